@@ -103,6 +103,17 @@ def dndz(x, **kw):
     return np.zeros_like(x[0])
 
 
+def nandgrad(x, **kw):
+    """
+    Refractive index and its gradient in one call.
+    """
+    expterm = grin_strength*np.exp(-x[0]**2 - 4.*x[1]**2)
+    return (expterm + 1.0,
+            np.array([-2.*x[0]*expterm,
+                      -2.*4.*x[1]*expterm,
+                      np.zeros_like(x[0])]))
+
+
 def bnd(x):
     """
     Boundary function.
@@ -112,7 +123,8 @@ def bnd(x):
 
 # grinmaterial = ConstantIndexGlass(lc1, 1.0 + grin_strength)
 grinmaterial = IsotropicGrinMaterial(lc1, nfunc, dndx, dndy, dndz,
-                                     parameterlist=[("n0", 0.5)])
+                                     parameterlist=[("n0", 0.5)],
+                                     nandgradfunc=nandgrad)
 grinmaterial.ds = 0.05
 grinmaterial.energyviolation = 0.01
 grinmaterial.boundaryfunction = bnd
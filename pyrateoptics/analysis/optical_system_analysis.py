@@ -24,6 +24,8 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+from copy import deepcopy
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -49,6 +51,7 @@ class OpticalSystemAnalysis(BaseLogger):
         super(OpticalSystemAnalysis, self).__init__(
                 kind=kind, name=name)
         self.opticalsystem = os
+        self.__trace_cache = None
         self.sequence = seq
         # TODO: field_raster and pupil raster belong into the aim class
 
@@ -63,6 +66,7 @@ class OpticalSystemAnalysis(BaseLogger):
         Sets sequence and optical element analyses.
         """
         self.__sequence = seq
+        self.clearTraceCache()
         self.opticalelementanalysis_dict = {}  # reset dict
         for (elem, elemseq) in seq:
             self.opticalelementanalysis_dict[elem] =\
@@ -150,28 +154,88 @@ class OpticalSystemAnalysis(BaseLogger):
         return (origin, k0[2, :, :], E0[2, :, :])
 
     def aim(self, numrays, rays_dict, bundletype="collimated",
-            wave=standard_wavelength):
+            wave=standard_wavelength, geometric=False):
         """
         Convenience function for ray aiming for different field points and for
         a specific pupil sampling. Will be substituted by a general aiming
         class later
+
+        If wave is a list of wavelengths, the rays for all wavelengths
+        are collected in one polychromatic bundle which is traced in a
+        single pass.
+
+        If geometric is True, geometric bundles without electrical
+        field are traced (sufficient for spots, footprints, etc.).
         """
 
         call_dict = {"collimated": self.collimated_bundle,
                      "divergent": self.divergent_bundle}
 
-        (o1, k1, E1) = call_dict[bundletype](numrays, rays_dict, wave=wave)
-        self.initial_bundles = [RayBundle(x0=o1, k0=k1, Efield0=E1, wave=wave)]
+        if np.ndim(wave) == 0:
+            (o1, k1, E1) = call_dict[bundletype](numrays, rays_dict,
+                                                 wave=wave)
+        else:
+            bundles = [call_dict[bundletype](numrays, rays_dict, wave=w)
+                       for w in wave]
+            o1 = np.hstack([o for (o, _, _) in bundles])
+            k1 = np.hstack([k for (_, k, _) in bundles])
+            E1 = np.hstack([e for (_, _, e) in bundles])
+            wave = np.repeat(np.asarray(wave, dtype=float),
+                             [np.shape(o)[1] for (o, _, _) in bundles])
+        self.initial_bundles = [RayBundle(x0=o1, k0=k1, Efield0=E1, wave=wave,
+                                          geometric=geometric)]
         # TODO: need access to (o, k, E) triples
 
+    def clearTraceCache(self):
+        """
+        Forces the next call of trace to trace the rays again.
+        """
+        self.__trace_cache = None
+
+    def isTraceCacheValid(self, **kwargs):
+        """
+        Checks whether the rays of the last trace call are still valid, i.e.
+        whether the initial bundles, the sequence, the trace options and
+        the version stamp of the optical system are unchanged.
+        """
+        cache = self.__trace_cache
+        if cache is None or self.initial_bundles is None:
+            return False
+        return (len(cache["bundles"]) == len(self.initial_bundles) and
+                all([cached is ib for (cached, ib) in
+                     zip(cache["bundles"], self.initial_bundles)]) and
+                cache["sequence"] == self.sequence and
+                cache["kwargs"] == kwargs and
+                cache["stamp"] == self.opticalsystem.getVersionStamp())
+
     def trace(self, **kwargs):
         """
         Convenience function to trace rays. Later the bundletype functionality
         will be substituted by aiming functionality.
+
+        The result is cached and reused by all analysis functions until the
+        initial bundles, the sequence, the trace options or the variables
+        of the optical system change. Changes of plain attributes (no
+        optimizable variables) are not detected, call clearTraceCache
+        after them.
+
+        The returned list is a copy, but the ray paths in it are shared
+        with the cache and must not be changed.
         """
+        if self.isTraceCacheValid(**kwargs):
+            self.info("reusing traced rays")
+            return list(self.__trace_cache["raypaths"])
         self.info("tracing rays")
-        return [self.opticalsystem.seqtrace(ib, self.sequence, **kwargs)
-                for ib in self.initial_bundles]
+        # the initial bundles are not touched by the trace
+        raypaths = [self.opticalsystem.seqtrace(ib.returnInitialRayBundle(),
+                                                self.sequence, **kwargs)
+                    for ib in self.initial_bundles]
+        self.__trace_cache = {"bundles": list(self.initial_bundles),
+                              "sequence": deepcopy(self.sequence),
+                              "kwargs": deepcopy(kwargs),
+                              "stamp": self.opticalsystem.getVersionStamp(),
+                              "raypaths": raypaths}
+        return list(raypaths)
 
     def trace3Dglobal(self, x0, k0, wave=standard_wavelength, **kwargs):
         """
@@ -185,7 +249,14 @@ class OpticalSystemAnalysis(BaseLogger):
 
         E0 = np.repeat(canonical_ey[:, np.newaxis], num_pts, axis=1)
 
-        self.initial_bundles = [RayBundle(x0, k0, E0, wave=wave)]
+        # keep the bundle (and therefore the cached trace) for equal rays
+        bundles = self.initial_bundles
+        if bundles is None or len(bundles) != 1 or\
+                bundles[0].geometric or\
+                not np.array_equal(bundles[0].x[0], x0) or\
+                not np.array_equal(bundles[0].k[0], k0) or\
+                not np.array_equal(bundles[0].wave, wave):
+            self.initial_bundles = [RayBundle(x0, k0, E0, wave=wave)]
         fp_raypaths = self.trace(**kwargs)
         return [[[(rb.x[0, :, :], rb.k[0, :, :])
                   for rb in rp.raybundles] for rp in fp] for fp in fp_raypaths]
@@ -272,8 +343,8 @@ class OpticalSystemAnalysis(BaseLogger):
         last_surf = self.opticalsystem.elements[last_oe].\
             surfaces[last_surf_name]
 
-        last_raybundle = raypath.raybundles[-1]
-        last_x_global = raypath.raybundles[-1].x[-1]
+        last_raybundle = raypath.returnLastRayBundle()
+        last_x_global = last_raybundle.x[-1]
 
         last_x_surf = last_surf.rootcoordinatesystem.\
             returnGlobalToLocalPoints(last_x_global)
@@ -88,7 +88,7 @@ class RayBundleAnalysis(BaseLogger):
                         (1d numpy array of 3 floats)
         """
 
-        directions = self.raybundle.returnKtoD()[-1]
+        directions = self.raybundle.returnKtoD(-1)
         # (_, num_rays) = np.shape(directions)
         com_d = np.sum(directions, axis=1)
         length = np.sqrt(np.sum(com_d**2))
@@ -114,7 +114,7 @@ class RayBundleAnalysis(BaseLogger):
         # deviations from the reference,
         # but for large deviations the definition makes no sense, anyway
 
-        directions = self.raybundle.returnKtoD()[-1]
+        directions = self.raybundle.returnKtoD(-1)
         (_, num_rays) = np.shape(directions)
 
         cross_product = np.cross(directions, refDir, axisa=0).T
@@ -27,6 +27,8 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 import math
 import re
+import itertools
+import numbers
 
 from copy import copy
 
@@ -40,6 +42,12 @@ class OptimizableVariable(BaseLogger):
     The value is not constrained to float.
     Also other dependent variables are possible to define.
     """
+
+    # Stamps shared by all variables. Every change of a variable draws
+    # the next stamp, therefore stamps are never reused.
+    revision_counter = itertools.count()
+    latest_revision = next(revision_counter)
+
     def __init__(self, variable_type="fixed",
                  name="", kind="optimizablevariable", **kwargs):
 
@@ -91,10 +99,17 @@ class OptimizableVariable(BaseLogger):
                     "external": self.init_external
                     }
 
+        # a new variable is not part of any cache or registry yet,
+        # therefore latest_revision and latest_structure_revision are kept
+        self.__revision = next(OptimizableVariable.revision_counter)
+        latest_structure_revision =\
+            ClassWithOptimizableVariables.latest_structure_revision
         self.var_type = variable_type
         self.evalfunc = self.evaldict[self.var_type]
         self.initdict[self.var_type](**kwargs)
         self.set_interval(None, None)
+        ClassWithOptimizableVariables.latest_structure_revision =\
+            latest_structure_revision
 
     def init_fixed(self, **kwargs):
         self.parameters = {}
@@ -111,6 +126,7 @@ class OptimizableVariable(BaseLogger):
         # self.parameters["function"] = kwargs.get("function", None)
         self.parameters["args"] = kwargs.get("args", ())
         # TODO: function also as string, string tuple or as code object
+        self.__plan_value = (None, None)
 
     def init_external(self, **kwargs):
         self.parameters = {}
@@ -141,6 +157,8 @@ class OptimizableVariable(BaseLogger):
         2010-03-31
         """
         # TODO: fine-tune for one-sided intervals
+        self.interval = (left, right)
+        self.markStructureChanged()
         if left is None and right is None:
             self.transform = lambda x: x
             self.inv_transform = lambda x: x
@@ -196,6 +214,8 @@ class OptimizableVariable(BaseLogger):
 
         self.evalfunc = self.evaldict[to_type]
         self.var_type = to_type
+        self.drawRevision()
+        self.markStructureChanged()
         self.debug("new value %s and new parameters %s" %
                    (str(self.evaluate()), str(self.parameters)))
 
@@ -206,6 +226,53 @@ class OptimizableVariable(BaseLogger):
         # TODO: overload assign operator
         if self.var_type == "variable" or self.var_type == "fixed":
             self.parameters["value"] = value
+            self.drawRevision()
+
+    def drawRevision(self):
+        """
+        Marks the value of the variable as changed.
+        """
+        self.__revision = next(OptimizableVariable.revision_counter)
+        OptimizableVariable.latest_revision = self.__revision
+
+    def markStructureChanged(self):
+        """
+        Invalidates the variable registries containing the variable,
+        e.g. since its type or interval changed.
+        """
+        self.__structure_revision =\
+            next(ClassWithOptimizableVariables.structure_counter)
+        ClassWithOptimizableVariables.latest_structure_revision =\
+            self.__structure_revision
+
+    def getStructureRevision(self):
+        return self.__structure_revision
+
+    def __setstate__(self, state):
+        """
+        Stamps of other processes may be drawn again in this one,
+        therefore new stamps are drawn.
+        """
+        super(OptimizableVariable, self).__setstate__(state)
+        self.__revision = next(OptimizableVariable.revision_counter)
+        self.__plan_value = (None, None)
+        self.__structure_revision =\
+            next(ClassWithOptimizableVariables.structure_counter)
+
+    def getRevision(self):
+        """
+        Returns a stamp which changes whenever the value of the variable
+        may have changed. Useful to invalidate caches depending on the
+        value. For pickups the stamps of the arguments are included.
+        The value of an external variable may change at any time,
+        therefore it gets a new stamp on every call.
+        """
+        if self.var_type == "external":
+            return next(OptimizableVariable.revision_counter)
+        if self.var_type == "pickup":
+            return max([self.__revision] +
+                       [arg.getRevision() for arg in self.parameters["args"]])
+        return self.__revision
 
     def eval_fixed(self):
         # if type = variable then give only access to value
@@ -215,7 +282,18 @@ class OptimizableVariable(BaseLogger):
         # if type = variable then give only access to value
         return self.parameters.get("value", None)
 
+    def setPlanValue(self, value):
+        """
+        Stores the value of a pickup computed by an EvaluationPlan. It is
+        returned by evaluate() as long as no variable changed.
+        """
+        self.__plan_value = (OptimizableVariable.latest_revision, value)
+
     def eval_pickup(self):
+        (revision, value) = self.__plan_value
+        if revision is not None and\
+                revision == OptimizableVariable.latest_revision:
+            return value
         # if type = pickup then package up all arguments into one tuple
         # and put it into the userdefined function
         # evaluate the result
@@ -285,6 +363,158 @@ class OptimizableVariable(BaseLogger):
             res.unique_id = kwargs["unique_id"]
         return res
 
+class EvaluationPlan(object):
+    """
+    Evaluation order of a set of OptimizableVariables and their values in
+    one contiguous array. The variables are sorted topologically once,
+    i.e. the arguments of every pickup come before the pickup. Then all
+    pickups are evaluated in one pass without recursion and every pickup
+    is evaluated exactly once. The results are stored in the pickup
+    variables and returned by them until the next variable changes.
+    Pickups depending on external variables are not stored, since the
+    external values may change at any time.
+
+    The interval transforms of the active variables are applied
+    vectorized over the whole active vector.
+    """
+
+    def __init__(self, variables, active):
+        """
+        :param variables (list of OptimizableVariable)
+                    arguments of pickups which are not part of the list
+                    are collected automatically
+        :param active (list of OptimizableVariable)
+                    subset of variables which is seen by the optimizer
+        """
+        self.order = []
+        index = {}
+        visiting = set()
+
+        def visit(var):
+            if id(var) in index:
+                return
+            if id(var) in visiting:
+                raise Exception("cyclic pickup dependency for variable " +
+                                var.name)
+            visiting.add(id(var))
+            if var.var_type == "pickup":
+                for arg in var.parameters["args"]:
+                    visit(arg)
+            visiting.discard(id(var))
+            index[id(var)] = len(self.order)
+            self.order.append(var)
+
+        for var in variables:
+            visit(var)
+
+        self.sources = [(index[id(var)], var) for var in self.order
+                        if var.var_type != "pickup"]
+        volatile = set()
+        for var in self.order:
+            if var.var_type == "external" or\
+                    (var.var_type == "pickup" and
+                     any([id(arg) in volatile
+                          for arg in var.parameters["args"]])):
+                volatile.add(id(var))
+        self.volatile = len(volatile) > 0
+        self.pickups = [(index[id(var)], var,
+                         np.array([index[id(arg)]
+                                   for arg in var.parameters["args"]],
+                                  dtype=int),
+                         id(var) not in volatile)
+                        for var in self.order if var.var_type == "pickup"]
+        self.values = np.zeros(len(self.order))
+
+        self.active = np.array([index[id(var)] for var in active], dtype=int)
+        intervals = [var.interval for var in active]
+        self.bounded = np.array([left is not None and right is not None
+                                 for (left, right) in intervals], dtype=bool)
+        self.onesided = np.array([(left is None) != (right is None)
+                                  for (left, right) in intervals],
+                                 dtype=bool)
+        self.left = np.array([left for (left, right) in intervals],
+                             dtype=object)[self.bounded].astype(float)
+        self.right = np.array([right for (left, right) in intervals],
+                              dtype=object)[self.bounded].astype(float)
+        self.active_variables = list(active)
+
+    def store(self, ind, value):
+        """
+        Writes value into the value array. Real numbers are stored as
+        float, for any other value the array is converted to an object
+        array.
+        """
+        if self.values.dtype != object:
+            if isinstance(value, numbers.Real):
+                value = float(value)
+            else:
+                self.values = self.values.astype(object)
+        self.values[ind] = value
+
+    def evaluate(self):
+        """
+        Evaluates all variables in topological order.
+
+        :return values (1d numpy array)
+        """
+        for (ind, var) in self.sources:
+            self.store(ind, var.evaluate())
+        for (ind, var, argindices, cache) in self.pickups:
+            (functionobject, functionname) = var.parameters["functionobject"]
+            value = functionobject.functions[functionname](
+                *self.values[argindices])
+            self.store(ind, value)
+            if cache:
+                var.setPlanValue(value)
+        return self.values
+
+    def transform(self, values):
+        """
+        Vectorized interval transform of the active values from their
+        finite interval to IR.
+
+        :param values (1d numpy array of float)
+        """
+        result = np.array(values, dtype=float)
+        (left, right) = (self.left, self.right)
+        x = result[self.bounded]
+        result[self.bounded] = np.log((-x + left)/(x - right)) *\
+            np.abs(left - right)
+        for ind in np.flatnonzero(self.onesided):
+            result[ind] = self.active_variables[ind].transform(values[ind])
+        return result
+
+    def inv_transform(self, values_transformed):
+        """
+        Vectorized interval transform of the active values from IR back
+        to their finite interval.
+
+        :param values_transformed (1d numpy array of float)
+        """
+        result = np.array(values_transformed, dtype=float)
+        (left, right) = (self.left, self.right)
+        x = result[self.bounded]
+        result[self.bounded] = left +\
+            (right - left)/(1. + np.exp(-x/np.abs(right - left)))
+        for ind in np.flatnonzero(self.onesided):
+            result[ind] = self.active_variables[ind].inv_transform(
+                values_transformed[ind])
+        return result
+
+    def getActiveValues(self):
+        return self.values[self.active]
+
+    def setActiveValues(self, values):
+        """
+        Sets the values of the active variables and evaluates the plan.
+
+        :param values (1d numpy array of float)
+        """
+        for (var, value) in zip(self.active_variables, values):
+            var.setvalue(float(value))
+        return self.evaluate()
+
+
 # TODO: This class contains far too much stuff! Refactor!
 # Four core functionalities which may be splitted:
 #   I   Observer (lightweight) - needed for interface communication
@@ -303,7 +533,26 @@ class ClassWithOptimizableVariables(BaseLogger):
     which gives the user the opportunity to implement a certain logic via
     class inheritance and interface the child class with some type of
     optimizer.
+
+    The result of the traversal is cached in a registry per object. Every
+    class and variable carries a structure stamp which changes whenever
+    it links or unlinks variables or classes (assignment of an attribute
+    which contains or contained variables or classes, or the add methods
+    of the raytracer containers) or the variable changes its type or
+    interval (see markStructureChanged). A registry is rebuilt only if
+    the stamp of one of the objects it contains changed, therefore
+    creating or changing unrelated objects keeps it. In place changes of
+    containers, e.g. self.lst.append(existing_variable), are not detected
+    and have to be followed by a call of markStructureChanged.
     """
+
+    # Structure stamps shared by all classes and variables. As long as
+    # latest_structure_revision did not change, no registry has to be
+    # checked.
+    structure_counter = itertools.count()
+    latest_structure_revision = next(structure_counter)
+    registry_attribute = "_ClassWithOptimizableVariables__variable_registry"
+
     def __init__(self, name="", kind="classwithoptimizablevariables",
                  **kwargs):
         """
@@ -318,6 +567,141 @@ class ClassWithOptimizableVariables(BaseLogger):
         self.list_observers = []
         # for the optimizable variable class it is useful to have some observer
         # links they get informed if variables change their values
+        self.__variable_registry = None
+        # a new class is not part of any registry yet, therefore
+        # latest_structure_revision is kept
+        self.__structure_revision =\
+            next(ClassWithOptimizableVariables.structure_counter)
+
+    def __setattr__(self, key, value):
+        if self.containsOptimizableVariables(value) or\
+                self.containsOptimizableVariables(self.__dict__.get(key)):
+            self.markStructureChanged()
+        super(ClassWithOptimizableVariables, self).__setattr__(key, value)
+
+    @staticmethod
+    def containsOptimizableVariables(value):
+        """
+        Checks whether value is or contains (in dicts, lists or tuples)
+        an OptimizableVariable or a ClassWithOptimizableVariables.
+        """
+        stack = [value]
+        visited = set()
+        while stack:
+            item = stack.pop()
+            if isinstance(item, (OptimizableVariable,
+                                 ClassWithOptimizableVariables)):
+                return True
+            if isinstance(item, (dict, list, tuple)) and\
+                    id(item) not in visited:
+                visited.add(id(item))
+                stack.extend(item.values() if isinstance(item, dict)
+                             else item)
+        return False
+
+    def markStructureChanged(self):
+        """
+        Invalidates the variable registries containing self. Has to be
+        called if objects are linked by in place changes of containers,
+        e.g. self.dict[key] = obj.
+        """
+        self.__structure_revision =\
+            next(ClassWithOptimizableVariables.structure_counter)
+        ClassWithOptimizableVariables.latest_structure_revision =\
+            self.__structure_revision
+
+    def getStructureRevision(self):
+        return self.__structure_revision
+
+    def getVariableRegistry(self):
+        """
+        Returns the cached result of getAllVariables together with the
+        flat ordered list of active variables. Rebuilt only if the
+        structure changed.
+
+        :return registry (dict): keys "revision" (unique stamp of the
+                 registry), "variables" (result of getAllVariables),
+                 "active" (list of OptimizableVariable), "plan"
+                 (EvaluationPlan), "structure" (list of objects with
+                 their structure stamps), "checked", "stamp" (last
+                 result of getVersionStamp)
+        """
+        registry = self.__variable_registry
+        if registry is None or not self.checkRegistry(registry):
+            latest = ClassWithOptimizableVariables.latest_structure_revision
+            variables = self.collectAllVariables()
+            active = [x for x in variables["vars"].values()
+                      if x.var_type == "variable"]
+            structure = [(obj, obj.getStructureRevision())
+                         for obj in list(variables["classes"].values()) +
+                         list(variables["vars"].values())]
+            registry = {"revision":
+                        next(ClassWithOptimizableVariables.structure_counter),
+                        "variables": variables,
+                        "active": active,
+                        "plan": EvaluationPlan(
+                            list(variables["vars"].values()), active),
+                        "structure": structure,
+                        "checked": latest,
+                        "stamp": (None, None)}
+            # do not trigger markStructureChanged by __setattr__
+            self.__dict__[self.registry_attribute] = registry
+        return registry
+
+    @staticmethod
+    def checkRegistry(registry):
+        """
+        Checks whether the structure stamps of all objects in a registry
+        are unchanged. Skipped if no structure changed at all since the
+        last check.
+        """
+        latest = ClassWithOptimizableVariables.latest_structure_revision
+        if registry["checked"] == latest:
+            return True
+        for (obj, revision) in registry["structure"]:
+            if obj.getStructureRevision() != revision:
+                return False
+        registry["checked"] = latest
+        return True
+
+    def getVersionStamp(self):
+        """
+        Returns a stamp which changes whenever the structure of self
+        (including its subobjects) changed, e.g. by replacing variables,
+        or the value of one of its variables may have changed. Useful to
+        invalidate caches of results depending on self. For external
+        variables the stamp changes on every call. Changes of attributes
+        which are no variables are not detected.
+
+        :return stamp (tuple of int)
+        """
+        registry = self.getVariableRegistry()
+        # as long as no variable changed, the last stamp is still valid
+        (latest, stamp) = registry["stamp"]
+        if latest != OptimizableVariable.latest_revision or\
+                registry["plan"].volatile:
+            revisions = [var.getRevision()
+                         for var in registry["variables"]["vars"].values()]
+            stamp = (registry["revision"], max([-1] + revisions))
+            registry["stamp"] = (OptimizableVariable.latest_revision, stamp)
+        return stamp
+
+    def __getstate__(self):
+        """
+        The registry is not part of the state, it is rebuilt on demand.
+        """
+        state = super(ClassWithOptimizableVariables, self).__getstate__()
+        state[self.registry_attribute] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Stamps of other processes may be drawn again in this one,
+        therefore a new structure stamp is drawn.
+        """
+        super(ClassWithOptimizableVariables, self).__setstate__(state)
+        self.__structure_revision =\
+            next(ClassWithOptimizableVariables.structure_counter)
 
     def appendObservers(self, obslist):
         self.list_observers += obslist
@@ -377,6 +761,8 @@ class ClassWithOptimizableVariables(BaseLogger):
         mydict = {}
 
         for (key, value) in self.__dict__.items():
+            if key == self.registry_attribute:
+                continue
             myitem = remove_non_optvars(value)
             if myitem is not None:
                 mydict[key] = myitem
@@ -384,6 +770,16 @@ class ClassWithOptimizableVariables(BaseLogger):
         return mydict
 
     def getAllVariables(self, recursive=True):
+        """
+        This functions traverses through a ClassWithOptimizableVariables
+        and collects several information of the underlying recursive structure.
+        For recursive=True the cached result from the registry is returned.
+        """
+        if recursive:
+            return self.getVariableRegistry()["variables"]
+        return self.collectAllVariables(recursive=False)
+
+    def collectAllVariables(self, recursive=True):
 
         """
         This functions traverses through a ClassWithOptimizableVariables
@@ -394,11 +790,8 @@ class ClassWithOptimizableVariables(BaseLogger):
         # TODO: This function is too intelligent. Divide into more appropriate sub problems
 
         def addOptimizableVariablesToList(var,
-                                          dictOfOptVars={"vars": {},
-                                                         "longkeystrings": {},
-                                                         "deref": {},
-                                                         "classes": {}},
-                                          idlist=[],
+                                          dictOfOptVars=None,
+                                          idlist=None,
                                           keystring="",
                                           reducedkeystring="", recursive=True):
             """
@@ -416,16 +809,26 @@ class ClassWithOptimizableVariables(BaseLogger):
 
             @param var: object to evaluate (object)
             @param dictOfOptVars: optimizable variables found (dict of dict of objects)
-            @param idlist: ids of objects already evaluated (list of int)
+            @param idlist: ids of objects already evaluated (set of int)
             """
 
+            if dictOfOptVars is None:
+                dictOfOptVars = {"vars": {},
+                                 "longkeystrings": {},
+                                 "deref": {},
+                                 "classes": {}}
+            if idlist is None:
+                idlist = set()
+
             if id(var) not in idlist:
-                idlist.append(id(var))
+                idlist.add(id(var))
 
                 if isinstance(var, ClassWithOptimizableVariables):
                     if len(idlist) == 1 or (len(idlist) > 1 and recursive):
                         dictOfOptVars["classes"][var.unique_id] = var
                         for (k, v) in var.__dict__.items():
+                            if k == var.registry_attribute:
+                                continue
                             newkeystring = keystring + "(" + var.name + ")." +\
                                 str(k)
                             newredkeystring = reducedkeystring + var.name + "."
@@ -522,35 +925,38 @@ class ClassWithOptimizableVariables(BaseLogger):
         but it does not matter since the variable references are still in the
         original dictionary in the class
         """
-        return [x for x in self.getAllVariables()["vars"].values()
-                if x.var_type == "variable"]
+        return list(self.getVariableRegistry()["active"])
 
     def getActiveValues(self):
         """
         Function to get all values into one large np.array.
         Supports only float at the moment.
         """
-        return np.array([float(a()) for a in self.getActiveVariables()])
+        active = self.getVariableRegistry()["active"]
+        return np.fromiter((float(a()) for a in active), dtype=float,
+                           count=len(active))
 
     def setActiveValues(self, x):
         """
         Function to set all values of active variables to the values in the
         large np.array x. Supports only float at the moment.
         """
-        for i, var in enumerate(self.getActiveVariables()):
-            var.setvalue(float(x[i]))
+        x = np.asarray(x, dtype=float)
+        for (var, value) in zip(self.getVariableRegistry()["active"], x):
+            var.setvalue(float(value))
 
     def getActiveTransformedValues(self):
-        return np.array([a.evaluate_transformed() for a in
-                         self.getActiveVariables()])
+        plan = self.getVariableRegistry()["plan"]
+        return plan.transform(self.getActiveValues())
 
     def setActiveTransformedValues(self, x):
         """
         Function to set all values of active variables to the values in the
-        large np.array x.
+        large np.array x. Afterwards all pickups are evaluated in one pass
+        (see EvaluationPlan).
         """
-        for i, var in enumerate(self.getActiveVariables()):
-            var.setvalue_transformed(float(x[i]))
+        plan = self.getVariableRegistry()["plan"]
+        plan.setActiveValues(plan.inv_transform(x))
 
     def resetVariable(self, key, var):
         """
@@ -562,6 +968,7 @@ class ClassWithOptimizableVariables(BaseLogger):
         dict_of_vars = self.getAllVariables()
         deref = dict_of_vars["deref"][key]
         exec(compile("self" + deref + " = var", "<string>", "exec"))
+        self.markStructureChanged()
 
     def getVariable(self, key):
         """
@@ -27,13 +27,20 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 import math
 from ..core.base import ClassWithOptimizableVariables
-import scipy.linalg as sla
 
-from ..raytracer.globalconstants import standard_wavelength
+from ..raytracer.helpers_math import (eig_generalized_finite_sample,
+                                      degenerate_eigenvectors_sample,
+                                      quartic_roots_sample)
+from ..raytracer.globalconstants import (standard_wavelength,
+                                         canonical_ex, canonical_ey)
 
 class Material(ClassWithOptimizableVariables):
     """Abstract base class for materials."""
 
+    # True if the index does not depend on the position, such that the
+    # trace may use IsotropicMaterial.propagateConicAndRefract
+    fused_conic_refraction = False
+
     def __init__(self, lc, name="", kind="material", **kwargs):
         """
         virtual constructor
@@ -83,6 +90,17 @@ class MaxwellMaterial(Material):
     # sorting E and k according to Poynting vector scalar product with real
     # direction vector
 
+    def __init__(self, lc, xi_solver="eig", **kwargs):
+        """
+        :param lc (LocalCoordinates object)
+        :param xi_solver (string) backend for the calculation of xi and
+                the E-field eigenvectors during refraction and reflection:
+                "eig" (generalized eigenvalue problem, default) or
+                "quartic" (roots of the quartic dispersion polynomial)
+        """
+        super(MaxwellMaterial, self).__init__(lc, **kwargs)
+        self.xi_solver = xi_solver
+
     def getEpsilonTensor(self, x, wave=standard_wavelength):
         """
         Calculate epsilon tensor if needed. (isotropic e.g.) eps = diag(3)*n^2
@@ -92,7 +110,11 @@ class MaxwellMaterial(Material):
         raise NotImplementedError()
 
     def calcKnormEfield(self, x, n, kpa_norm, wave=standard_wavelength):
-        (xi_4, efield_4) = self.calcXiEigenvectorsNorm(x, n, kpa_norm, wave=wave)
+        xi_solvers = {"eig": self.calcXiEigenvectorsNorm,
+                      "quartic": self.calcXiEigenvectorsNormQuartic}
+
+        (xi_4, efield_4) = xi_solvers[self.xi_solver](x, n, kpa_norm,
+                                                      wave=wave)
 
         # xi_4: 4xN
         # efield_4: 4x3xN
@@ -132,8 +154,6 @@ class MaxwellMaterial(Material):
 
         (k_norm_4, Efield_4) = self.calcKnormEfield(x, n, kpa_norm, wave=wave)
 
-        k_norm_4_sorted = np.zeros_like(k_norm_4)
-        Efield_4_sorted = np.zeros_like(Efield_4)
         Sn_scalarproduct = np.zeros((4, num_pts))
 
 
@@ -142,9 +162,12 @@ class MaxwellMaterial(Material):
             Sn_scalarproduct[i, :] = np.sum(Si*e, axis=0)
 
         Sn_scalarproduct_argsort = Sn_scalarproduct.argsort(axis=0)
-        for i in range(num_pts):
-            k_norm_4_sorted[:, :, i] = k_norm_4[Sn_scalarproduct_argsort[:, i], :, i]
-            Efield_4_sorted[:, :, i] = Efield_4[Sn_scalarproduct_argsort[:, i], :, i]
+        k_norm_4_sorted = np.transpose(
+            k_norm_4[Sn_scalarproduct_argsort, :, np.arange(num_pts)],
+            (0, 2, 1))
+        Efield_4_sorted = np.transpose(
+            Efield_4[Sn_scalarproduct_argsort, :, np.arange(num_pts)],
+            (0, 2, 1))
 
         return (k_norm_4_sorted, Efield_4_sorted)
 
@@ -165,8 +188,6 @@ class MaxwellMaterial(Material):
 
         (k_norm_4, Efield_4) = self.calcKnormDirectionEfield(x, kd, wave=wave)
 
-        k_norm_4_sorted = np.zeros_like(k_norm_4)
-        Efield_4_sorted = np.zeros_like(Efield_4)
         Sn_scalarproduct = np.zeros((4, num_pts))
 
 
@@ -174,10 +195,18 @@ class MaxwellMaterial(Material):
             Si = self.calcPoytingVectorNorm(k_norm_4[i, :, :], Efield_4[i, :, :])
             Sn_scalarproduct[i, :] = np.sum(Si*e, axis=0)
 
-        Sn_scalarproduct_argsort = Sn_scalarproduct.argsort(axis=0)
-        for i in range(num_pts):
-            k_norm_4_sorted[:, :, i] = k_norm_4[Sn_scalarproduct_argsort[:, i], :, i]
-            Efield_4_sorted[:, :, i] = Efield_4[Sn_scalarproduct_argsort[:, i], :, i]
+        # solutions of a degenerate eigenvalue have equal scalar products
+        # up to rounding; keep their order by a stable sort of rounded values
+        Sn_scale = np.max(np.abs(Sn_scalarproduct), axis=0)
+        Sn_scale[Sn_scale == 0] = 1.
+        Sn_scalarproduct_argsort = np.round(
+            Sn_scalarproduct/Sn_scale, 10).argsort(axis=0, kind="mergesort")
+        k_norm_4_sorted = np.transpose(
+            k_norm_4[Sn_scalarproduct_argsort, :, np.arange(num_pts)],
+            (0, 2, 1))
+        Efield_4_sorted = np.transpose(
+            Efield_4[Sn_scalarproduct_argsort, :, np.arange(num_pts)],
+            (0, 2, 1))
 
         return (k_norm_4_sorted, Efield_4_sorted)
 
@@ -371,19 +400,11 @@ class MaxwellMaterial(Material):
         Kmatrix = np.array(eps, dtype=complex) # if eps is only real we have to cast it to complex
         Cmatrix = np.copy(ZeroMatrix)
 
-        # FIXME: subst for loop by einsum
-        #Mmatrix += np.einsum("i...,j...->ij...", n, n)
-        #Cmatrix += np.einsum("i...,j...->ij...", kpa_norm, n) +\
-        #    np.einsum("i...,j...->ij...", n, kpa_norm)
-        #Kmatrix += -np.einsum("k...,k...->...", kpa_norm, kpa_norm)*IdMatrix +\
-        #    np.einsum("i...,j...->ij...", kpa_norm, kpa_norm)
-
-        for j in range(num_pts):
-            Mmatrix[:, :, j] += np.outer(n[:, j], n[:, j])
-            Cmatrix[:, :, j] += np.outer(kpa_norm[:, j], n[:, j]) +\
-                np.outer(n[:, j], kpa_norm[:, j])
-            Kmatrix[:, :, j] += -np.dot(kpa_norm[:,j], kpa_norm[:,j])*complexidmatrix +\
-                np.outer(kpa_norm[:, j], kpa_norm[:, j])
+        Mmatrix += np.einsum("i...,j...->ij...", n, n)
+        Cmatrix += np.einsum("i...,j...->ij...", kpa_norm, n) +\
+            np.einsum("i...,j...->ij...", n, kpa_norm)
+        Kmatrix += -np.einsum("k...,k...->...", kpa_norm, kpa_norm)*IdMatrix +\
+            np.einsum("i...,j...->ij...", kpa_norm, kpa_norm)
 
         Amatrix6x6 = np.vstack(
                     (np.hstack((Cmatrix, Kmatrix)),
@@ -416,34 +437,15 @@ class MaxwellMaterial(Material):
 
         """
 
-        (num_dims, num_pts) = np.shape(kpa_norm)
-
-        eigenvectors = np.zeros((4, 3, num_pts), dtype=complex)
-        eigenvalues = np.zeros((4, num_pts), dtype=complex)
         # xi number, eigv 3xN
+        # all generalized eigenvalue problems are solved at once
 
         ((Amatrix6x6, Bmatrix6x6), (Mmatrix, Cmatrix, Kmatrix)) \
             = self.calcXiQEVMatricesNorm(x, n, kpa_norm, wave=wave)
 
-        for j in range(num_pts):
-            (w, vr) = sla.eig(Amatrix6x6[:, :, j], b=Bmatrix6x6[:, :, j])
-
-            # first remove infinite parts
-            # then sort w for abs value
-            # then remove the largest values until len(w) = 4
-
-            wfinite = np.isfinite(w)
-            w = w[wfinite]
-            vr = vr[:, wfinite]
-
-            if len(w) > 4:
-                to_remove = len(w) - 4
-                sorted_indices = np.abs(w).argsort()
-                w = w[sorted_indices][:-to_remove]
-                vr = vr[:, sorted_indices][:, :-to_remove]
-
-            eigenvalues[:, j] = np.copy(w)
-            eigenvectors[:, :, j] = (vr.T)[:, 3:]
+        (eigenvalues, eigenvectors6) = eig_generalized_finite_sample(
+            Amatrix6x6, Bmatrix6x6, 4)
+        eigenvectors = eigenvectors6[:, 3:, :]
 
         return (eigenvalues, eigenvectors)
 
@@ -460,35 +462,24 @@ class MaxwellMaterial(Material):
         (num_dims, num_pts) = np.shape(x)
         eps = self.getEpsilonTensor(x, wave=wave)
 
-        eigenvectors = np.zeros((4, 3, num_pts), dtype=complex)
-        eigenvalues = np.zeros((4, num_pts), dtype=complex)
-
-        Bmatrix = np.zeros((3, 3, num_pts), dtype=complex)
         Amatrix = eps
         scalar_product_ee = np.sum(e*e, axis=0)
 
-        for j in range(num_pts):
-            Bmatrix[:, :, j] = -(-np.eye(3)*scalar_product_ee[j] + np.outer(e[:, j], e[:, j]))
-
-        for j in range(num_pts):
-            (w, vr) = sla.eig(Amatrix[:, :, j], b=Bmatrix[:, :, j])
-
-            # first remove infinite parts
-            # then sort w for abs value
-            # then remove the largest values until len(w) = 4
+        Bmatrix = -(-np.eye(3)[:, :, np.newaxis]*scalar_product_ee +
+                    np.einsum("i...,j...->ij...", e, e))
 
-            wfinite = np.isfinite(w)
-            w = w[wfinite]
-            vr = vr[:, wfinite]
+        (w, vr) = eig_generalized_finite_sample(Amatrix, Bmatrix, 2)
 
-            if len(w) > 2:
-                to_remove = len(w) - 2
-                sorted_indices = np.abs(w).argsort()
-                w = w[sorted_indices][:-to_remove]
-                vr = vr[:, sorted_indices][:, :-to_remove]
+        # the eigenvectors of a degenerate eigenvalue (e.g. isotropic
+        # material) are fixed to a deterministic basis, such that the
+        # default polarization is the projection of canonical_ex
+        # (of canonical_ey for e along the x axis)
+        degenerate = np.abs(w[0] - w[1]) <= 1e-10*np.abs(w[0])
+        vr[:, :, degenerate] = degenerate_eigenvectors_sample(
+            vr[:, :, degenerate], canonical_ex, canonical_ey)
 
-            eigenvalues[:, j] = np.hstack((np.sqrt(w), -np.sqrt(w)))
-            eigenvectors[:, :, j] = np.vstack((vr.T, vr.T))
+        eigenvalues = np.vstack((np.sqrt(w), -np.sqrt(w)))
+        eigenvectors = np.vstack((vr, vr))
 
         return (eigenvalues, eigenvectors)
 
@@ -563,18 +554,73 @@ class MaxwellMaterial(Material):
         return p4*xi_norm**4 + p3*xi_norm**3 + p2*xi_norm**2 + p1*xi_norm + p0
 
     def calcXiNormZeros(self, x, n, kpa_norm, wave=standard_wavelength):
-        (num_dims, num_pts) = np.shape(kpa_norm)
-
         (p4, p3, p2, p1, p0) = self.calcXiPolynomialNorm(x, n, kpa_norm, wave=wave)
 
-        xizeros = np.zeros((4, num_pts), dtype=complex)
-        for i in np.arange(num_pts):
-            polycoeffs = [p4[i], p3[i], p2[i], p1[i], p0[i]]
-            roots = np.roots(polycoeffs)
-            xizeros[:, i] = roots
-        return xizeros
+        # all polynomials are solved at once
+        return quartic_roots_sample(np.array([p4, p3, p2, p1, p0]))
 
+    def calcXiEigenvectorsNormQuartic(self, x, n, kpa_norm,
+                                      wave=standard_wavelength, tol=1e-6):
+        """
+        Calculate eigenvalues and eigenvectors like calcXiEigenvectorsNorm,
+        but obtain xi from the zeros of the quartic polynomial and the
+        eigenvectors from the null space of the 3x3 matrix
+        (xi^2 M + xi C + K). Rays with (almost) degenerate solutions are
+        delegated to calcXiEigenvectorsNorm, since the null space is two
+        dimensional there.
 
+        :param x (3xN numpy array of float)
+                points where to evaluate eps tensor in local material coordinates
+        :param n (3xN numpy array of float)
+                normal of surface in local coordinates
+        :param kpa (3xN numpy array of float)
+                incoming wave vector inplane component in local coordinates
+        :param tol (float) relative tolerance for degeneracy detection
+
+        :return (xi, eigenvectors): xi (4xN numpy array of complex);
+                eigenvectors (4x3xN numpy array of complex)
+
+        """
+
+        eps = self.getEpsilonTensor(x, wave=wave)
+        eigenvalues = self.calcXiNormZeros(x, n, kpa_norm, wave=wave)
+
+        # propagator -k^2 delta_ij + k_i k_j + eps_ij for k = kpa + xi n
+        # equals xi^2 M + xi C + K
+        k_norm_4 = kpa_norm + eigenvalues[:, np.newaxis, :]*n  # 4x3xN
+        qmatrix = np.einsum("ai...,aj...->aij...", k_norm_4, k_norm_4) + eps
+        ksquared = np.einsum("ai...,ai...->a...", k_norm_4, k_norm_4)
+        for i in range(3):
+            qmatrix[:, i, i, :] -= ksquared  # 4x3x3xN
+
+        # rank 2 matrix: the null vector is perpendicular (without complex
+        # conjugation) to all rows, choose the best conditioned cross product
+        crossproducts = np.array(
+            [np.cross(qmatrix[:, i, :, :], qmatrix[:, j, :, :], axis=1)
+             for (i, j) in ((0, 1), (1, 2), (2, 0))])  # 3x4x3xN
+        crossnorms = np.sqrt(np.sum(np.abs(crossproducts)**2, axis=2))
+        best = np.argmax(crossnorms, axis=0)  # 4xN
+        (roots, pts) = np.indices(best.shape)
+        eigenvectors = np.transpose(crossproducts[best, roots, :, pts],
+                                    (0, 2, 1))
+        maxcrossnorm = crossnorms[best, roots, pts]
+
+        # normalize like lower part of unit eigenvector [xi X, X] of GLEVP
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eigenvectors /= (maxcrossnorm *
+                             np.sqrt(1. + np.abs(eigenvalues)**2))[
+                                 :, np.newaxis, :]
+
+        rownorm = np.max(np.sqrt(np.sum(np.abs(qmatrix)**2, axis=2)), axis=1)
+        degenerate = np.any(maxcrossnorm <= tol*rownorm**2, axis=0)
+        if np.any(degenerate):
+            (eigenvalues[:, degenerate], eigenvectors[:, :, degenerate]) = \
+                self.calcXiEigenvectorsNorm(x[:, degenerate],
+                                            n[:, degenerate],
+                                            kpa_norm[:, degenerate],
+                                            wave=wave)
+
+        return (eigenvalues, eigenvectors)
 
     def calcXiAnisotropic(self, x, n, kpa, wave=standard_wavelength):
         """
@@ -34,10 +34,22 @@ from ..raytracer.globalconstants import standard_wavelength
 
 class AnisotropicMaterial(MaxwellMaterial):
     
-    def __init__(self, lc, epstensor, name="", comment=""):
-        super(AnisotropicMaterial, self).__init__(lc, name=name, comment=comment)
+    def __init__(self, lc, epstensor, name="", comment="", xi_solver="eig",
+                 pruning_threshold=0.0):
+        """
+        :param lc (LocalCoordinates object)
+        :param epstensor (3x3 numpy array of complex)
+        :param xi_solver (string) see MaxwellMaterial
+        :param pruning_threshold (float) rays of a split eigenstate which
+                carry less than this fraction of the incoming energy are
+                dropped at splits (see splitRayBundle); 0 keeps all rays
+        """
+        super(AnisotropicMaterial, self).__init__(lc, name=name,
+                                                  comment=comment,
+                                                  xi_solver=xi_solver)
         
         self.epstensor = epstensor
+        self.pruning_threshold = pruning_threshold
         # up to now the material is not dispersive since the epsilon tensor
         # is not intended to be wave-dependent
     
@@ -59,11 +71,108 @@ class AnisotropicMaterial(MaxwellMaterial):
 
         nextSurface.intersect(raybundle)
 
+    def checkPolarizedBundle(self, raybundle):
+        # the rays in anisotropic materials are determined by their
+        # electrical fields which geometric bundles do not carry
+        if raybundle.geometric:
+            raise Exception("geometric raybundles cannot be traced through "
+                            "anisotropic material " + self.name)
+
+    def calcSplitEnergyFractions(self, e1, normal, branches):
+        """
+        Estimates the share of the energy flux through the surface which
+        is carried by every outgoing eigenstate. The incoming field is
+        projected onto the normalized E-field of each eigenstate; Fresnel
+        coefficients are not taken into account.
+
+        :param e1 (3xN numpy array of complex) incoming E-field
+        :param normal (3xN numpy array of float)
+        :param branches (list of tuples (k2, e2) of 3xN numpy arrays of
+               complex) outgoing k_norm and E-field of the eigenstates
+
+        :return fractions (list of 1d numpy arrays of float)
+        """
+        fluxes = []
+        for (k2, e2) in branches:
+            norm_e2 = np.sqrt(np.real(np.einsum("i...,i...",
+                                                np.conj(e2), e2)))
+            e2_unit = e2 / norm_e2
+            amplitude = np.einsum("i...,i...", np.conj(e2_unit), e1)
+            s2 = self.calcPoytingVectorNorm(k2, amplitude*e2_unit)
+            fluxes.append(np.abs(np.sum(s2*normal, axis=0)))
+
+        totalflux = sum(fluxes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return [flux / totalflux for flux in fluxes]
+
+    def splitRayBundle(self, raybundle, actualSurface, normal, branches,
+                       splitup=False):
+        """
+        Constructs the outgoing raybundles of both eigenstates without
+        the rays below pruning_threshold of the energy.
+
+        :param raybundle (RayBundle object) incoming rays
+        :param actualSurface (Surface object)
+        :param normal (3xN numpy array of float) normal in local coords
+        :param branches (list of 2 tuples (k2, e2)) outgoing eigenstates
+               in local coordinates
+        :param splitup (bool)
+
+        :return tuple of RayBundle objects
+        """
+        e1 = self.lc.returnGlobalToLocalDirections(raybundle.Efield[-1])
+        num_rays = len(raybundle.rayID)
+
+        fractions = self.calcSplitEnergyFractions(e1, normal, branches)
+        # rays with undefined fractions are kept
+        keeps = [(fraction < self.pruning_threshold) ^ True
+                 for fraction in fractions]
+
+        pruned = [num_rays - np.sum(keep) for keep in keeps]
+        raybundle.pruning_statistics[actualSurface.name] = {
+            "rays": num_rays, "pruned": pruned}
+        if sum(pruned) > 0:
+            self.debug("pruning: %s of %d rays below energy threshold %g"
+                       % (str(pruned), num_rays, self.pruning_threshold))
+
+        if not splitup:
+            keep = np.hstack(keeps)
+            indices = np.tile(np.arange(num_rays), len(branches))[keep]
+
+            k2 = np.hstack([k2 for (k2, _) in branches])[:, keep]
+            e2 = np.hstack([e2 for (_, e2) in branches])[:, keep]
+
+            newids = raybundle.rayID[indices]
+            newwave = raybundle.returnWaveOfRays(indices)
+
+            orig = raybundle.x[-1][:, indices]
+            newk = self.lc.returnLocalToGlobalDirections(k2)
+            newe = self.lc.returnLocalToGlobalDirections(e2)
+
+            return (RayBundle(orig, newk, newe, newids, newwave,
+                              splitted=True),)
+        else:
+            # at least one (possibly empty) branch continues the ray path
+            selected = [i for (i, keep) in enumerate(keeps)
+                        if np.any(keep)] or [0]
+            newbundles = []
+            for i in selected:
+                ((k2, e2), keep) = (branches[i], keeps[i])
+                newk = self.lc.returnLocalToGlobalDirections(k2[:, keep])
+                newe = self.lc.returnLocalToGlobalDirections(e2[:, keep])
+                newbundles.append(
+                    RayBundle(raybundle.x[-1][:, keep], newk, newe,
+                              raybundle.rayID[keep],
+                              raybundle.returnWaveOfRays(keep)))
+            return tuple(newbundles)
+
     def refract(self, raybundle, actualSurface, splitup=False):
 
+        self.checkPolarizedBundle(raybundle)
+
         k1 = self.lc.returnGlobalToLocalDirections(raybundle.k[-1])
-        normal = raybundle.getLocalSurfaceNormal(actualSurface, self, raybundle.x[-1])
-        xlocal = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
+        normal = raybundle.getLocalSurfaceNormal(actualSurface, self)
+        xlocal = raybundle.returnLocalPoints(self.lc)
 
         valid_x = checkfinite(xlocal)
         valid_normals = checkfinite(normal)
@@ -76,38 +185,20 @@ class AnisotropicMaterial(MaxwellMaterial):
 
         (k2_sorted, e2_sorted) = self.sortKnormEField(xlocal, normal, k_inplane, normal, wave=raybundle.wave)
 
-        if not splitup:
         # 2 vectors with largest scalarproduct of S with n
-            k2 = np.hstack((k2_sorted[2], k2_sorted[3]))
-    
-            e2 = np.hstack((e2_sorted[2], e2_sorted[3]))
-    
-            newids = np.hstack((raybundle.rayID, raybundle.rayID))
-    
-            orig = np.hstack((raybundle.x[-1], raybundle.x[-1]))        
-            newk = self.lc.returnLocalToGlobalDirections(k2)
-            newe = self.lc.returnLocalToGlobalDirections(e2)
-    
-            return (RayBundle(orig, newk, newe, newids, raybundle.wave, splitted=True),)
-        else:
-            k2_1 = self.lc.returnLocalToGlobalDirections(k2_sorted[2])
-            k2_2 = self.lc.returnLocalToGlobalDirections(k2_sorted[3])
-
-            e2_1 = self.lc.returnLocalToGlobalDirections(e2_sorted[2])
-            e2_2 = self.lc.returnLocalToGlobalDirections(e2_sorted[3])
-
-            orig = raybundle.x[-1]
+        branches = [(k2_sorted[2], e2_sorted[2]),
+                    (k2_sorted[3], e2_sorted[3])]
 
-            return (
-                RayBundle(orig, k2_1, e2_1, raybundle.rayID, raybundle.wave),
-                RayBundle(orig, k2_2, e2_2, raybundle.rayID, raybundle.wave)
-                )
+        return self.splitRayBundle(raybundle, actualSurface, normal,
+                                   branches, splitup=splitup)
 
     def reflect(self, raybundle, actualSurface, splitup=False):
 
+        self.checkPolarizedBundle(raybundle)
+
         k1 = self.lc.returnGlobalToLocalDirections(raybundle.k[-1])        
-        normal = raybundle.getLocalSurfaceNormal(actualSurface, self, raybundle.x[-1])
-        xlocal = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
+        normal = raybundle.getLocalSurfaceNormal(actualSurface, self)
+        xlocal = raybundle.returnLocalPoints(self.lc)
 
         valid_x = checkfinite(xlocal)
         valid_normals = checkfinite(normal)
@@ -125,28 +216,8 @@ class AnisotropicMaterial(MaxwellMaterial):
         # TODO: negative sign due to compatibility with z-direction of
         # coordinate decenter
 
-        if not splitup:
-            k2 = -np.hstack((k2_sorted[0], k2_sorted[1]))
-            e2 = -np.hstack((e2_sorted[0], e2_sorted[1]))
-            newids = np.hstack((raybundle.rayID, raybundle.rayID))
-    
-            orig = np.hstack((raybundle.x[-1], raybundle.x[-1]))        
-            newk = self.lc.returnLocalToGlobalDirections(k2)
-            newe = self.lc.returnLocalToGlobalDirections(e2)
-
-
-            return (RayBundle(orig, newk, newe, newids, raybundle.wave, splitted=True),)
-        else:
-            k2_1 = self.lc.returnLocalToGlobalDirections(-k2_sorted[0])
-            k2_2 = self.lc.returnLocalToGlobalDirections(-k2_sorted[1])
-
-            e2_1 = self.lc.returnLocalToGlobalDirections(-e2_sorted[0])
-            e2_2 = self.lc.returnLocalToGlobalDirections(-e2_sorted[1])
-
-            orig = raybundle.x[-1]
-
-            return (
-                RayBundle(orig, k2_1, e2_1, raybundle.rayID, raybundle.wave),
-                RayBundle(orig, k2_2, e2_2, raybundle.rayID, raybundle.wave)
-                )
+        branches = [(-k2_sorted[0], -e2_sorted[0]),
+                    (-k2_sorted[1], -e2_sorted[1])]
 
+        return self.splitRayBundle(raybundle, actualSurface, normal,
+                                   branches, splitup=splitup)
@@ -24,16 +24,35 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import os
+import copy
+import pickle
+from collections import OrderedDict
+
 import yaml
 import numpy as np
 import scipy.interpolate
 from .material_isotropic import IsotropicMaterial
+from scipy.spatial import cKDTree
 from ..raytracer.globalconstants import Fline, dline, Cline
 from ..core.log import BaseLogger
 
 
 # FIXME: this class has too many methods
 class refractiveindex_dot_info_glasscatalog(BaseLogger):
+
+    # Parsed library files and page files shared by all catalogue
+    # objects, keyed on file name; values carry the file mtime.
+    # Least recently used entries are dropped first.
+    library_cache = OrderedDict()
+    page_cache = OrderedDict()
+    dispersion_cache = OrderedDict()
+    library_cache_size = 4
+    page_cache_size = 1024
+
+    # bump if the content of the index files changes
+    index_version = 2
+
     def __init__(self, database_basepath, **kwargs):
         """
         Reads the refractiveindex.info database and provides glass data.
@@ -53,13 +72,19 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
 
         Example:
         gcat = refractiveindex_dot_info_glasscatalog("/home/user/refractiveindex.info-database/database")
+
+        Parsing library.yml is slow, therefore the parsed library and a
+        long name lookup table are stored in library_index.pickle next
+        to it. The index is rebuilt when library.yml is newer than the
+        index. Pages are parsed when they are first requested.
         """
 
         super(refractiveindex_dot_info_glasscatalog, self).__init__(**kwargs)
 
         self.database_basepath = database_basepath
-        self.librarydict = self.read_library(database_basepath +
-                                             "/library.yml")
+        (self.librarydict, self.longnames) =\
+            self.read_library_index(database_basepath + "/library.yml")
+        self.dispersion_trees = (None, {})
 
     def read_yml_file(self, ymlfilename):
         """
@@ -119,6 +144,147 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                             "PAGE")
         return lib
 
+    def collect_long_names(self, librarydict):
+        """
+        Builds lookup table from glass long names to (shelf, book, page).
+
+        :param librarydict: (dict) as from read_library
+
+        :return dic: (dict)
+        """
+        dic = {}
+        for (shelf, shelfdict) in librarydict.items():
+            for (book, bookdict) in shelfdict["content"].items():
+                for (page, pagedict) in bookdict["content"].items():
+                    # todo: if 2 pages have the same longName,
+                    # now only one will be put in dic
+                    dic[pagedict["name"]] = (shelf, book, page)
+        return dic
+
+    def read_library_index(self, library_yml_filename):
+        """
+        Returns parsed library and long name lookup table. They are taken
+        from memory or from the index file if these are not older than
+        the library file, otherwise the library file is parsed and the
+        index file is (re)written.
+
+        :param library_yml_filename: (str)
+
+        :return (librarydict, longnames): (tuple of dict)
+        """
+        try:
+            mtime = os.path.getmtime(library_yml_filename)
+        except OSError:
+            self.info("Glass catalogue file IO error: %s" %
+                      (library_yml_filename,))
+            return ({}, {})
+
+        cache = refractiveindex_dot_info_glasscatalog.library_cache
+        entry = self.lookup_cache(cache, library_yml_filename)
+        if entry is not None:
+            (cached_mtime, librarydict, longnames) = entry
+            if cached_mtime == mtime:
+                return (librarydict, longnames)
+
+        index_filename = os.path.join(os.path.dirname(library_yml_filename),
+                                      "library_index.pickle")
+        index = self.load_index(index_filename, mtime)
+        if index is None:
+            librarydict = self.read_library(library_yml_filename)
+            longnames = self.collect_long_names(librarydict)
+            self.save_index(index_filename, mtime,
+                            {"librarydict": librarydict,
+                             "longnames": longnames})
+        else:
+            (librarydict, longnames) = (index["librarydict"],
+                                        index["longnames"])
+
+        self.store_in_cache(
+            cache, library_yml_filename, (mtime, librarydict, longnames),
+            refractiveindex_dot_info_glasscatalog.library_cache_size)
+        return (librarydict, longnames)
+
+    def lookup_cache(self, cache, key):
+        """
+        Returns an entry of one of the LRU caches and marks it as
+        recently used.
+
+        :param cache: (OrderedDict)
+        :param key: (str)
+
+        :return entry: (tuple) or None if key is not cached
+        """
+        entry = cache.pop(key, None)
+        if entry is not None:
+            cache[key] = entry
+        return entry
+
+    def store_in_cache(self, cache, key, entry, size):
+        """
+        Stores an entry in one of the LRU caches and drops the least
+        recently used entries beyond size.
+
+        :param cache: (OrderedDict)
+        :param key: (str)
+        :param entry: (tuple)
+        :param size: (int)
+        """
+        cache.pop(key, None)
+        cache[key] = entry
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def load_index(self, index_filename, mtime):
+        """
+        Loads index file.
+
+        :param index_filename: (str)
+        :param mtime: (float) modification time of the library file
+
+        :return content: (dict) or None if the index file does
+                not exist, is not readable or outdated
+        """
+        try:
+            with open(index_filename, "rb") as f:
+                index = pickle.load(f)
+        except Exception:
+            return None
+
+        if not isinstance(index, dict) or\
+                index.get("version") !=\
+                refractiveindex_dot_info_glasscatalog.index_version or\
+                index.get("mtime") != mtime:
+            self.info("Glass catalogue index outdated: %s" %
+                      (index_filename,))
+            return None
+
+        return index["content"]
+
+    def save_index(self, index_filename, mtime, content):
+        """
+        Writes index file. Failures (e.g. read-only database) are logged
+        only, since the index is just a speedup.
+
+        :param index_filename: (str)
+        :param mtime: (float) modification time of the library file
+        :param content: (dict)
+        """
+        index = {"version": refractiveindex_dot_info_glasscatalog.index_version,
+                 "mtime": mtime,
+                 "content": content}
+        tmp_filename = index_filename + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tmp_filename, "wb") as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(index_filename):
+                os.remove(index_filename)
+            os.rename(tmp_filename, index_filename)
+        except (IOError, OSError):
+            self.info("Glass catalogue index not writable: %s" %
+                      (index_filename,))
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
     def getMaterialDict(self, shelf, book, page):
         """
         Reads and returns a page of the refractiveindex.info database.
@@ -129,6 +295,23 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
 
         :return ymldict: (dict)
         """
+        # copy, such that the cached data cannot be changed by the caller
+        return copy.deepcopy(self.getPageData(shelf, book, page)[0])
+
+    def getPageData(self, shelf, book, page):
+        """
+        Reads a page of the refractiveindex.info database and parses its
+        dispersion data. Both are shared with the page cache and must
+        not be changed.
+
+        :param shelf: (str)
+        :param book:  (str)
+        :param page:  (str)
+
+        :return (ymldict, dispersion_data): (dict, list of tuple or None)
+                dispersion_data as from CatalogMaterial.readDispersionData;
+                None if the page cannot be parsed
+        """
         ymlfilename = self.database_basepath + "/data/"
 
         self.logger.info("Material dict: %s" % (str(
@@ -138,8 +321,28 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                                        [page]["data"]
         self.logger.info("Material file: %s" % (ymlfilename,))
 
-        data = self.read_yml_file(ymlfilename)
-        return data
+        try:
+            mtime = os.path.getmtime(ymlfilename)
+        except OSError:
+            mtime = None
+
+        cache = refractiveindex_dot_info_glasscatalog.page_cache
+        entry = None
+        if mtime is not None:
+            entry = self.lookup_cache(cache, ymlfilename)
+        if entry is None or entry[0] != mtime:
+            data = self.read_yml_file(ymlfilename)
+            try:
+                dispersion_data = CatalogMaterial.readDispersionData(data)
+            except Exception:
+                dispersion_data = None
+            entry = (mtime, data, dispersion_data)
+            if mtime is not None:
+                self.store_in_cache(
+                    cache, ymlfilename, entry,
+                    refractiveindex_dot_info_glasscatalog.page_cache_size)
+
+        return entry[1:]
 
     # start of higher functionality section
 
@@ -187,16 +390,7 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
                    keys are glass long names
                    values are tuples (shelf, book, page)
         """
-        dic = {}
-        for shelf in self.getShelves():
-            self.debug("shelf=%s" % repr(shelf))
-            for book in self.getBooks(shelf):
-                for page in self.getPages(shelf, book):
-                    longname = self.getPageLongName(shelf, book, page)
-                    # todo: if 2 pages have the same longName,
-                    # now only one will be put in dic
-                    dic[longname] = (shelf, book, page)
-        return dic
+        return dict(self.longnames)
 
     def findPagesWithLongNameContaining(self, searchterm):
         """
@@ -223,13 +417,15 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
         but don't know the shelf, book and page in the
         refractiveindex.info database.
         """
+        shelf, book, page = self.findPageFromLongName(glassName)
+        return self.getMaterialDict(shelf, book, page)
 
-        allpages = self.getDictOfLongNames()
-        self.debug("allpages=%s" % repr(allpages))
-        result = []
-        for longname in allpages:
-            if longname == glassName:
-                result = allpages[longname]
+    def findPageFromLongName(self, glassName):
+        """
+        Returns (shelf, book, page) of a glass name; raises an exception
+        with similar names if there is none.
+        """
+        result = self.longnames.get(glassName, ())
 
         if len(result) == 0:  # no glass found, throwing exception
             errormsg = "glass name " + str(glassName) + " not found."
@@ -239,8 +435,7 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
             else:
                 errormsg += " No glass names containing this string found."
             raise Exception(errormsg)
-        shelf, book, page = result
-        return self.getMaterialDict(shelf, book, page)
+        return result
 
     def createGlassObjectFromLongName(self, lc, glassName):
         """
@@ -252,28 +447,177 @@ class refractiveindex_dot_info_glasscatalog(BaseLogger):
 
         :return matobj: (object)
         """
-        matdict = self.getMaterialDictFromLongName(glassName)
-        matobj = CatalogMaterial(lc, matdict)
+        (matdict, dispersion_data) =\
+            self.getPageData(*self.findPageFromLongName(glassName))
+        matobj = CatalogMaterial(lc, matdict, dispersion_data=dispersion_data)
         return matobj
 
+    def getDispersionTable(self):
+        """
+        Returns nd, vd and PgF of all glasses of the catalogue. Since all
+        pages have to be parsed, the table is stored in
+        library_dispersion.pickle next to library.yml and rebuilt
+        together with the library index.
+        Pages whose dispersion data do not cover g to C line are left out.
+
+        :return table: (dict)
+                "longnames": (list of str)
+                "nd", "vd", "PgF": (1d numpy arrays of float)
+        """
+        library_yml_filename = self.database_basepath + "/library.yml"
+        try:
+            mtime = os.path.getmtime(library_yml_filename)
+        except OSError:
+            mtime = None
+
+        cache = refractiveindex_dot_info_glasscatalog.dispersion_cache
+        entry = self.lookup_cache(cache, library_yml_filename)
+        if mtime is not None and entry is not None:
+            (cached_mtime, table) = entry
+            if cached_mtime == mtime:
+                return table
+
+        index_filename = os.path.join(self.database_basepath,
+                                      "library_dispersion.pickle")
+        table = None
+        if mtime is not None:
+            table = self.load_index(index_filename, mtime)
+        if table is None:
+            # the pages of a changed library.yml have to be evaluated
+            (self.librarydict, self.longnames) =\
+                self.read_library_index(library_yml_filename)
+            table = self.calculate_dispersion_table()
+            if mtime is not None:
+                self.save_index(index_filename, mtime, table)
+        if mtime is not None:
+            self.store_in_cache(
+                cache, library_yml_filename, (mtime, table),
+                refractiveindex_dot_info_glasscatalog.library_cache_size)
+
+        return table
+
+    def calculate_dispersion_table(self):
+        """
+        Evaluates nd, vd and PgF for all pages of the catalogue.
+        """
+        # g, F, d, C lines with the precision used by the glass
+        # manufacturers for nd, vd, PgF (the rounded values in
+        # globalconstants would shift vd by about 0.03)
+        lines = np.array([435.8343e-6, 486.1327e-6, 587.5618e-6, 656.2725e-6])
+        longnames = []
+        indices = []
+        for longname in sorted(self.longnames):
+            (shelf, book, page) = self.longnames[longname]
+            try:
+                (matdict, dispersion_data) =\
+                    self.getPageData(shelf, book, page)
+                material = CatalogMaterial(None, matdict,
+                                           dispersion_data=dispersion_data,
+                                           name="dispersion_table")
+                n = np.real(material.getIndex(None, lines))
+            except Exception:
+                self.debug("no dispersion data for %s" % (longname,))
+                continue
+            longnames.append(longname)
+            indices.append(n)
+
+        (ng, nF, nd, nC) = np.reshape(np.array(indices, dtype=float),
+                                      (len(longnames), 4)).T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vd = (nd - 1.)/(nF - nC)
+            PgF = (ng - nF)/(nF - nC)
+
+        return {"longnames": longnames, "nd": nd, "vd": vd, "PgF": PgF}
+
+    def findGlassesCloseTo(self, nd, vd, PgF=None, num=1,
+                           scales=(1e-3, 0.1, 1e-3)):
+        """
+        Nearest neighbour search in the (nd, vd) or (nd, vd, PgF) plane of
+        all catalogue glasses. The differences are divided by scales
+        before the Euclidean distance is taken; the default scales are
+        the resolution of the six digit glass code for nd and vd.
+        Queries for many target glasses at once should pass arrays.
+
+        :param nd: (float or numpy array of float)
+        :param vd: (float or numpy array of float)
+        :param PgF: (None, float or numpy array of float)
+        :param num: (int) number of glasses per query; at most the
+                    number of glasses in the catalogue are returned
+        :param scales: (tuple of float) for nd, vd, PgF
+
+        :return (longnames, distances): (numpy array of str with shape of
+                nd (and trailing axis of length min(num, number of
+                glasses) if num > 1), numpy array of float of the same
+                shape)
+        """
+        keys = ("nd", "vd") if PgF is None else ("nd", "vd", "PgF")
+        scales = np.asarray(scales[:len(keys)], dtype=float)
+
+        # the trees belong to one dispersion table and are dropped
+        # as soon as the table is rebuilt (i.e. library.yml changed)
+        table = self.getDispersionTable()
+        if self.dispersion_trees[0] is not table:
+            self.dispersion_trees = (table, {})
+        trees = self.dispersion_trees[1]
+
+        treekey = (keys, tuple(scales))
+        if treekey not in trees:
+            points = np.array([table[key] for key in keys]).T
+            valid = np.all(np.isfinite(points), axis=1)
+            trees[treekey] = (
+                cKDTree(points[valid]/scales),
+                np.array(table["longnames"], dtype=object)[valid])
+        (tree, longnames) = trees[treekey]
+
+        if len(longnames) == 0:
+            raise Exception("no glasses with dispersion data in catalogue")
+
+        targets = np.broadcast_arrays(*[np.asarray(value, dtype=float)
+                                        for value in (nd, vd, PgF)[:len(keys)]])
+        points = np.stack(targets, axis=-1)/scales
+        # for k > number of glasses, the tree would return the
+        # out of range index len(longnames) with infinite distance
+        k = min(num, len(longnames))
+        (distances, indices) = tree.query(
+            points, k=k if num == 1 else list(range(1, k + 1)))
+
+        return (longnames[indices], distances)
+
     def getMaterialDictCloseTo_nd_vd_PgF(self, nd=1.51680,
                                          vd=64.17, PgF=0.5349):
         """
         Search a material close to given parameters.
         """
-        raise NotImplementedError()
+        (longname, _) = self.findGlassesCloseTo(nd, vd, PgF)
+        return self.getMaterialDictFromLongName(longname)
 
     def getMaterialDictCloseTo_nd_vd(self, nd=1.51680, vd=64.17):
         """
         Search a material close to given parameters.
         """
-        raise NotImplementedError()
+        (longname, _) = self.findGlassesCloseTo(nd, vd)
+        return self.getMaterialDictFromLongName(longname)
 
     def getMaterialDictFromSchottCode(self, schottCode=517642):
         """
         Identify and return a material from a given material code.
+        The code consists of the first three decimals of nd - 1 and
+        ten times vd, i.e. 517642 for nd = 1.5168, vd = 64.17.
         """
-        raise NotImplementedError()
+        table = self.getDispersionTable()
+        with np.errstate(invalid="ignore"):
+            codes = np.round((table["nd"] - 1.)*1000.)*1000 +\
+                np.round(table["vd"]*10.)
+        matches = np.flatnonzero(codes == schottCode)
+
+        if len(matches) == 0:
+            raise Exception("no glass with code " + str(schottCode) +
+                            " found.")
+        longnames = [table["longnames"][ind] for ind in matches]
+        if len(longnames) > 1:
+            self.info("glasses with code %d: %s, taking first one" %
+                      (schottCode, str(longnames)))
+        return self.getMaterialDictFromLongName(longnames[0])
 
 
 class IndexFormulaContainer(object):
@@ -298,61 +642,76 @@ class IndexFormulaContainer(object):
     def setDispFunction(self, typ, coeff):
         self.coeff = coeff
 
+        # The sums over the coefficients run over the last axis,
+        # such that w_um may be a scalar or an array of wavelengths.
+
         def Sellmeier(w_um):
+            w = w_um[..., np.newaxis]
             B = self.coeff[1::2]
             C = self.coeff[2::2]
-            nsquared = 1 + self.coeff[0] + sum(B * w_um**2 / (w_um**2 - C**2))
+            nsquared = 1 + self.coeff[0] + np.sum(B * w**2 / (w**2 - C**2),
+                                                  axis=-1)
             return np.sqrt(nsquared)
 
         def Sellmeier2(w_um):
+            w = w_um[..., np.newaxis]
             B = self.coeff[1::2]
             C = self.coeff[2::2]
-            nsquared = 1 + self.coeff[0] + sum(B * w_um**2 / (w_um**2 - C))
+            nsquared = 1 + self.coeff[0] + np.sum(B * w**2 / (w**2 - C),
+                                                  axis=-1)
             return np.sqrt(nsquared)
 
         def Polynomial(w_um):
+            w = w_um[..., np.newaxis]
             A = self.coeff[1::2]
             P = self.coeff[2::2]
-            nsquared = self.coeff[0] + sum(A * (w_um**P))
+            nsquared = self.coeff[0] + np.sum(A * (w**P), axis=-1)
             return np.sqrt(nsquared)
 
         def refractiveindex_dot_info_formula_with_9_or_less_coefficients(w_um):
+            w = w_um[..., np.newaxis]
             A = self.coeff[1::4]
             B = self.coeff[2::4]
             C = self.coeff[3::4]
             D = self.coeff[4::4]
-            nsquared = self.coeff[0] + sum(A * (w_um**B) / (w_um**2 - C**D))
+            nsquared = self.coeff[0] + np.sum(A * (w**B) / (w**2 - C**D),
+                                              axis=-1)
             return np.sqrt(nsquared)
 
         def refractiveindex_dot_info_formula_with_11_or_more_coefficients(w_um):
+            w = w_um[..., np.newaxis]
             A = self.coeff[[1, 5]]
             B = self.coeff[[2, 6]]
             C = self.coeff[[3, 7]]
             D = self.coeff[[4, 8]]
             E = self.coeff[9::2]
             F = self.coeff[10::2]
-            nsquared = self.coeff[0] + sum(A * (w_um**B) / (w_um**2 - C**D))\
-                + sum(E * (w_um**F))
+            nsquared = self.coeff[0] +\
+                np.sum(A * (w**B) / (w**2 - C**D), axis=-1) +\
+                np.sum(E * (w**F), axis=-1)
             return np.sqrt(nsquared)
 
         def Cauchy(w_um):
+            w = w_um[..., np.newaxis]
             A = self.coeff[1::2]
             P = self.coeff[2::2]
-            n = self.coeff[0] + sum(A * (w_um**P))
+            n = self.coeff[0] + np.sum(A * (w**P), axis=-1)
             return n
 
         def Gases(w_um):
+            w = w_um[..., np.newaxis]
             B = self.coeff[1::2]
             C = self.coeff[2::2]
-            n = 1 + self.coeff[0] + sum(B / (C - w_um**(-2)))
+            n = 1 + self.coeff[0] + np.sum(B / (C - w**(-2)), axis=-1)
             return n
 
         def Herzberger(w_um):
             denom = w_um**2 - 0.028
+            w = w_um[..., np.newaxis]
             A = self.coeff[3:]
             P = 2 * np.arange(len(A)) + 2
             n = self.coeff[0] + self.coeff[1] / denom +\
-                self.coeff[2] / denom**2 + sum(A * w_um**P)
+                self.coeff[2] / denom**2 + np.sum(A * w**P, axis=-1)
             return n
 
         def Retro(w_um):
@@ -397,12 +756,12 @@ class IndexFormulaContainer(object):
 
     def getIndex(self, wavelength):
         """
-        :param wavelength: (float)
+        :param wavelength: (float or numpy array of float)
                wavelength in mm
-        :return n: (float)
+        :return n: (float or numpy array of float)
                refractive index real part
         """
-        wave_um = 1000 * wavelength  # wavelength in um
+        wave_um = 1000 * np.asarray(wavelength, dtype=float)  # wavelength in um
         # The refractiveindex.info database uses units of um
         # for its dispersion formulas.
         # It would be a huge effort to rewrite the whole database,
@@ -410,7 +769,8 @@ class IndexFormulaContainer(object):
         # the pyrate wavelength in mm to fit the dispersion formulas.
 
         # TODO: this is an if statement in a time-critical place
-        if wave_um < self.waverange[0] or wave_um > self.waverange[1]:
+        if np.any(wave_um < self.waverange[0]) or\
+                np.any(wave_um > self.waverange[1]):
             raise Exception("wavelength out of range")
 
         n = self.__dispFunction(wave_um)
@@ -418,12 +778,22 @@ class IndexFormulaContainer(object):
 
 
 class CatalogMaterial(IsotropicMaterial):
-    def __init__(self, lc, ymldict, **kwargs):
+
+    fused_conic_refraction = True
+
+    def __init__(self, lc, ymldict, index_cache_size=64,
+                 dispersion_data=None, **kwargs):
         """
         Material from the refractiveindex.info database.
 
         :param ymldict: (dict)
                 dictionary from a refractiveindex.info page yml file.
+        :param index_cache_size: (int)
+                number of wavelengths for which the index is kept
+                (least recently used ones are dropped first)
+        :param dispersion_data: (list of tuple or None)
+                DATA of ymldict as parsed by readDispersionData;
+                parsed here if None
         :param name: (str)
         :param comment: (str)
 
@@ -439,13 +809,35 @@ class CatalogMaterial(IsotropicMaterial):
                                               kind="material_from_catalog",
                                               **kwargs)
 
+        self.annotations["DATA"] = ymldict["DATA"]
+
+        if dispersion_data is None:
+            dispersion_data = CatalogMaterial.readDispersionData(ymldict)
+
+        self.__nk = [IndexFormulaContainer(typ, coeff, rang)
+                     for (typ, coeff, rang) in dispersion_data]
+
+        self.index_cache_size = index_cache_size
+        self.__index_cache = OrderedDict()
+
+    @staticmethod
+    def readDispersionData(ymldict):
+        """
+        Parses the dispersion formulas or tables of a refractiveindex.info
+        page.
+
+        :param ymldict: (dict)
+                dictionary from a refractiveindex.info page yml file.
+
+        :return dispersion_data: (list of tuple)
+                (type, coefficients, wavelength range) for n and k
+        """
         data = ymldict["DATA"]
-        self.annotations["DATA"] = data
 
         if len(data) > 2:
             raise Exception("Max 2 entries for dispersion allowed - n and k.")
 
-        self.__nk = []
+        dispersion_data = []
         for datafield in data:  # i=0 is n  ;  i=1 is k
             dispersionDict = datafield
             typ = dispersionDict["type"]
@@ -459,13 +851,61 @@ class CatalogMaterial(IsotropicMaterial):
                                  dtype=float)
                 rang = np.array(dispersionDict["wavelength_range"].split(),
                                 dtype=float)
-            self.__nk.append(IndexFormulaContainer(typ, coeff, rang))
+            dispersion_data.append((typ, coeff, rang))
+        return dispersion_data
 
     def getIndex(self, x, wave):
-        n = 0
-        for dispFun in self.__nk:
-            n += dispFun.getIndex(wave)
-        return n
+        """
+        Refractive index from the dispersion formulas. Since the
+        wavelengths of a trace are the same for all surfaces and all
+        optimization steps, the index is cached per wavelength.
+
+        :param x: position (not used)
+        :param wave: wavelength in mm (float or numpy array of float)
+
+        :return n: (float or numpy array of float)
+        """
+        if np.ndim(wave) == 0:
+            n = self.__index_cache.pop(wave, None)
+            if n is None:
+                return self.getIndicesCached(np.array([wave]))[0]
+            self.__index_cache[wave] = n  # mark as recently used
+            return n
+
+        (unique_waves, inverse) = np.unique(wave, return_inverse=True)
+        return self.getIndicesCached(unique_waves)[inverse].reshape(
+            np.shape(wave))
+
+    def getIndicesCached(self, waves):
+        """
+        Looks up indices for an array of wavelengths in the cache.
+        Missing wavelengths are evaluated (and range checked) at once
+        and added to the cache.
+
+        :param waves: (1d numpy array of float)
+
+        :return n: (1d numpy array of float or complex)
+        """
+        cache = self.__index_cache
+        missing = [wave for wave in waves.tolist() if wave not in cache]
+
+        if missing:
+            n_missing = 0
+            for dispFun in self.__nk:
+                n_missing = n_missing + dispFun.getIndex(np.array(missing))
+            for (wave, n) in zip(missing, n_missing):
+                cache[wave] = n
+
+        result = []
+        for wave in waves.tolist():
+            n = cache.pop(wave)
+            cache[wave] = n  # mark as recently used
+            result.append(n)
+
+        while len(cache) > max(self.index_cache_size, len(waves)):
+            cache.popitem(last=False)
+
+        return np.array(result)
 
 
 if __name__ == "__main__":
@@ -33,14 +33,43 @@ from ..core.base import OptimizableVariable
 from .material_isotropic import IsotropicMaterial
 
 class IsotropicGrinMaterial(IsotropicMaterial):
-    def __init__(self, lc, fun, dfdx, dfdy, dfdz, parameterlist=[], name="", comment=""):
+
+    # coefficients of the 4th order symplectic integrator (Yoshida)
+    yoshida_c = [1.0/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),1.0/(2.0*(2.0 - 2.0**(1./3.)))]
+    yoshida_d = [1.0/(2.0 - 2.0**(1./3.)),(-2.0**(1./3.))/((2.0 - 2.0**(1./3.))),1.0/(2.0 - 2.0**(1./3.)),0.0]
+
+    def __init__(self, lc, fun, dfdx, dfdy, dfdz, parameterlist=[], name="", comment="",
+                 nandgradfunc=None):
+        """
+        :param lc (LocalCoordinates object)
+        :param fun, dfdx, dfdy, dfdz (functions of x (3xN numpy array)
+               and parameters) refractive index and its derivatives
+        :param parameterlist (list of (name, value) tuples)
+        :param nandgradfunc (function or None) returns refractive index
+               and gradient (3xN numpy array) at once; if given, it is
+               used for the integration instead of the single functions
+        """
         super(IsotropicGrinMaterial, self).__init__(lc, name=name, comment=comment)
         self.nfunc = fun
         self.dndx = dfdx
         self.dndy = dfdy
         self.dndz = dfdz
+        self.nandgradfunc = nandgradfunc
         self.ds = 0.1
         self.energyviolation = 1e-3
+        # store every history_decimation'th integration step in the
+        # raybundle (0: final positions only)
+        self.history_decimation = 1
+        # adaptive step size control (ds is the initial step size)
+        # with local error tolerance steptolerance and maximal step
+        # size maxds (None: unlimited)
+        self.adaptive = False
+        self.steptolerance = 1e-8
+        self.maxds = None
+        # last step ends on the next surface (up to surfacetolerance)
+        self.solvefinalstep = True
+        self.surfacetolerance = 1e-12
+        self.finalstepiterations = 30
         self.boundaryfunction = lambda x: x[0]**2 + x[1]**2 <= 10.0**2
 
         self.params = {}
@@ -66,104 +95,271 @@ class IsotropicGrinMaterial(IsotropicMaterial):
         return self.boundaryfunction(x)
 
 
+    def returnIndexAndGradient(self, x):
+        """
+        Evaluates refractive index and its gradient in one call.
+        Uses nandgradfunc if given, otherwise fun, dfdx, dfdy, dfdz.
+
+        :param x (3xN numpy array of float) local positions
+
+        :return (n, gradn) tuple of (1d numpy array of float,
+                3xN numpy array of float)
+        """
+        if self.nandgradfunc is not None:
+            return self.nandgradfunc(x, **self.params)
+        return (self.nfunc(x, **self.params),
+                np.array([self.dndx(x, **self.params),
+                          self.dndy(x, **self.params),
+                          self.dndz(x, **self.params)]))
+
+    def appendHistory(self, raybundle, pos, vel, index, valid):
+        newk = vel/index
+        Eapp = self.calcEfieldOfBundle(raybundle, pos, None, newk)
+        if Eapp is not None:
+            Eapp = self.lc.returnLocalToGlobalDirections(Eapp)
+        raybundle.append(self.lc.returnLocalToGlobalPoints(pos),
+                         self.lc.returnLocalToGlobalDirections(newk),
+                         Eapp, valid)
+
+    def yoshidaStep(self, pos, vel, tau):
+        """
+        One step of the 4th order symplectic (Yoshida) integrator.
+
+        :param pos (3xN numpy array of float) local positions
+        :param vel (3xN numpy array of float) velocities (n times direction)
+        :param tau (float or 1d numpy array of float) step size (per ray)
+
+        :return (pos, vel, n) tuple of new positions, velocities and
+                refractive indices at the new positions
+        """
+        for (ci, di) in zip(self.yoshida_c, self.yoshida_d):
+            pos = pos + tau*ci*2.0*vel
+            (optin, gradn) = self.returnIndexAndGradient(pos)
+            if di != 0.0:
+                vel = vel + tau*di*2.0*optin*gradn
+        return (pos, vel, optin)
+
+    def adaptiveStep(self, pos, vel, index, tau):
+        """
+        Step doubling: compares one step of size tau with two steps of
+        size tau/2. Rays with an estimated local error (of positions and
+        velocities) below steptolerance accept the two half steps,
+        the other rays keep their state. For all rays the step size is
+        adapted to the error estimate.
+
+        :param pos, vel (3xN numpy arrays of float)
+        :param index (1d numpy array of float) refractive index at pos
+        :param tau (1d numpy array of float) step sizes
+
+        :return (pos, vel, n, tau) new state and step sizes
+        """
+        (pos1, vel1, _) = self.yoshidaStep(pos, vel, tau)
+        (poshalf, velhalf, _) = self.yoshidaStep(pos, vel, 0.5*tau)
+        (pos2, vel2, optin2) = self.yoshidaStep(poshalf, velhalf, 0.5*tau)
+
+        # Richardson estimate of the local error of a 4th order method
+        error = np.sqrt(np.sum((pos2 - pos1)**2 + (vel2 - vel1)**2,
+                               axis=0))/15.
+        accepted = error <= self.steptolerance
+
+        with np.errstate(divide="ignore"):
+            factor = 0.9*(self.steptolerance/error)**0.2
+        factor = np.clip(np.nan_to_num(factor), 0.2, 5.0)
+        newtau = tau*factor
+        if self.maxds is not None:
+            newtau = np.minimum(newtau, self.maxds)
+
+        pos = np.where(accepted, pos2, pos)
+        vel = np.where(accepted, vel2, vel)
+        index = np.where(accepted, optin2, index)
+        return (pos, vel, index, newtau)
+
+    def returnSurfaceDistance(self, pos, nextSurface):
+        """
+        Signed distance (in z direction) of local positions from
+        nextSurface, positive behind the surface.
+        """
+        xshape = self.lc.returnActualToOtherPoints(pos, nextSurface.shape.lc)
+        return xshape[2] - nextSurface.shape.getSag(xshape[0], xshape[1])
+
+    def solveFinalStep(self, pos, vel, tau, nextSurface):
+        """
+        Finds for rays crossing nextSurface within the next step the step
+        size s in [0, tau] which ends on the surface (regula falsi,
+        Illinois variant) and performs this step.
+
+        :param pos, vel (3xN numpy arrays of float) state in front of
+               the surface
+        :param tau (1d numpy array of float) step sizes crossing it
+        :param nextSurface (Surface object)
+
+        :return (pos, vel, n) state on the surface
+        """
+        (sa, sb) = (np.zeros_like(tau), 1.*tau)
+        ga = self.returnSurfaceDistance(pos, nextSurface)
+        (newpos, newvel, optin) = self.yoshidaStep(pos, vel, sb)
+        gb = self.returnSurfaceDistance(newpos, nextSurface)
+
+        # side of the last replaced end (1: sb, -1: sa)
+        side = np.zeros(np.shape(tau), dtype=int)
+
+        for _ in range(self.finalstepiterations):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                s = sb - gb*(sb - sa)/(gb - ga)
+            s = np.where(np.isfinite(s), s, 0.5*(sa + sb))
+            (newpos, newvel, optin) = self.yoshidaStep(pos, vel, s)
+            g = self.returnSurfaceDistance(newpos, nextSurface)
+            if np.all(np.abs(g) <= self.surfacetolerance):
+                break
+            behind = g > 0
+            # Illinois: halve the function value at an end which is
+            # retained twice in a row
+            ga = np.where(behind & (side == 1), 0.5*ga, ga)
+            gb = np.where((True ^ behind) & (side == -1), 0.5*gb, gb)
+            (sa, ga) = (np.where(behind, sa, s), np.where(behind, ga, g))
+            (sb, gb) = (np.where(behind, s, sb), np.where(behind, g, gb))
+            side = np.where(behind, 1, -1)
+
+        return (newpos, newvel, optin)
+
     def symplecticintegrator(self, raybundle, nextSurface, tau):
+        """
+        Integrates the rays with the 4th order symplectic (Yoshida)
+        integrator and step size tau until they reach nextSurface.
+        Only rays which are still active are advanced. Rays leaving
+        the boundary or violating the energy conservation
+        |v|^2 - n^2 by more than energyviolation are invalidated.
+
+        If adaptive is True, every ray has its own step size which is
+        controlled by step doubling (see adaptiveStep), starting with
+        tau. If solvefinalstep is True, the last step of each ray ends
+        exactly on nextSurface (see solveFinalStep), otherwise rays
+        are frozen at their last position in front of nextSurface.
+
+        The positions are appended to raybundle every
+        history_decimation steps (0: only the final positions).
+
+        :param raybundle (RayBundle object), gets changed!
+        :param nextSurface (Surface object)
+        :param tau (float) step size
+
+        :return (pos, vel, energies, valid) final positions and
+                velocities in local coordinates, maximal absolute
+                energy violation per ray and validity
+        """
 
         startpoint = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
-        startdirection = self.lc.returnGlobalToLocalDirections(raybundle.returnKtoD()[-1])
-
-        clist = [1.0/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),(1.0-2.0**(1./3.))/(2.0*(2.0 - 2.0**(1./3.))),1.0/(2.0*(2.0 - 2.0**(1./3.)))]
-        dlist = [1.0/(2.0 - 2.0**(1./3.)),(-2.0**(1./3.))/((2.0 - 2.0**(1./3.))),1.0/(2.0 - 2.0**(1./3.)),0.0]
-
-
-        optindstart = self.nfunc(startpoint, **self.params)
-        positions = [1.*startpoint]
-        velocities = [1.*optindstart*startdirection]
-
-        energies = []
-
+        startdirection = self.lc.returnGlobalToLocalDirections(raybundle.returnKtoD(-1))
+
+        # updated* are the positions, velocities and indices of all rays;
+        # the entries of active rays are only written for the history
+        # and when the rays are frozen
+        updatedindex = self.nfunc(startpoint, **self.params)*np.ones_like(startpoint[0])
+        updatedpos = 1.*startpoint
+        updatedvel = updatedindex*startdirection
+
+        num_pts = np.shape(startpoint)[1]
+        valid = np.ones(num_pts, dtype=bool)
+        energies = np.zeros(num_pts)
+
+        # compacted arrays of the active rays
+        active = np.arange(num_pts)
+        pos = updatedpos
+        vel = updatedvel
+        index = updatedindex
+        energy = energies
+        if self.adaptive:
+            tau = tau*np.ones(num_pts)
+
+        decimation = self.history_decimation
         loopcount = 0
+        appended = True
 
-        valid = np.ones_like(startpoint[0], dtype=bool)
-        final = np.zeros_like(startpoint[0], dtype=bool)
-
-        pointstodraw = []
-        momentatodraw = []
-
-        updatedpos = startpoint
-        updatedvel = velocities[-1]
+        while len(active) > 0:
 
-        while not np.all(final): 
-            
             loopcount += 1
-            lastpos = positions[-1]
-            lastvel = velocities[-1]
-
-            for (ci, di) in zip(clist, dlist):
-                newpos = lastpos + tau*ci*2.0*lastvel
-                newvel = lastvel
-
-                optin = self.nfunc(newpos, **self.params)
 
-                newvel = newvel + tau*di*2.0*optin*np.array( \
-                 [self.dndx(newpos, **self.params),
-                  self.dndy(newpos, **self.params),
-                  self.dndz(newpos, **self.params)])
-
-                lastpos = newpos
-                lastvel = newvel
-
-            positions.append(newpos)
-            velocities.append(newvel)
-
-            
-            
+            if self.adaptive:
+                (newpos, newvel, optin, newtau) =\
+                    self.adaptiveStep(pos, vel, index, tau)
+            else:
+                (newpos, newvel, optin) = self.yoshidaStep(pos, vel, tau)
 
             # validity and finalization check
 
-            totalenergy = np.sum(newvel**2) - np.sum(optin**2)
+            totalenergy = np.abs(np.sum(newvel**2, axis=0) - optin**2)
+            energy = np.maximum(energy, totalenergy)
 
-            # testing for some critical energyviolation
-            # and invalidate all rays
+            self.debug("step(" + str(loopcount) + ") -> " +
+                       str(len(active)) + " active rays, energy " +
+                       "conservation violation: " + str(np.max(totalenergy)))
 
-            if abs(totalenergy) > self.energyviolation:
-                self.warning('integration aborted due to energy violation: abs(' + str(totalenergy) + ') > ' + str(self.energyviolation))
-                self.warning('Please reduce integration step size.')
-                valid[:] = False # all rays with energy violation are not useful due to integration errors
+            # rays with critical energy violation are invalid
+            # due to integration errors, as well as rays hitting the
+            # boundary
+            invalid = (totalenergy > self.energyviolation) |\
+                (True ^ self.inBoundary(newpos))
 
-            self.debug("step(" + str(loopcount) + ") -> energy conservation violation: " + str(totalenergy))
-
-            xglobalnewpos = self.lc.returnLocalToGlobalPoints(newpos)                        
-            xshape = nextSurface.shape.lc.returnGlobalToLocalPoints(xglobalnewpos)
-
-            final = (xshape[2] - nextSurface.shape.getSag(xshape[0], xshape[1]) > 0)
+            final = self.returnSurfaceDistance(newpos, nextSurface) > 0
             # has ray reached next surface? if yes: mark as final
-
-            valid[True ^ self.inBoundary(newpos)] = False
-            # has ray hit boundary? mark as invalid
-
-            final[True ^ valid] += True            
             # all non valid rays are also final
-
-            updatedpos[:,True ^ final] = newpos[:,True ^ final]
-            updatedvel[:,True ^ final] = newvel[:,True ^ final]
-
-            k0 = 1. #2.*math.pi/raybundle.wave
-            newk = k0*updatedvel/self.nfunc(updatedpos, **self.params)
-            Eapp = self.lc.returnLocalToGlobalDirections(self.calcEfield(newpos, None, newk, wave=raybundle.wave))
-            kapp = self.lc.returnLocalToGlobalDirections(newk)            
-            xapp = self.lc.returnLocalToGlobalPoints(updatedpos)            
-
-            pointstodraw.append(1.*updatedpos)
-            momentatodraw.append(1.*updatedvel)
-
-            raybundle.append(xapp, kapp, Eapp, valid)
+            final |= invalid
+
+            if np.any(final):
+                # freeze final rays at their last position in front of
+                # the surface (or on the surface) and compact the
+                # active ones
+                frozen = active[final]
+                valid[active[invalid]] = False
+                updatedpos[:, frozen] = pos[:, final]
+                updatedvel[:, frozen] = vel[:, final]
+                updatedindex[frozen] = index[final]
+                energies[frozen] = energy[final]
+
+                crossed = final & (True ^ invalid)
+                if self.solvefinalstep and np.any(crossed):
+                    (surfpos, surfvel, surfindex) = self.solveFinalStep(
+                        pos[:, crossed], vel[:, crossed],
+                        tau[crossed] if self.adaptive
+                        else tau*np.ones(np.sum(crossed)),
+                        nextSurface)
+                    onsurface = active[crossed]
+                    updatedpos[:, onsurface] = surfpos
+                    updatedvel[:, onsurface] = surfvel
+                    updatedindex[onsurface] = surfindex
+
+                notfinal = True ^ final
+                active = active[notfinal]
+                newpos = newpos[:, notfinal]
+                newvel = newvel[:, notfinal]
+                optin = optin[notfinal]
+                energy = energy[notfinal]
+                if self.adaptive:
+                    newtau = newtau[notfinal]
+
+            (pos, vel, index) = (newpos, newvel, optin)
+            if self.adaptive:
+                tau = newtau
+
+            appended = decimation > 0 and loopcount % decimation == 0
+            if appended:
+                updatedpos[:, active] = pos
+                updatedvel[:, active] = vel
+                updatedindex[active] = index
+                self.appendHistory(raybundle, updatedpos, updatedvel,
+                                   updatedindex, valid)
             # TODO: if pathlength of a certain ray is too long, mark as invalid and final
 
-            # for energy and phase space analysis
+        if not appended:
+            self.appendHistory(raybundle, updatedpos, updatedvel,
+                               updatedindex, valid)
 
-            energies.append(totalenergy)
+        num_violations = np.sum(energies > self.energyviolation)
+        if num_violations > 0:
+            self.warning(str(num_violations) + ' rays invalidated due to energy violation > ' + str(self.energyviolation))
+            self.warning('Please reduce integration step size.')
 
-        return (positions, velocities, pointstodraw, momentatodraw, energies, valid)
+        return (updatedpos, updatedvel, energies, valid)
 
 
     def propagate(self, raybundle, nextSurface):
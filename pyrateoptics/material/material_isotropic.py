@@ -30,6 +30,7 @@ from ..core.base import OptimizableVariable
 
 from ..raytracer.ray import RayBundle
 from ..raytracer.helpers_math import checkfinite
+from ..raytracer.surface_shape import conic_intersection
 from ..raytracer.globalconstants import standard_wavelength
 
 from .material import MaxwellMaterial
@@ -57,9 +58,21 @@ class IsotropicMaterial(MaxwellMaterial):
     def calcEfield(self, x, n, k, wave=standard_wavelength):
         # FIXME: Efield calculation wrong! For polarization
         # you have to calc it correctly!
-        ey = np.zeros_like(k)
-        ey[1, :] = 1.
-        return np.cross(k, ey, axisa=0, axisb=0).T
+        # k x ey
+        efield = np.zeros_like(k)
+        efield[0] = -k[2]
+        efield[2] = k[0]
+        return efield
+
+    def calcEfieldOfBundle(self, raybundle, x, n, k):
+        """
+        Electrical field for the new wave vectors k of rays coming from
+        raybundle. Geometric bundles carry no field, therefore None
+        is returned for them and calcEfield is skipped.
+        """
+        if raybundle.geometric:
+            return None
+        return self.calcEfield(x, n, k, wave=raybundle.wave)
 
     def calcXi(self, x, normal, k_inplane, wave=standard_wavelength):
         return self.calcXiIsotropic(x, normal, k_inplane, wave=wave)
@@ -73,6 +86,8 @@ class IsotropicMaterial(MaxwellMaterial):
                 normal of surface in local coordinates
         :param k_inplane (3xN numpy array of float)
                 incoming wave vector inplane component in local coordinates
+        :param wave (float or 1d numpy array of float)
+                wavelength, an array gives the wavelength per ray
 
         :return (xi, valid) tuple of (3x1 numpy array of complex,
                 3x1 numpy array of bool)
@@ -93,9 +108,8 @@ class IsotropicMaterial(MaxwellMaterial):
     def refract(self, raybundle, actualSurface, splitup=False):
 
         k1 = self.lc.returnGlobalToLocalDirections(raybundle.k[-1])
-        normal = raybundle.getLocalSurfaceNormal(actualSurface,
-                                                 self, raybundle.x[-1])
-        xlocal = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
+        normal = raybundle.getLocalSurfaceNormal(actualSurface, self)
+        xlocal = raybundle.returnLocalPoints(self.lc)
 
         valid_normals = checkfinite(normal)
 
@@ -117,17 +131,17 @@ class IsotropicMaterial(MaxwellMaterial):
 
         # FIXME: E field calculation wrong: xlocal, normal, newk in different
         # coordinate systems
-        Efield = self.calcEfield(xlocal, normal, newk, wave=raybundle.wave)
+        Efield = self.calcEfieldOfBundle(raybundle, xlocal, normal, newk)
 
         return (RayBundle(orig, newk, Efield, raybundle.rayID[valid],
-                          raybundle.wave),)
+                          raybundle.returnWaveOfRays(valid),
+                          geometric=raybundle.geometric),)
 
     def reflect(self, raybundle, actualSurface, splitup=False):
 
         k1 = self.lc.returnGlobalToLocalDirections(raybundle.k[-1])
-        normal = raybundle.getLocalSurfaceNormal(actualSurface, self,
-                                                 raybundle.x[-1])
-        xlocal = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
+        normal = raybundle.getLocalSurfaceNormal(actualSurface, self)
+        xlocal = raybundle.returnLocalPoints(self.lc)
 
         valid_normals = checkfinite(normal)
         # normals or sag values could either be nan or infinite
@@ -151,10 +165,72 @@ class IsotropicMaterial(MaxwellMaterial):
         orig = raybundle.x[-1][:, valid]
         newk = self.lc.returnLocalToGlobalDirections(k2[:, valid])
 
-        Efield = self.calcEfield(xlocal, normal, newk, wave=raybundle.wave)
+        Efield = self.calcEfieldOfBundle(raybundle, xlocal, normal, newk)
+
+        return (RayBundle(orig, newk, Efield, raybundle.rayID[valid],
+                          raybundle.returnWaveOfRays(valid),
+                          geometric=raybundle.geometric),)
+
+    def propagateConicAndRefract(self, raybundle, actualSurface):
+        """
+        Fused version of propagate (in an isotropic material with
+        constant index) and refract for surfaces of Conic shape.
+        Intersection, normal and refraction are computed in one pass in
+        the local coordinates of the shape, which is possible because
+        the index does not depend on the position. Therefore neither the
+        intersection nor the normal is transformed into the material
+        coordinates.
+
+        :param raybundle (RayBundle object), gets changed like by propagate
+        :param actualSurface (Surface object with Conic shape)
+
+        :return (RayBundle object,) rays after refraction
+        """
+        shape = actualSurface.shape
+        lc = shape.lc
+        basisT = lc.localbasis.T
+        curv = shape.curvature()
+        cc = shape.conic()
+
+        r0 = raybundle.returnLocalPoints(lc)
+        d = np.dot(basisT, raybundle.returnKtoD(-1))
+        k1 = np.dot(basisT, raybundle.k[-1])
+
+        (t, valid_intersection) = conic_intersection(r0, d, curv, cc)
+        xlocal = r0 + d*t
+
+        raybundle.appendIntersection(lc, xlocal, valid_intersection)
+        actualSurface.removeRaysOutsideAperture(raybundle)
+
+        # normal from the gradient of
+        # -1/2 (1+cc) c z^2 + z - 1/2 c (x^2 + y^2) = 0
+        normal = np.multiply(xlocal, -curv)
+        normal[2] *= 1. + cc
+        normal[2] += 1.
+        normal /= np.sqrt(np.einsum("i...,i...", normal, normal))
+
+        valid_normals = np.isfinite(np.sum(normal, axis=0))
+
+        k_inplane = k1 - np.einsum("i...,i...", k1, normal)*normal
+
+        (xi, valid_refraction) = self.calcXiIsotropic(xlocal,
+                                                      normal,
+                                                      k_inplane,
+                                                      wave=raybundle.wave)
+
+        valid = raybundle.valid[-1] * valid_refraction * valid_normals
+
+        # only valid rays are returned
+        k2 = np.compress(valid, k_inplane, axis=1) +\
+            np.compress(valid, xi)*np.compress(valid, normal, axis=1)
+
+        orig = np.compress(valid, raybundle.x[-1], axis=1)
+        newk = np.dot(basisT.T, k2)
+        Efield = self.calcEfieldOfBundle(raybundle, None, None, newk)
 
         return (RayBundle(orig, newk, Efield, raybundle.rayID[valid],
-                          raybundle.wave),)
+                          raybundle.returnWaveOfRays(valid),
+                          geometric=raybundle.geometric),)
 
     def propagate(self, raybundle, nextSurface):
 
@@ -172,6 +248,8 @@ class ConstantIndexGlass(IsotropicMaterial):
     """
     A simple glass defined by a single refractive index.
     """
+
+    fused_conic_refraction = True
     def __init__(self, lc, n=1.0, **kwargs):
         super(ConstantIndexGlass, self).__init__(lc, **kwargs)
 
@@ -191,6 +269,9 @@ class ConstantIndexGlass(IsotropicMaterial):
 
 
 class ModelGlass(IsotropicMaterial):
+
+    fused_conic_refraction = True
+
     def __init__(self, lc, n0_A_B=(1.49749699179,
                                    0.0100998734374*1e-3,
                                    0.000328623343942*(1e-3)**3.5),
@@ -214,10 +295,11 @@ class ModelGlass(IsotropicMaterial):
         Private routine for all isotropic materials obeying the
         Snell law of refraction.
 
-        :param raybundle: RayBundle object containing the wavelength
-         of the rays.
+        :param x: position (not used)
+        :param wave: wavelength in mm (float or numpy array of float)
 
-        :return index: refractive index at respective wavelength (float)
+        :return index: refractive index at respective wavelength
+                       (float or numpy array of float)
         """
         return self.n0() + self.A() / wave + self.B() / (wave**3.5)
 
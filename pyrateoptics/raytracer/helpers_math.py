@@ -102,3 +102,211 @@ def random_rotation_matrix_sample(n, m):
         (ql, r) = np.linalg.qr(rnd[:, :, j])
         q[:, :, j]= ql
     return q
+
+
+def eig_generalized_finite_sample(A, B, num_finite,
+                                  shifts=(0.3187+0.5314j, -0.7431+0.2718j,
+                                          0.1353-0.9127j), tol=1e-10):
+    """
+    Solves the generalized eigenvalue problems A v = w B v for a sample
+    of m matrices at once. B may be singular, such that some w are
+    infinite. Only the num_finite eigenvalues with smallest abs value
+    and their eigenvectors are returned.
+
+    The problems are reduced to standard eigenvalue problems by the
+    spectral transformation (A - s B)^-1 B v = 1/(w - s) v which maps
+    infinite w onto zero. For every matrix the first shift s is chosen
+    for which A - s B is not singular.
+
+    @param: A (n x n x m numpy array of complex)
+    @param: B (n x n x m numpy array of complex)
+    @param: num_finite (int) number of eigenvalues to be returned
+    @param: shifts (tuple of complex) candidates for spectral shift
+
+    @return: (w, v) (num_finite x m numpy array of complex,
+                     num_finite x n x m numpy array of complex)
+    """
+    (n, _, m) = np.shape(A)
+
+    As = np.transpose(np.asarray(A, dtype=complex), (2, 0, 1))
+    Bs = np.transpose(np.asarray(B, dtype=complex), (2, 0, 1))
+
+    shift = np.zeros(m, dtype=complex)
+    to_shift = np.ones(m, dtype=bool)
+    for s in shifts:
+        shifted = As[to_shift] - s*Bs[to_shift]
+        # compare determinant with Hadamard bound to be scale invariant
+        hadamard = np.prod(np.sqrt(np.sum(np.abs(shifted)**2, axis=2)),
+                           axis=1)
+        regular = np.abs(np.linalg.det(shifted)) > tol*hadamard
+        indices = np.flatnonzero(to_shift)[regular]
+        shift[indices] = s
+        to_shift[indices] = False
+        if not np.any(to_shift):
+            break
+
+    mu, v = np.linalg.eig(
+        np.linalg.solve(As - shift[:, np.newaxis, np.newaxis]*Bs, Bs))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w = shift[:, np.newaxis] + 1./mu
+    w[np.isfinite(w) ^ True] = np.inf
+
+    # first remove infinite parts
+    # then keep num_finite values with smallest abs
+    order = np.argsort(np.abs(w), axis=1)[:, :num_finite]
+    rows = np.arange(m)[:, np.newaxis]
+
+    w_finite = w[rows, order].T
+    v_finite = np.transpose(v[rows, :, order], (1, 2, 0))
+
+    return (w_finite, v_finite)
+
+
+def degenerate_eigenvectors_sample(v, preferred, fallback):
+    """
+    Chooses a deterministic basis for pairs of eigenvectors belonging to
+    a degenerate eigenvalue. The first vector is the projection of
+    preferred onto the span of the pair (or of fallback if preferred is
+    almost orthogonal to it), the second one is orthogonal to the first.
+
+    @param: v (2 x n x m numpy array of complex) eigenvector pairs
+    @param: preferred (n numpy array of float)
+    @param: fallback (n numpy array of float)
+
+    @return: v (2 x n x m numpy array of complex) orthonormal pairs
+    """
+    def normalize(vec):
+        return vec/np.linalg.norm(vec, axis=0)
+
+    def project(vec, basis):
+        return sum([b*np.sum(np.conj(b)*vec[:, np.newaxis], axis=0)
+                    for b in basis])
+
+    u0 = normalize(v[0])
+    u1 = normalize(v[1] - u0*np.sum(np.conj(u0)*v[1], axis=0))
+
+    first = project(preferred, (u0, u1))
+    orthogonal = np.linalg.norm(first, axis=0) < 1e-8
+    first[:, orthogonal] = project(fallback, (u0[:, orthogonal],
+                                              u1[:, orthogonal]))
+    first = normalize(first)
+
+    # orthogonalize the basis vector which is less parallel to first
+    u = np.where(np.abs(np.sum(np.conj(first)*u0, axis=0)) <
+                 np.abs(np.sum(np.conj(first)*u1, axis=0)), u0, u1)
+    second = normalize(u - first*np.sum(np.conj(first)*u, axis=0))
+
+    return np.array([first, second])
+
+
+def polish_polynomial_roots_sample(coeffs, roots, newton_steps=2):
+    """
+    Polishes approximate roots of m polynomials by Newton steps. Steps
+    which do not decrease the residual are rejected, since near multiple
+    roots the derivative almost vanishes.
+
+    @param: coeffs (n+1 x m numpy array of complex) polynomial
+            coefficients, highest degree first (like numpy.roots)
+    @param: roots (k x m numpy array of complex) approximate roots
+    @param: newton_steps (int) number of Newton steps
+
+    @return: roots (k x m numpy array of complex)
+    """
+    def horner(cs, z):
+        result = np.zeros_like(z)
+        for c in cs:
+            result = result*z + c
+        return result
+
+    n = np.shape(coeffs)[0] - 1
+    dcoeffs = coeffs[:-1]*np.arange(n, 0, -1)[:, np.newaxis]
+
+    roots = np.array(roots, dtype=complex)
+    p = horner(coeffs, roots)
+    for _ in range(newton_steps):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newroots = roots - p/horner(dcoeffs, roots)
+            newp = horner(coeffs, newroots)
+            improved = np.abs(newp) < np.abs(p)
+        roots[improved] = newroots[improved]
+        p[improved] = newp[improved]
+
+    return roots
+
+
+def cubic_roots_sample(coeffs):
+    """
+    Calculates the roots of m cubic polynomials at once by Cardano's
+    formula.
+
+    @param: coeffs (4 x m numpy array of complex) polynomial
+            coefficients, highest degree first
+
+    @return: roots (3 x m numpy array of complex)
+    """
+    (a, b, c, d) = np.asarray(coeffs, dtype=complex)
+    (b, c, d) = (b/a, c/a, d/a)
+
+    # depressed cubic t^3 + p t + q = 0 with x = t - b/3
+    p = c - b**2/3.
+    q = 2.*b**3/27. - b*c/3. + d
+
+    sqrtdisc = np.sqrt(q**2/4. + p**3/27.)
+    # choose sign to avoid cancellation
+    sqrtdisc[np.abs(-q/2. - sqrtdisc) > np.abs(-q/2. + sqrtdisc)] *= -1.
+    u = (-q/2. + sqrtdisc)**(1./3.)
+
+    omega = np.exp(2.j*np.pi/3.*np.arange(3))[:, np.newaxis]
+    uk = u*omega
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = uk - p/(3.*uk)
+    # u vanishes only for p = q = 0, i.e. for a triple root t = 0
+    t[:, u == 0] = 0.
+
+    return t - b/3.
+
+
+def quartic_roots_sample(coeffs, newton_steps=2):
+    """
+    Calculates the roots of m quartic polynomials at once by Ferrari's
+    method. The roots are polished by some Newton steps afterwards.
+
+    @param: coeffs (5 x m numpy array of complex) polynomial
+            coefficients, highest degree first (like numpy.roots)
+    @param: newton_steps (int) number of Newton steps for polishing
+
+    @return: roots (4 x m numpy array of complex)
+    """
+    coeffs = np.asarray(coeffs, dtype=complex)
+    (a, b, c, d, e) = coeffs
+    (b, c, d, e) = (b/a, c/a, d/a, e/a)
+
+    # depressed quartic y^4 + p y^2 + q y + r = 0 with x = y - b/4
+    p = c - 3.*b**2/8.
+    q = d - b*c/2. + b**3/8.
+    r = e - b*d/4. + b**2*c/16. - 3.*b**4/256.
+
+    # resolvent cubic 8 m^3 + 8 p m^2 + (2 p^2 - 8 r) m - q^2 = 0;
+    # the root with largest abs value vanishes only if p = q = r = 0
+    mroots = cubic_roots_sample(np.array([8.*np.ones_like(p), 8.*p,
+                                          2.*p**2 - 8.*r, -q**2]))
+    (rows, cols) = (np.argmax(np.abs(mroots), axis=0),
+                    np.arange(np.shape(mroots)[1]))
+    m = mroots[rows, cols]
+
+    sqrt2m = np.sqrt(2.*m)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        qterm = 2.*q/sqrt2m
+    qterm[m == 0] = 0.
+
+    sqrtplus = np.sqrt(-(2.*p + 2.*m + qterm))
+    sqrtminus = np.sqrt(-(2.*p + 2.*m - qterm))
+
+    y = 0.5*np.array([sqrt2m + sqrtplus,
+                      sqrt2m - sqrtplus,
+                      -sqrt2m + sqrtminus,
+                      -sqrt2m - sqrtminus])
+
+    return polish_polynomial_roots_sample(coeffs, y - b/4.,
+                                          newton_steps=newton_steps)
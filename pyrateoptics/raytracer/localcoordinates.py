@@ -27,12 +27,77 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import numpy as np
 import math
 import random
+import itertools
 
 from .helpers_math import rodrigues
 
 from ..core.base import ClassWithOptimizableVariables, OptimizableVariable
 
+
+class LocalCoordinatesIndex(object):
+    """
+    Index of a coordinate system tree. It maps the names and the ids of
+    all coordinate systems connected to the root to the coordinate system
+    objects. One index object is shared by all coordinate systems of a
+    tree and is merged into the index of the new parent tree by addChild.
+    """
+
+    def __init__(self, lc):
+        self.names = {}  # name -> list of LocalCoordinates
+        self.ids = {}  # id -> LocalCoordinates
+        self.add(lc)
+
+    def add(self, lc):
+        if self.ids.get(id(lc)) is lc:
+            return
+        self.ids[id(lc)] = lc
+        self.names.setdefault(lc.name, []).append(lc)
+
+    def rename(self, lc, oldname, newname):
+        lst = self.names.get(oldname, [])
+        if lc in lst:
+            lst.remove(lc)
+            if not lst:
+                del self.names[oldname]
+            self.names.setdefault(newname, []).append(lc)
+
+    def contains(self, lc):
+        return self.ids.get(id(lc)) is lc
+
+    def lookup(self, name):
+        return self.names.get(name, [])
+
+    def __getstate__(self):
+        """
+        ids are not valid after copying, they are rebuilt from names.
+        """
+        return {"names": self.names}
+
+    def __setstate__(self, state):
+        self.names = state["names"]
+        self.ids = dict((id(lc), lc)
+                        for lst in self.names.values() for lc in lst)
+
+
 class LocalCoordinates(ClassWithOptimizableVariables):
+    """
+    The frame (localbasis, globalcoordinates, ...) is evaluated lazily.
+    It is recomputed on access only if the revision of one of the
+    tilt/decenter variables of the coordinate system or of its parents
+    changed (see OptimizableVariable.getRevision), therefore setting a
+    variable updates only the subtree below it. The check is skipped
+    entirely as long as no variable changed and no variable was replaced
+    (see ClassWithOptimizableVariables.latest_structure_revision). Setting
+    parent or tiltThenDecenter marks the frames of the subtree as unchecked.
+
+    All coordinate systems of a tree share a LocalCoordinatesIndex, such
+    that reference lookups by name and connection checks do not have to
+    traverse the tree.
+    """
+
+    # stamps of computed frames, shared by all coordinate systems
+    frame_counter = itertools.count()
+
     def __init__(self, name="", kind="localcoordinates", **kwargs):
         # TODO: Reference to global to be rewritten into reference to root
         '''
@@ -76,19 +141,73 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         self.parent = None # None means reference to root coordinate system
         self.__children = [] # children
 
-        self.globalcoordinates = np.array([0, 0, 0])
-        self.localdecenter = np.array([0, 0, 0])
-        self.localrotation = np.lib.eye(3)
-        self.localbasis = np.lib.eye(3)
+        self.__globalcoordinates = np.array([0, 0, 0])
+        self.__localdecenter = np.array([0, 0, 0])
+        self.__localrotation = np.lib.eye(3)
+        self.__localbasis = np.lib.eye(3)
+        # key: revisions the frame was computed from
+        # stamp: drawn whenever the frame is recomputed
+        # checked: global variable and structure revision at the last check
+        self.__frame = {"key": None, "stamp": None, "checked": None}
+        self.__index = LocalCoordinatesIndex(self)
+        # affine maps to other frames, valid for the frame with stamp
+        self.__transforms = {"stamp": None, "maps": {}}
 
         self.update() # initial update
 
+    def __setattr__(self, key, value):
+        super(LocalCoordinates, self).__setattr__(key, value)
+        if key in ("parent", "tiltThenDecenter") and\
+                "_LocalCoordinates__index" in self.__dict__:
+            for lc in self.returnConnectedChildren():
+                lc.__frame["checked"] = None
+
+    def setName(self, name):
+        oldname = self.__dict__.get("_BaseLogger__name")
+        super(LocalCoordinates, self).setName(name)
+        index = self.__dict__.get("_LocalCoordinates__index")
+        if index is not None:
+            index.rename(self, oldname, self.name)
+
+    name = property(ClassWithOptimizableVariables.getName, setName)
 
     def getChildren(self):
         return self.__children
 
     children = property(getChildren)
 
+    def getGlobalCoordinates(self):
+        self.refresh()
+        return self.__globalcoordinates
+
+    globalcoordinates = property(getGlobalCoordinates)
+
+    def getLocalDecenter(self):
+        self.refresh()
+        return self.__localdecenter
+
+    localdecenter = property(getLocalDecenter)
+
+    def getLocalRotation(self):
+        self.refresh()
+        return self.__localrotation
+
+    localrotation = property(getLocalRotation)
+
+    def getLocalBasis(self):
+        self.refresh()
+        return self.__localbasis
+
+    localbasis = property(getLocalBasis)
+
+    def getFrameStamp(self):
+        """
+        Returns a stamp which changes whenever the frame of the
+        coordinate system is recomputed.
+        """
+        self.refresh()
+        return self.__frame["stamp"]
+
 
     def addChild(self, childlc):
         """
@@ -103,6 +222,11 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         childlc.parent = self
         childlc.update()
         self.__children.append(childlc)
+        index = self.__index
+        for lc in childlc.returnConnectedChildren():
+            index.add(lc)
+            lc.__index = index
+        self.markStructureChanged()
         return childlc
 
     def addChildToReference(self, refname, childlc):
@@ -117,13 +241,40 @@ class LocalCoordinates(ClassWithOptimizableVariables):
 
         TODO: refnames occuring twice may lead to undefined behavior.
         """
-        if self.name == refname:
-            self.addChild(childlc)
-        else:
-            for x in self.__children:
-                x.addChildToReference(refname, childlc)
+        for lc in self.returnConnectedByName(refname):
+            lc.addChild(childlc)
         return childlc
 
+    def isConnected(self, lc):
+        """
+        Checks whether lc is self or one of its (grand)-children.
+
+        @param: lc -- the coordinate system to be checked (object)
+
+        @return: bool
+        """
+        if not self.__index.contains(lc):
+            return False
+        if self.parent is None:
+            # self is the root of the index
+            return True
+        # the index covers the whole tree, check for the subtree of self
+        while lc is not None and lc is not self:
+            lc = lc.parent
+        return lc is self
+
+    def returnConnectedByName(self, name):
+        """
+        Returns all coordinate systems with the given name in self or
+        its (grand)-children.
+
+        @param: name -- name of the coordinate systems (str)
+
+        @return: lst -- coordinate systems found (list of objects)
+        """
+        return [lc for lc in self.__index.lookup(name)
+                if self.isConnected(lc)]
+
 
 
     def calculateMatrixFromTilt(self, tiltx, tilty, tiltz, tiltThenDecenter=0):
@@ -213,43 +364,83 @@ class LocalCoordinates(ClassWithOptimizableVariables):
         decy = self.decy.evaluate()
         decz = self.decz.evaluate()
 
-        self.localdecenter = np.array([decx, decy, decz])
-        self.localrotation = self.calculateMatrixFromTilt(tiltx, tilty, tiltz, self.tiltThenDecenter)
+        self.__localdecenter = np.array([decx, decy, decz])
+        self.__localrotation = self.calculateMatrixFromTilt(tiltx, tilty, tiltz, self.tiltThenDecenter)
 
-    def update(self):
+    def refresh(self):
         '''
         runs through all references specified and sums up
         coordinates and local rotations to get appropriate
-        global coordinate
+        global coordinate. This is only done if one of the variables
+        of self or its parents changed or was replaced since the last call.
         '''
-        self.calculate()
-
-        parentcoordinates = np.array([0, 0, 0])
-        parentbasis = np.lib.eye(3)
-
-        if self.parent != None:
-            parentcoordinates = self.parent.globalcoordinates
-            parentbasis = self.parent.localbasis
-
-        self.localbasis = np.dot(parentbasis, self.localrotation)
-        if self.tiltThenDecenter == 0:
-            # first decenter then rotation
-            self.globalcoordinates = \
-            parentcoordinates + \
-            np.dot(parentbasis, self.localdecenter)
-            # TODO: removed .T on parentbasis to obtain correct behavior; examine!
-        else:
-            # first rotation then decenter
-            self.globalcoordinates = \
-            parentcoordinates + \
-            np.dot(self.localbasis, self.localdecenter)
-            # TODO: removed .T on localbasis to obtain correct behavior; examine!
+        frame = self.__frame
+        checked = (OptimizableVariable.latest_revision,
+                   ClassWithOptimizableVariables.latest_structure_revision)
+        if frame["checked"] == checked:
+            return
+
+        # refresh the unchecked parents top down instead of recursively,
+        # chains of coordinate systems may be deep
+        unchecked = []
+        lc = self.parent
+        while lc is not None and lc.__frame["checked"] != checked:
+            unchecked.append(lc)
+            lc = lc.parent
+        for lc in reversed(unchecked):
+            lc.refresh()
+
+        parentkey = None
+        if self.parent is not None:
+            parentkey = self.parent.getFrameStamp()
+        key = (self.decx.getRevision(), self.decy.getRevision(),
+               self.decz.getRevision(), self.tiltx.getRevision(),
+               self.tilty.getRevision(), self.tiltz.getRevision(),
+               self.tiltThenDecenter, parentkey)
+
+        if key != frame["key"]:
+            self.calculate()
+
+            parentcoordinates = np.array([0, 0, 0])
+            parentbasis = np.lib.eye(3)
+
+            if self.parent is not None:
+                parentcoordinates = self.parent.globalcoordinates
+                parentbasis = self.parent.localbasis
+
+            self.__localbasis = np.dot(parentbasis, self.__localrotation)
+            if self.tiltThenDecenter == 0:
+                # first decenter then rotation
+                self.__globalcoordinates = \
+                parentcoordinates + \
+                np.dot(parentbasis, self.__localdecenter)
+                # TODO: removed .T on parentbasis to obtain correct behavior; examine!
+            else:
+                # first rotation then decenter
+                self.__globalcoordinates = \
+                parentcoordinates + \
+                np.dot(self.__localbasis, self.__localdecenter)
+                # TODO: removed .T on localbasis to obtain correct behavior; examine!
+
+            frame["key"] = key
+            frame["stamp"] = next(LocalCoordinates.frame_counter)
+        frame["checked"] = checked
 
-        for ch in self.__children:
-            ch.update()
+    def update(self):
+        '''
+        Recomputes the frames of self and all children and informs the
+        observers, children first.
+        '''
+        connected = self.returnConnectedChildren()
+        for lc in connected:
+            lc.__frame["key"] = None
+            lc.__frame["checked"] = None
+        for lc in connected:
+            lc.refresh()
 
         # inform observers about update
-        self.informObservers()
+        for lc in reversed(connected):
+            lc.informObservers()
 
     def aimAt(self, anotherlc, update=False):
         (tiltx, tilty, tiltz) = self.calculateAim(anotherlc)
@@ -295,24 +486,53 @@ class LocalCoordinates(ClassWithOptimizableVariables):
 
         return (tiltx, tilty, tiltz)
 
+    def returnAffineTransformTo(self, lcother):
+        """
+        Returns the affine map from the local coordinates of self to the
+        local coordinates of lcother. It is composed once from both frames
+        and cached until one of the frames changes (see getFrameStamp).
+
+        @param: lcother -- the target coordinate system (object)
+
+        @return: transform -- homogeneous transformation (4x4 numpy array)
+        """
+        stamp = self.getFrameStamp()
+        otherstamp = lcother.getFrameStamp()
+        transforms = self.__transforms
+        if transforms["stamp"] != stamp or len(transforms["maps"]) > 64:
+            transforms["stamp"] = stamp
+            transforms["maps"] = {}
+        transform = transforms["maps"].get(otherstamp)
+        if transform is None:
+            otherbasisT = lcother.localbasis.T
+            transform = np.eye(4)
+            transform[:3, :3] = np.dot(otherbasisT, self.localbasis)
+            transform[:3, 3] = np.dot(otherbasisT,
+                                      self.globalcoordinates -
+                                      lcother.globalcoordinates)
+            transforms["maps"][otherstamp] = transform
+        return transform
+
     def returnActualToOtherPoints(self, localpts, lcother):
         # TODO: constraint: lcother and self share same root, check: lcother=self
-        globalpts = self.returnLocalToGlobalPoints(localpts)
-        return lcother.returnGlobalToLocalPoints(globalpts)
+        if lcother is self:
+            return localpts
+        transform = self.returnAffineTransformTo(lcother)
+        return (np.dot(transform[:3, :3], localpts).T + transform[:3, 3]).T
 
     def returnOtherToActualPoints(self, otherpts, lcother):
         # TODO: constraint: lcother and self share same root
-        globalpts = lcother.returnLocalToGlobalPoints(otherpts)
-        return self.returnGlobalToLocalPoints(globalpts)
+        return lcother.returnActualToOtherPoints(otherpts, self)
 
     def returnActualToOtherDirections(self, localdirs, lcother):
         # TODO: constraint: lcother and self share same root
-        globaldirs = self.returnLocalToGlobalDirections(localdirs)
-        return lcother.returnGlobalToLocalDirections(globaldirs)
+        if lcother is self:
+            return localdirs
+        transform = self.returnAffineTransformTo(lcother)
+        return np.dot(transform[:3, :3], localdirs)
 
     def returnOtherToActualDirections(self, otherdirs, lcother):
-        globaldirs = lcother.returnLocalToGlobalDirections(otherdirs)
-        return self.returnGlobalToLocalDirections(globaldirs)
+        return lcother.returnActualToOtherDirections(otherdirs, self)
 
     def returnActualToOtherTensors(self, localtensors, lcother):
         # TODO: constraint: lcother and self share same root
@@ -380,15 +600,18 @@ class LocalCoordinates(ClassWithOptimizableVariables):
 
 
     def returnConnectedNames(self):
-        lst = [self.name]
-        for ch in self.__children:
-            lst = lst + ch.returnConnectedNames()
-        return lst
+        return [lc.name for lc in self.returnConnectedChildren()]
 
     def returnConnectedChildren(self):
-        lst = [self]
-        for ch in self.__children:
-            lst = lst + ch.returnConnectedChildren()
+        """
+        Returns self and its (grand)-children in depth first order.
+        """
+        lst = []
+        stack = [self]
+        while stack:
+            lc = stack.pop()
+            lst.append(lc)
+            stack.extend(reversed(lc.children))
         return lst
 
 
@@ -53,8 +53,7 @@ class LocalCoordinatesTreeBase(ClassWithOptimizableVariables):
 
         :return bool
         """
-        allconnectedchildren = self.rootcoordinatesystem.returnConnectedChildren()
-        return (lc in allconnectedchildren)
+        return self.rootcoordinatesystem.isConnected(lc)
 
     def addLocalCoordinateSystem(self, lc, refname):
         """
@@ -65,15 +64,15 @@ class LocalCoordinatesTreeBase(ClassWithOptimizableVariables):
 
         :return lc
         """
-        allnames = self.rootcoordinatesystem.returnConnectedNames()
+        root = self.rootcoordinatesystem
 
-        if lc.name in allnames:
+        if root.returnConnectedByName(lc.name):
             lc.name = ''
 
-        if refname not in allnames:
-            refname = self.rootcoordinatesystem.name
+        if not root.returnConnectedByName(refname):
+            refname = root.name
 
-        self.rootcoordinatesystem.addChildToReference(refname, lc)
+        root.addChildToReference(refname, lc)
 
         return lc
 
@@ -27,9 +27,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 from .localcoordinatestreebase import LocalCoordinatesTreeBase
 from .localcoordinates import LocalCoordinates
 from .ray import RayPath, RayBundle
+from .surface_shape import Conic
 from .globalconstants import numerical_tolerance
 
-from copy import deepcopy
 
 import numpy as np
 
@@ -67,6 +67,7 @@ class OpticalElement(LocalCoordinatesTreeBase):
         else:
             raise Exception("surface coordinate system should be connected to OpticalElement root coordinate system")
         self.__surf_mat_connection[key] = (minusNmat_key, plusNmat_key)
+        self.markStructureChanged()
 
     def changeMaterialsForSurface(self, key, materialkeys):
         (minusNmat_key, plusNmat_key) = materialkeys
@@ -95,6 +96,7 @@ class OpticalElement(LocalCoordinatesTreeBase):
             if key not in self.__materials:
                 self.__materials[key] = material_object
                 self.__materials[key].comment = comment
+                self.markStructureChanged()
             else:
                 self.warning("Material key " + str(key) + " already taken. Material will not be added.")
         else:
@@ -119,6 +121,23 @@ class OpticalElement(LocalCoordinatesTreeBase):
 
         return returnmat
 
+    def isFusedConicRefraction(self, surface, mat1, mat2):
+        """
+        Checks whether propagation in mat1 to surface and refraction into
+        mat2 may be done by the fused kernel
+        IsotropicMaterial.propagateConicAndRefract. This is the case for
+        Conic shapes (but not for derived shapes) between materials with
+        position independent index.
+
+        :param surface (Surface object)
+        :param mat1 (Material object)
+        :param mat2 (Material object)
+
+        :return bool
+        """
+        return type(surface.shape) is Conic and\
+            mat1.fused_conic_refraction and mat2.fused_conic_refraction
+
     def sequence_to_hitlist(self, seq):
         """
         Converts surface sequence of optical element into hitlist which is
@@ -315,7 +334,23 @@ class OpticalElement(LocalCoordinatesTreeBase):
         return (pilotraypath, XYUVmatrices)
 
 
-    def seqtrace(self, raybundle, sequence, background_medium, splitup=False):
+    def seqtrace(self, raybundle, sequence, background_medium, splitup=False,
+                 record_surfaces=None):
+        """
+        Sequential trace of raybundle through the optical element.
+
+        :param raybundle (RayBundle object)
+        :param sequence (list of (surface key, options dict))
+        :param background_medium (Material object)
+        :param splitup (bool), split raypaths at anisotropic interfaces
+        :param record_surfaces (None or list of surface keys)
+               None: every intermediate raybundle is kept in the raypaths.
+               list: streaming mode; only the raybundles ending at the
+               given surfaces and the final raybundle are kept, such that
+               memory does not grow with the number of surfaces.
+
+        :return rpaths (list of RayPath objects)
+        """
 
         # FIXME: should depend on a list of RayPath
 
@@ -339,31 +374,53 @@ class OpticalElement(LocalCoordinatesTreeBase):
             mnmat = self.__materials.get(mnmat, background_medium)
             pnmat = self.__materials.get(pnmat, background_medium)
 
-            # finalize current_bundles
-            for rp in rpaths:
-                current_bundle = rp.raybundles[-1]
-                current_material.propagate(current_bundle, current_surface)
-
             if refract_flag:
-                current_material = self.findoutWhichMaterial(mnmat,
-                                                             pnmat,
-                                                             current_material)
+                next_material = self.findoutWhichMaterial(mnmat,
+                                                          pnmat,
+                                                          current_material)
             else:
-                pass
+                next_material = current_material
+
+            fused = refract_flag and\
+                self.isFusedConicRefraction(current_surface,
+                                            current_material,
+                                            next_material)
+
+            if not fused:
+                # finalize current_bundles
+                for rp in rpaths:
+                    current_bundle = rp.returnLastRayBundle()
+                    current_material.propagate(current_bundle,
+                                               current_surface)
+
+            current_material = next_material
 
             current_material_deflection = {True: current_material.refract,
                                            False: current_material.reflect}
 
+            record_flag = record_surfaces is None or\
+                surfkey in record_surfaces
+
             for rp in rpaths:
-                current_bundle = rp.raybundles[-1]
-                raybundles = current_material_deflection[refract_flag](
+                current_bundle = rp.returnLastRayBundle()
+                if fused:
+                    # propagation and refraction at once
+                    raybundles = current_material.propagateConicAndRefract(
+                        current_bundle, current_surface)
+                else:
+                    raybundles = current_material_deflection[refract_flag](
                         current_bundle,
                         current_surface,
                         splitup=splitup)
 
+                if not record_flag:
+                    # bundle ending at current surface is not needed anymore
+                    rp.popRayBundle()
+
                 for rb in raybundles[1:]:
-                    # if there are more than one return value, copy path
-                    rpathprime = deepcopy(rp)
+                    # if there are more than one return value, branch path
+                    # (the common raybundles are shared, not copied)
+                    rpathprime = rp.branch()
                     rpathprime.appendRayBundle(rb)
                     rpaths_new.append(rpathprime)
                 rp.appendRayBundle(raybundles[0])
@@ -395,10 +452,11 @@ class OpticalElement(LocalCoordinatesTreeBase):
             surf_start = self.__surfaces[surf_start_key]
             surf_end = self.__surfaces[surf_end_key]
 
-            x0_glob = rpath.raybundles[-1].x[-1]
-            k0_glob = rpath.raybundles[-1].k[-1]
+            lastbundle = rpath.returnLastRayBundle()
+            x0_glob = lastbundle.x[-1]
+            k0_glob = lastbundle.k[-1]
 
-            newbundle = RayBundle(x0_glob, k0_glob, None, rpath.raybundles[-1].rayID, wave=rpath.raybundles[-1].wave)
+            newbundle = RayBundle(x0_glob, k0_glob, None, lastbundle.rayID, wave=lastbundle.wave)
 
             x0 = surf_start.rootcoordinatesystem.returnGlobalToLocalPoints(x0_glob)
             k0 = surf_start.rootcoordinatesystem.returnGlobalToLocalDirections(k0_glob)
@@ -26,7 +26,6 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import numpy as np
 from pprint import pformat
-from copy import deepcopy
 
 from .raytracer_keyword_class_association import kind_of_raytracer_classes
 from ..material.material_keyword_class_association import kind_of_material_classes
@@ -68,20 +67,46 @@ class OpticalSystem(LocalCoordinatesTreeBase):
     def getDictionary(self):
         return super(OpticalSystem, self).getDictionary()
 
-    def seqtrace(self, initialbundle, elementsequence, splitup=False): # [("elem1", [1, 3, 4]), ("elem2", [1,4,4]), ("elem1", [4, 3, 1])]
+    def seqtrace(self, initialbundle, elementsequence, splitup=False,
+                 record_surfaces=None): # [("elem1", [1, 3, 4]), ("elem2", [1,4,4]), ("elem1", [4, 3, 1])]
+        """
+        Sequential trace of initialbundle through the optical system.
+
+        :param initialbundle (RayBundle object)
+        :param elementsequence (list of (element key, sequence))
+        :param splitup (bool), split raypaths at anisotropic interfaces
+        :param record_surfaces (None or list of (element key, surface key))
+               None: every intermediate raybundle is kept in the raypaths.
+               list: streaming mode; only the raybundles ending at the
+               given surfaces and the final raybundle are kept.
+               Use an empty list to keep the final raybundle only
+               (e.g. for spot diagrams or merit functions).
+
+        :return rpaths (list of RayPath objects)
+        """
         rpath = RayPath(initialbundle)
         rpaths = [rpath]
         for (elem, subseq) in elementsequence:
             rpaths_new = []
 
+            elem_record_surfaces = None
+            if record_surfaces is not None:
+                elem_record_surfaces = [surfkey for (elemkey, surfkey)
+                                        in record_surfaces if elemkey == elem]
+
             for rp in rpaths:
                 raypaths_to_append =\
-                    self.elements[elem].seqtrace(rp.raybundles[-1],
+                    self.elements[elem].seqtrace(rp.returnLastRayBundle(),
                                                  subseq,
                                                  self.material_background,
-                                                 splitup=splitup)
+                                                 splitup=splitup,
+                                                 record_surfaces=elem_record_surfaces)
+                if record_surfaces is not None:
+                    # element raypaths start with the last raybundle
+                    # of rp if it is to be recorded
+                    rp.popRayBundle()
                 for rp_append in raypaths_to_append[1:]:
-                    rpathprime = deepcopy(rp)
+                    rpathprime = rp.branch()
                     rpathprime.appendRayPath(rp_append)
                     rpaths_new.append(rpathprime)
                 rp.appendRayPath(raypaths_to_append[0])
@@ -113,8 +138,8 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         self.info(pilotraypathsequence)
         for ((elem, subseq), prp_nr) in zip(elementsequence, pilotraypathsequence):
             (append_pilotpath, append_rpath) =\
-                self.elements[elem].para_seqtrace(pilotpath.raybundles[-1],
-                                                  rpath.raybundles[-1],
+                self.elements[elem].para_seqtrace(pilotpath.returnLastRayBundle(),
+                                                  rpath.returnLastRayBundle(),
                                                   subseq,
                                                   self.material_background,
                                                   pilotraypath_nr=prp_nr,
@@ -156,7 +181,7 @@ class OpticalSystem(LocalCoordinatesTreeBase):
             # hitlist may contain exactly one stophit
 
             (append_pilotpath, elem_matrices) =\
-                self.elements[elem].calculateXYUV(pilotpath.raybundles[-1],
+                self.elements[elem].calculateXYUV(pilotpath.returnLastRayBundle(),
                                                   subseq,
                                                   self.material_background,
                                                   pilotraypath_nr=prp_nr,
@@ -219,6 +244,7 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         """
         if self.checkForRootConnection(element.rootcoordinatesystem):
             self.elements[key] = element
+            self.markStructureChanged()
         else:
             raise Exception("OpticalElement root should be connected to root of OpticalSystem")
 
@@ -231,6 +257,7 @@ class OpticalSystem(LocalCoordinatesTreeBase):
         # TODO: update of local coordinate references missing
         if key in self.elements:
             self.elements.pop(key)
+            self.markStructureChanged()
 
 
     def getABCDMatrix(self, ray, firstSurfacePosition=0, lastSurfacePosition=-1):
@@ -32,7 +32,7 @@ from .globalconstants import standard_wavelength, canonical_ex, canonical_ey
 
 class RayBundle(object):
     def __init__(self, x0, k0, Efield0, rayID=None, wave=standard_wavelength,
-                 splitted=False):
+                 splitted=False, numsteps=2, geometric=False):
         """
         Class representing a bundle of rays.
 
@@ -45,33 +45,133 @@ class RayBundle(object):
         :param rayID: (1d numpy array of int)
                     Set an ID number for each ray in the bundle;
                     if empty -> generate arange
-        :param wave: (float)
+        :param wave: (float or 1d numpy array of float)
                     Wavelength of the radiation in millimeters.
+                    If an array is given, it contains the wavelength of
+                    every ray (polychromatic bundle).
+        :param numsteps: (int)
+                    Number of points (including x0) to preallocate.
+        :param geometric: (bool)
+                    Store only real positions and wave vectors and no
+                    electrical field.
         """
         self.splitted = splitted
+        self.geometric = geometric
+        # per shape name: iterations and residuals of the intersection
+        self.intersection_statistics = {}
+        # per surface name: rays pruned at anisotropic splits
+        self.pruning_statistics = {}
+        # (lc, frame stamp, numsteps, local points) of the last point
+        self.__localpoints = None
         numray = np.shape(x0)[1]
         if rayID is None or len(rayID) == 0:
             rayID = np.arange(numray)
         self.rayID = rayID
 
-        newshape = self.newshape(np.shape(x0))
-
-        self.x = x0.reshape(newshape)
-        # First index counting index: x[0] == x0
-        # shape(x): axis=0: counting axis
+        # The arrays x, k, Efield, valid are views on the first
+        # numsteps rows of preallocated buffers.
+        # shape(x): axis=0: counting axis (x[0] == x0)
         # axis=1: vector components (xyz)
         # axis=2: ray number
 
-        self.k = k0.reshape(newshape)
+        capacity = max(numsteps, 1)
+        x0 = np.asarray(x0)
+        k0 = np.asarray(k0)
+        if geometric:
+            x0 = np.real(x0)
+            if not np.issubdtype(x0.dtype, np.floating):
+                x0 = np.asarray(x0, dtype=float)
+            k0 = np.asarray(np.real(k0), dtype=x0.dtype)
+
+        self.__numsteps = 1
+
+        self.__x = np.empty((capacity,) + np.shape(x0), dtype=x0.dtype)
+        self.__x[0] = x0
 
-        self.valid = np.ones((1, numray), dtype=bool)
+        self.__k = np.empty((capacity,) + np.shape(k0), dtype=k0.dtype)
+        self.__k[0] = k0
+
+        self.__valid = np.ones((capacity, numray), dtype=bool)
 
         self.wave = wave
-        if Efield0 is None or len(Efield0) == 0:
-            self.Efield = np.zeros(newshape)
-            self.Efield[:, 1, :] = 1.
+        if geometric:
+            self.__Efield = None
+        elif Efield0 is None or len(Efield0) == 0:
+            self.__Efield = np.zeros((capacity,) + np.shape(x0))
+            self.__Efield[0, 1, :] = 1.
         else:
-            self.Efield = Efield0.reshape(newshape)
+            Efield0 = np.asarray(Efield0)
+            self.__Efield = np.empty((capacity,) + np.shape(Efield0),
+                                     dtype=Efield0.dtype)
+            self.__Efield[0] = Efield0
+
+    def getX(self):
+        return self.__x[:self.__numsteps]
+
+    def resetNumberOfSteps(self, array):
+        """
+        Takes the number of points from an array which replaced one of
+        x, k, Efield, valid.
+        """
+        self.__numsteps = np.shape(array)[0]
+        self.__localpoints = None
+
+    def setX(self, x):
+        self.__x = x
+        self.resetNumberOfSteps(x)
+
+    x = property(getX, setX)
+
+    def getK(self):
+        return self.__k[:self.__numsteps]
+
+    def setK(self, k):
+        self.__k = k
+        self.resetNumberOfSteps(k)
+
+    k = property(getK, setK)
+
+    def getEfield(self):
+        if self.geometric:
+            return None
+        return self.__Efield[:self.__numsteps]
+
+    def setEfield(self, Efield):
+        if self.geometric:
+            if Efield is not None:
+                raise Exception("geometric raybundles have no " +
+                                "electrical field")
+            return
+        self.__Efield = Efield
+        self.resetNumberOfSteps(Efield)
+
+    Efield = property(getEfield, setEfield)
+
+    def getValid(self):
+        return self.__valid[:self.__numsteps]
+
+    def setValid(self, valid):
+        self.__valid = valid
+        self.resetNumberOfSteps(valid)
+
+    valid = property(getValid, setValid)
+
+    def isPolychromatic(self):
+        return np.ndim(self.wave) > 0
+
+    def returnWaveOfRays(self, selection):
+        """
+        Returns the wavelength for a selection of rays, e.g. for
+        constructing a new bundle from a subset of the rays.
+
+        :param selection (1d numpy array of bool or int)
+                    index of the rays as for rayID
+
+        :return wave (float or 1d numpy array of float)
+        """
+        if self.isPolychromatic():
+            return np.asarray(self.wave)[selection]
+        return self.wave
 
     def newshape(self, shape2d):
         """
@@ -79,37 +179,143 @@ class RayBundle(object):
         """
         return tuple([1] + list(shape2d))
 
+    def growBuffer(self, buf, capacity, dtype):
+        """
+        Returns buffer with at least capacity rows and given dtype.
+        The filled part of the old buffer is copied.
+        """
+        if np.shape(buf)[0] >= capacity and buf.dtype == dtype:
+            return buf
+        newbuf = np.empty((capacity,) + np.shape(buf)[1:], dtype=dtype)
+        newbuf[:self.__numsteps] = buf[:self.__numsteps]
+        return newbuf
+
+    def reserve(self, numsteps):
+        """
+        Preallocates storage for numsteps points such that subsequent
+        calls of append are in-place writes.
+
+        :param numsteps (int)
+        """
+        self.__x = self.growBuffer(self.__x, numsteps, self.__x.dtype)
+        self.__k = self.growBuffer(self.__k, numsteps, self.__k.dtype)
+        if not self.geometric:
+            self.__Efield = self.growBuffer(self.__Efield, numsteps,
+                                            self.__Efield.dtype)
+        self.__valid = self.growBuffer(self.__valid, numsteps, bool)
+
     def append(self, xnew, knew, Enew, Validnew):
         """
         Appends one point with appropriate wave vector, electrical field and
         validity array. New validity status is cumulative.
+        If the preallocated storage is exhausted, it is doubled.
+        For geometric bundles Enew is ignored and xnew, knew are
+        stored with the real dtype of the bundle.
 
         :param xnew (2d numpy 3xN array of float)
         :param knew (2d numpy 3xN array of complex)
-        :param Enew (2d numpy 3xN array of complex)
+        :param Enew (2d numpy 3xN array of complex or None)
+        :param Validnew (1d numpy array of bool)
+
+        """
+        num = self.__numsteps
+        capacity = max(np.shape(self.__x)[0],
+                       np.shape(self.__k)[0],
+                       np.shape(self.__valid)[0])
+        if capacity <= num:
+            capacity = 2*num
+
+        if self.geometric:
+            self.__x = self.growBuffer(self.__x, capacity, self.__x.dtype)
+            self.__k = self.growBuffer(self.__k, capacity, self.__k.dtype)
+            self.__valid = self.growBuffer(self.__valid, capacity, bool)
+
+            self.__x[num] = np.reshape(np.real(xnew),
+                                       np.shape(self.__x)[1:])
+            self.__k[num] = np.reshape(np.real(knew),
+                                       np.shape(self.__k)[1:])
+            self.__valid[num] = self.__valid[num - 1]*Validnew
+
+            self.__numsteps = num + 1
+            return
+
+        xnew = np.asarray(xnew)
+        knew = np.asarray(knew)
+        Enew = np.asarray(Enew)
+
+        self.__x = self.growBuffer(self.__x, capacity,
+                                   np.result_type(self.__x.dtype,
+                                                  xnew.dtype))
+        self.__k = self.growBuffer(self.__k, capacity,
+                                   np.result_type(self.__k.dtype,
+                                                  knew.dtype))
+        self.__Efield = self.growBuffer(self.__Efield, capacity,
+                                        np.result_type(self.__Efield.dtype,
+                                                       Enew.dtype))
+        self.__valid = self.growBuffer(self.__valid, capacity, bool)
+
+        self.__x[num] = np.reshape(xnew, np.shape(self.__x)[1:])
+        self.__k[num] = np.reshape(knew, np.shape(self.__k)[1:])
+        self.__Efield[num] = np.reshape(Enew, np.shape(self.__Efield)[1:])
+        self.__valid[num] = self.__valid[num - 1]*Validnew
+
+        self.__numsteps = num + 1
+
+    def appendIntersection(self, lc, xlocal, Validnew):
+        """
+        Appends intersection points given in the local coordinates of lc.
+        Wave vector and electrical field are kept. The local points are
+        kept for returnLocalPoints.
+
+        :param lc (LocalCoordinates object)
+        :param xlocal (2d numpy 3xN array of float)
         :param Validnew (1d numpy array of bool)
+        """
+        Enew = None if self.geometric else self.Efield[-1]
+        self.append(lc.returnLocalToGlobalPoints(xlocal),
+                    self.k[-1], Enew, Validnew)
+        self.__localpoints = (lc, lc.getFrameStamp(), self.__numsteps,
+                              xlocal)
 
+    def returnLocalPoints(self, lc):
         """
-        newshape = self.newshape(np.shape(xnew))
-        newshapev = (1, np.shape(Validnew)[0])
+        Returns the last points of the bundle in the local coordinates
+        of lc. If the points were appended by appendIntersection, they
+        are transformed directly from the frame of the intersection.
+
+        :param lc (LocalCoordinates object)
 
-        txnew = np.reshape(xnew, newshape)
-        tknew = np.reshape(knew, newshape)
-        tEnew = np.reshape(Enew, newshape)
-        tValidnew = np.reshape(self.valid[-1]*Validnew, newshapev)
+        :return xlocal (2d numpy 3xN array of float)
+        """
+        if self.__localpoints is not None:
+            (lcpoints, stamp, num, xlocal) = self.__localpoints
+            if num == self.__numsteps and stamp == lcpoints.getFrameStamp():
+                return lcpoints.returnActualToOtherPoints(xlocal, lc)
+        return lc.returnGlobalToLocalPoints(self.x[-1])
 
-        self.x      = np.vstack((self.x, txnew))
-        self.k      = np.vstack((self.k, tknew))
-        self.Efield = np.vstack((self.Efield, tEnew))
-        self.valid  = np.vstack((self.valid, tValidnew))
+    def returnInitialRayBundle(self):
+        """
+        Returns a new bundle which only contains the initial points of
+        self, e.g. for tracing the same rays again.
+        """
+        Efield0 = None if self.geometric else self.Efield[0]
+        return RayBundle(self.x[0], self.k[0], Efield0, self.rayID,
+                         self.wave, geometric=self.geometric)
 
     def clone(self):
-        result = RayBundle(self.x[0], self.k[0], self.Efield[0], self.rayID, self.wave)
+        if self.geometric:
+            result = RayBundle(self.x[0], self.k[0], None, self.rayID,
+                               self.wave, geometric=True)
+        else:
+            result = RayBundle(self.x[0], self.k[0], self.Efield[0],
+                               self.rayID, self.wave)
+            result.Efield = np.copy(self.Efield)
 
         result.x = np.copy(self.x)
         result.k = np.copy(self.k)
-        result.Efield = np.copy(self.Efield)
         result.valid = np.copy(self.valid)
+        result.intersection_statistics = dict(self.intersection_statistics)
+        result.pruning_statistics = dict(self.pruning_statistics)
 
         return result
 
@@ -117,43 +323,70 @@ class RayBundle(object):
     def returnLocalComponents(self, lc, num):
         xloc = lc.returnGlobalToLocalPoints(self.x[num])
         kloc = lc.returnGlobalToLocalDirections(self.k[num])
-        Eloc = lc.returnGlobalToLocalDirections(self.Efield[num])
+        if self.geometric:
+            Eloc = None
+        else:
+            Eloc = lc.returnGlobalToLocalDirections(self.Efield[num])
 
         return (xloc, kloc, Eloc)
 
     def returnLocalD(self, lc, num):
-        dloc = lc.returnGlobalToLocalDirections(self.returnKtoD()[num])
+        dloc = lc.returnGlobalToLocalDirections(self.returnKtoD(num))
         return dloc
 
     def appendLocalComponents(self, lc, xloc, kloc, Eloc, valid):
         xglob = lc.returnLocalToGlobalPoints(xloc)
         kglob = lc.returnLocalToGlobalDirections(kloc)
-        Eglob = lc.returnLocalToGlobalDirections(Eloc)
+        if Eloc is None:
+            Eglob = None
+        else:
+            Eglob = lc.returnLocalToGlobalDirections(Eloc)
 
         self.append(xglob, kglob, Eglob, valid)
 
-    def returnKtoD(self):
+    def returnKtoD(self, num=None):
+        """
+        Returns the normalized directions of the Poynting vectors.
+        For geometric bundles these are the normalized wave vectors.
 
-        (num_bundle, num_dim, num_pts) = np.shape(self.Efield)
+        :param num (int or None), step for which the directions are
+               calculated; None calculates all steps
 
-        absE2 = np.reshape(
-                np.sum(np.conj(self.Efield)*self.Efield, axis=1),
-                (num_bundle, 1, num_pts))
-        Ek = np.reshape(
-                np.sum(self.Efield*self.k, axis=1),
-                (num_bundle, 1, num_pts))
-        S = np.real(absE2*self.k - Ek*np.conj(self.Efield))
+        :return d (3d numpy array of float, 2d numpy 3xN array for given num)
+        """
+        if self.geometric:
+            k = self.k if num is None else self.k[num]
+            return k / np.sqrt(np.sum(k*k, axis=-2, keepdims=True))
+
+        if num is None:
+            (k, Efield) = (self.k, self.Efield)
+        else:
+            (k, Efield) = (self.k[num], self.Efield[num])
 
-        normS = np.sqrt(
-                np.reshape(np.sum(S**2, axis=1),
-                           (num_bundle, 1, num_pts)))
+        if np.iscomplexobj(k) or np.iscomplexobj(Efield):
+            absE2 = np.sum(np.conj(Efield)*Efield, axis=-2, keepdims=True)
+            Ek = np.sum(Efield*k, axis=-2, keepdims=True)
+            S = np.real(absE2*k - Ek*np.conj(Efield))
+        else:
+            absE2 = np.sum(Efield*Efield, axis=-2, keepdims=True)
+            Ek = np.sum(Efield*k, axis=-2, keepdims=True)
+            S = absE2*k - Ek*Efield
+
+        normS = np.sqrt(np.sum(S**2, axis=-2, keepdims=True))
 
         return S / normS
 
 
 
-    def getLocalSurfaceNormal(self, surface, material, xglob):
-        xlocshape = surface.shape.lc.returnGlobalToLocalPoints(xglob)
+    def getLocalSurfaceNormal(self, surface, material, xglob=None):
+        """
+        Returns the surface normal at xglob (default: the last points of
+        the bundle) in the local coordinates of the material.
+        """
+        if xglob is None:
+            xlocshape = self.returnLocalPoints(surface.shape.lc)
+        else:
+            xlocshape = surface.shape.lc.returnGlobalToLocalPoints(xglob)
         nlocshape = surface.shape.getNormal(xlocshape[0], xlocshape[1])
         nlocmat = material.lc.returnOtherToActualDirections(nlocshape, surface.shape.lc)
         return nlocmat
@@ -201,19 +434,99 @@ class RayBundle(object):
 
 
 
+class RayPathNode(object):
+    """
+    Node of the ray path tree: one raybundle and a link to the node of
+    the preceding raybundle. Nodes are never changed after creation,
+    therefore they may be shared by several ray paths.
+    """
+
+    def __init__(self, raybundle, parent=None):
+        self.raybundle = raybundle
+        self.parent = parent
+        self.depth = 1 if parent is None else parent.depth + 1
+
+
 class RayPath(object):
 
     def __init__(self, initialraybundle=None):
-        if initialraybundle is None:
-            self.raybundles = []
-        else:
-            self.raybundles = [initialraybundle]
+        """
+        Sequence of raybundles along a path through the optical system.
+
+        The raybundles are kept as a parent-linked list of RayPathNode
+        objects. Ray paths which are branched (e.g. at birefringent
+        splits) share their common prefix bundles by reference instead
+        of copying them. raybundles is a tuple which is built on demand
+        and cached until the path changes; use appendRayBundle,
+        popRayBundle or the raybundles setter to change the path.
+        """
+        self.__last = None
+        # (last node, tuple of raybundles up to this node)
+        self.__flat = (None, ())
+        if initialraybundle is not None:
+            self.appendRayBundle(initialraybundle)
+
+    def getRayBundles(self):
+        (node, raybundles) = self.__flat
+        if node is not self.__last:
+            raybundles = []
+            node = self.__last
+            while node is not None:
+                raybundles.append(node.raybundle)
+                node = node.parent
+            raybundles = tuple(reversed(raybundles))
+            self.__flat = (self.__last, raybundles)
+        return raybundles
+
+    def setRayBundles(self, raybundles):
+        self.__last = None
+        for raybundle in raybundles:
+            self.appendRayBundle(raybundle)
+
+    raybundles = property(getRayBundles, setRayBundles)
+
+    def __getstate__(self):
+        # flat list instead of the nested nodes for copy and pickle
+        return {"raybundles": self.raybundles}
+
+    def __setstate__(self, state):
+        self.__last = None
+        self.__flat = (None, ())
+        self.raybundles = state["raybundles"]
+
+    def getNumberOfRayBundles(self):
+        return 0 if self.__last is None else self.__last.depth
+
+    def returnLastRayBundle(self):
+        return self.__last.raybundle
 
     def appendRayBundle(self, raybundle):
-        self.raybundles.append(raybundle)
+        self.__last = RayPathNode(raybundle, self.__last)
 
     def appendRayPath(self, raypath):
-        self.raybundles += raypath.raybundles
+        for raybundle in raypath.raybundles:
+            self.appendRayBundle(raybundle)
+
+    def popRayBundle(self):
+        """
+        Removes the last raybundle from the path and returns it.
+        Other ray paths sharing this raybundle are not affected.
+        """
+        raybundle = self.__last.raybundle
+        self.__last = self.__last.parent
+        return raybundle
+
+    def branch(self):
+        """
+        Returns a new ray path with the same raybundles. The raybundles
+        are shared by reference and not copied; both paths may be
+        continued independently afterwards.
+
+        :return raypath (RayPath object)
+        """
+        raypath = RayPath()
+        raypath.__last = self.__last
+        return raypath
 
     def draw2d(self, ax, color="blue",
                plane_normal=canonical_ex, up=canonical_ey,
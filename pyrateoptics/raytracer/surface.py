@@ -109,14 +109,21 @@ class Surface(LocalCoordinatesTreeBase):
         self.shape.intersect(raybundle)
 
         if remove_rays_outside_aperture:
-            globalintersection = raybundle.x[-1]
-            local_ap_intersection =\
-                self.aperture.lc.returnGlobalToLocalPoints(globalintersection)
+            self.removeRaysOutsideAperture(raybundle)
 
-            valid = self.aperture.arePointsInAperture(local_ap_intersection[0],
-                                                      local_ap_intersection[1])
+    def removeRaysOutsideAperture(self, raybundle):
+        """
+        Invalidates the last points of raybundle outside the aperture.
+
+        :param raybundle (RayBundle object), gets changed!
+        """
+        local_ap_intersection =\
+            raybundle.returnLocalPoints(self.aperture.lc)
+
+        valid = self.aperture.arePointsInAperture(local_ap_intersection[0],
+                                                  local_ap_intersection[1])
 
-            raybundle.valid[-1] = raybundle.valid[-1]*valid
+        raybundle.valid[-1] = raybundle.valid[-1]*valid
 
     def draw2d(self, ax, vertices=50,
                inyzplane=True,
@@ -25,12 +25,10 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import numpy as np
-from scipy.misc import factorial
 import math
 from ..core.base import ClassWithOptimizableVariables, OptimizableVariable
 from scipy.optimize import fsolve
 from scipy.interpolate import RectBivariateSpline, interp2d, bisplrep
-from scipy.special import jacobi
 from .globalconstants import numerical_tolerance
 import ctypes
 
@@ -134,13 +132,68 @@ class Shape(ClassWithOptimizableVariables):
 
     def getLocalRayBundleForIntersect(self, raybundle):
         localo = self.lc.returnGlobalToLocalPoints(raybundle.x[-1])
-        globald = raybundle.returnKtoD()
-        locald = self.lc.returnGlobalToLocalDirections(globald[-1])
+        locald = self.lc.returnGlobalToLocalDirections(raybundle.returnKtoD(-1))
         return (localo, locald)
 
 
+def quadric_intersection(r0, rayDir, curvx, curvy, curvz):
+    """
+    Calculates the ray parameter of the intersection of rays with the
+    quadric surface curvx x^2 + curvy y^2 + curvz z^2 - 2 z = 0, which
+    touches the xy plane in the origin.
+
+    :param r0: start points of the rays (2d numpy 3xN array of float)
+    :param rayDir: directions of the rays (2d numpy 3xN array of float)
+    :param curvx: curvature in x direction (float)
+    :param curvy: curvature in y direction (float)
+    :param curvz: coefficient of z^2 (float)
+
+    :return t: ray parameter of intersection (1d numpy array of float)
+    :return validIndices: whether rays hit the quadric (1d numpy array of bool)
+    """
+
+    # FIXME: G = 0 if start points lie on a conic with the same parameters than
+    # the next surface! (e.g.: water drop with internal reflection)
+
+    F = rayDir[2] - (curvx * rayDir[0] * r0[0] + curvy * rayDir[1] * r0[1] + curvz * rayDir[2] * r0[2])
+    G = curvx * r0[0]**2 + curvy * r0[1]**2 + curvz * r0[2]**2 - 2 * r0[2]
+    H = - (curvx * rayDir[0]**2 + curvy * rayDir[1]**2 + curvz * rayDir[2]**2)
+
+    square = F**2 + H*G
+    division_part = F + np.sqrt(square)
+
+
+    #H_nearly_zero = (np.abs(H) < numerical_tolerance)
+    #G_nearly_zero = (np.abs(G) < numerical_tolerance)
+    #F_nearly_zero = (np.abs(F) < numerical_tolerance)
+    #t = np.where(H_nearly_zero, G/(2.*F), np.where(G_nearly_zero, -2.*F/H, G / division_part))
+
+    t = G/division_part
+
+    # find indices of rays that don't intersect with the quadric
+    validIndices = square > 0 #*(True - F_nearly_zero)
+
+    return (t, validIndices)
+
+
+def conic_intersection(r0, rayDir, curv, cc):
+    """
+    Calculates the ray parameter of the intersection of rays with a
+    conic section surface in its vertex coordinate system.
+
+    :param r0: start points of the rays (2d numpy 3xN array of float)
+    :param rayDir: directions of the rays (2d numpy 3xN array of float)
+    :param curv: curvature of the conic (float)
+    :param cc: conic constant (float)
+
+    :return t: ray parameter of intersection (1d numpy array of float)
+    :return validIndices: whether rays hit the conic (1d numpy array of bool)
+    """
+    return quadric_intersection(r0, rayDir, curv, curv, curv*(1+cc))
+
+
 class Conic(Shape):
-    def __init__(self, lc, curv=0.0, cc=0.0, **kwargs):
+    def __init__(self, lc, curv=0.0, cc=0.0, kind="shape_Conic", **kwargs):
         """
         Create rotationally symmetric surface
         with a conic cross section in the meridional plane.
@@ -154,7 +207,7 @@ class Conic(Shape):
              cc = 1 rotational paraboloid
              cc > 1 rotational hyperboloid
         """
-        super(Conic, self).__init__(lc, kind="shape_Conic", **kwargs)
+        super(Conic, self).__init__(lc, kind=kind, **kwargs)
 
         self.curvature = OptimizableVariable(name="curvature", value=curv)
         self.conic = OptimizableVariable(name="conic constant", value=cc)
@@ -268,35 +321,12 @@ class Conic(Shape):
         # rayDir = raybundle.rayDir in the local coordinate system
         # raybundle itself lives in the global coordinate system
 
-        # FIXME: G = 0 if start points lie on a conic with the same parameters than
-        # the next surface! (e.g.: water drop with internal reflection)
-
-        curv = self.curvature()
-        cc = self.conic()
-
-        F = rayDir[2] - curv * (rayDir[0] * r0[0] + rayDir[1] * r0[1] + rayDir[2] * r0[2] * (1+cc))
-        G = curv * (r0[0]**2 + r0[1]**2 + r0[2]**2 * (1+cc)) - 2 * r0[2]
-        H = - curv - cc * curv * rayDir[2]**2
-
-        square = F**2 + H*G
-        division_part = F + np.sqrt(square)
-
-
-        #H_nearly_zero = (np.abs(H) < numerical_tolerance)
-        #G_nearly_zero = (np.abs(G) < numerical_tolerance)
-        #F_nearly_zero = (np.abs(F) < numerical_tolerance)
-        #t = np.where(H_nearly_zero, G/(2.*F), np.where(G_nearly_zero, -2.*F/H, G / division_part))
-
-        t = G/division_part
+        (t, validIndices) = conic_intersection(r0, rayDir,
+                                               self.curvature(), self.conic())
 
         intersection = r0 + rayDir * t
 
-        # find indices of rays that don't intersect with the sphere
-        validIndices = square > 0 #*(True - F_nearly_zero)
-
-        globalinter = self.lc.returnLocalToGlobalPoints(intersection)
-
-        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], validIndices)
+        raybundle.appendIntersection(self.lc, intersection, validIndices)
 
 
 class Cylinder(Conic):
@@ -348,9 +378,7 @@ class Cylinder(Conic):
 
         validIndices = (square > 0) # TODO: damping criterion
 
-        globalinter = self.lc.returnLocalToGlobalPoints(intersection)
-
-        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], validIndices)
+        raybundle.appendIntersection(self.lc, intersection, validIndices)
 
 
 class FreeShape(Shape):
@@ -408,23 +436,127 @@ class ExplicitShape(FreeShape):
     def getSag(self, x, y):
         return self.F(x, y)
 
-    def intersect(self, raybundle):
-        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
+    def getIntersectionSeed(self, r0, rayDir):
+        """
+        Initial guess for the intersection of the rays with the surface.
+        Uses the intersection with the vertex sphere, if the central
+        curvature is known, and with the vertex plane otherwise (or if
+        the ray misses the sphere).
+
+        :param r0: start points in local coordinates (2d numpy 3xN array of float)
+        :param rayDir: directions in local coordinates (2d numpy 3xN array of float)
+        :return t: ray parameter (1d numpy array of float)
+        """
+        try:
+            curv = self.getCentralCurvature()
+        except NotImplementedError:
+            curv = 0.
 
-        t = np.zeros_like(r0[0])
+        return self.seedFromQuadric(r0, rayDir, curv, curv, curv)
 
-        def Fwrapper(t, r0, rayDir):
-            return r0[2] + t*rayDir[2] - self.F(r0[0] + t*rayDir[0], r0[1] + t*rayDir[1])
+    def seedFromQuadric(self, r0, rayDir, curvx, curvy, curvz, z0=0.):
+        """
+        Intersects the rays with the quadric
+        curvx x^2 + curvy y^2 + curvz (z - z0)^2 - 2 (z - z0) = 0
+        to obtain an initial guess for the Newton iteration. Rays missing
+        the quadric are intersected with the plane z = z0.
+
+        :param r0: start points in local coordinates (2d numpy 3xN array of float)
+        :param rayDir: directions in local coordinates (2d numpy 3xN array of float)
+        :param curvx, curvy, curvz: quadric coefficients (float)
+        :param z0: vertex position of the quadric (float)
+        :return t: ray parameter (1d numpy array of float)
+        """
+        r0shifted = r0 - np.array([0., 0., z0])[:, np.newaxis]
+        (t, valid) = quadric_intersection(r0shifted, rayDir,
+                                          curvx, curvy, curvz)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tplane = -r0shifted[2]/rayDir[2]
+        t[valid ^ True] = tplane[valid ^ True]
 
-        t = fsolve(Fwrapper, t, args=(r0, rayDir), xtol=self.tol)
+        return t
 
-        globalinter = self.lc.returnLocalToGlobalPoints(r0 + rayDir * t)
+    def intersectNewton(self, r0, rayDir, t, halvings=5):
+        """
+        Solves r0_z + t d_z - F(r0_x + t d_x, r0_y + t d_y) = 0 for every
+        ray independently by Newton iterations with the analytic gradient
+        gradF. Rays are removed from the iteration once their step is
+        below tol. Steps which leave the domain of F are halved.
+
+        :param r0: start points in local coordinates (2d numpy 3xN array of float)
+        :param rayDir: directions in local coordinates (2d numpy 3xN array of float)
+        :param t: initial guess for ray parameters (1d numpy array of float)
+        :param halvings: maximal number of step halvings (int)
+
+        :return t: ray parameters (1d numpy array of float)
+        :return converged: whether Newton converged (1d numpy array of bool)
+        :return numiterations: iterations per ray (1d numpy array of int)
+        :return residual: last residual per ray (1d numpy array of float)
+        """
 
+        def residualfun(t, r0, rayDir):
+            x = r0 + rayDir*t
+            return x[2] - self.F(x[0], x[1])
+
+        t = np.array(t, dtype=float)
+        converged = np.zeros_like(t, dtype=bool)
+        numiterations = np.zeros_like(t, dtype=int)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            residual = residualfun(t, r0, rayDir)
+            active = np.flatnonzero(np.isfinite(residual))
+
+            for _ in range(self.iterations):
+                if len(active) == 0:
+                    break
+
+                (r0a, da, ta) = (r0[:, active], rayDir[:, active], t[active])
+                xa = r0a + da*ta
+                derivative = np.sum(self.gradF(xa[0], xa[1], xa[2])*da,
+                                    axis=0)
+                dt = residual[active]/derivative
+
+                tnew = ta - dt
+                resnew = residualfun(tnew, r0a, da)
+                for _ in range(halvings):
+                    outside = np.isfinite(resnew) ^ True
+                    if not np.any(outside):
+                        break
+                    dt[outside] *= 0.5
+                    tnew[outside] = ta[outside] - dt[outside]
+                    resnew[outside] = residualfun(tnew[outside],
+                                                  r0a[:, outside],
+                                                  da[:, outside])
+
+                t[active] = tnew
+                residual[active] = resnew
+                numiterations[active] += 1
+
+                done = np.abs(dt) < self.tol
+                failed = np.isfinite(resnew) ^ True
+                converged[active[done & (failed ^ True)]] = True
+                active = active[(done | failed) ^ True]
+
+        return (t, converged, numiterations, residual)
 
-        validIndices = np.ones_like(r0[0], dtype=bool)
+    def intersect(self, raybundle):
+        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
+
+        t = self.getIntersectionSeed(r0, rayDir)
+        (t, validIndices, numiterations, residual) = \
+            self.intersectNewton(r0, rayDir, t)
 
+        raybundle.intersection_statistics[self.name] = {
+            "iterations": numiterations,
+            "residual": np.abs(residual)}
+        if len(numiterations) > 0:
+            self.debug("intersection: %d of %d rays converged, "
+                       "mean iterations %.2f, max iterations %d"
+                       % (np.sum(validIndices), len(validIndices),
+                          np.mean(numiterations), np.max(numiterations)))
 
-        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], validIndices)
+        # rays without convergence of the Newton iteration are invalid
+        raybundle.appendIntersection(self.lc, r0 + rayDir * t, validIndices)
 
 
 class ImplicitShape(FreeShape):
@@ -566,6 +698,13 @@ class Asphere(ExplicitShape):
     def getCentralCurvature(self):
         return self.params["curv"].evaluate()
 
+    def getIntersectionSeed(self, r0, rayDir):
+        """
+        Initial guess from the intersection with the base conic.
+        """
+        (curv, cc, _) = self.getAsphereParameters()
+        return self.seedFromQuadric(r0, rayDir, curv, curv, curv*(1+cc))
+
 
 class Biconic(ExplicitShape):
     """
@@ -657,6 +796,16 @@ class Biconic(ExplicitShape):
     def getCentralCurvature(self):
         return 0.5*(self.params["curvx"]() + self.params["curvy"]())
 
+    def getIntersectionSeed(self, r0, rayDir):
+        """
+        Initial guess from the intersection with the quadric which
+        coincides with the base biconic in both principal sections up to
+        second order and is exact for equal curvatures and conic constants.
+        """
+        (curvx, curvy, ccx, ccy, _) = self.getBiconicParameters()
+        curvz = 0.5*(curvx*(1+ccx) + curvy*(1+ccy))
+        return self.seedFromQuadric(r0, rayDir, curvx, curvy, curvz)
+
 class LinearCombination(ExplicitShape):
     """
     Class for combining several principal forms with arbitray corrections
@@ -730,46 +879,34 @@ class XYPolynomials(ExplicitShape):
         self.list_coefficients = [(xpow, ypow) for (xpow, ypow, coefficient) in coefficients]
         initcoeffs = [("normradius", normradius)] + [("CX"+str(xpower)+"Y"+str(ypower), coefficient) for (xpower, ypower, coefficient) in coefficients]
 
-        def xyf(x, y):
-            (normradius, coeffs) = self.getXYParameters()
-
-            res = np.zeros_like(x)
+        self.__coefficient_keys = ["normradius"] +\
+            ["CX"+str(xpow)+"Y"+str(ypow)
+             for (xpow, ypow) in self.list_coefficients]
+        self.__coefficient_cache = (None, None)
 
-            for (xpow, ypow, coefficient) in coeffs:
-                normalization = 1./normradius**(xpow+ypow)
-                res += x**xpow*y**ypow*coefficient*normalization
-            return res
+        def xyf(x, y):
+            (sag, _, _) = self.evaluateXYPolynomial(x, y, derivatives=0)
+            return sag
 
         def gradxyf(x, y, z): # gradient for implicit function z - af(x, y) = 0
             res = np.zeros((3, len(x)))
-            (normradius, coeffs) = self.getXYParameters()
-
-            for (xpow, ypow, coefficient) in coeffs:
-                normalization = 1./normradius**(xpow+ypow)
-                xpm1 = np.where(xpow >= 1, x**(xpow-1), np.zeros_like(x))
-                ypm1 = np.where(ypow >= 1, y**(ypow-1), np.zeros_like(x))
-                res[0, :] += -xpow*xpm1*y**ypow*coefficient*normalization
-                res[1, :] += -ypow*x**xpow*ypm1*coefficient*normalization
-            res[2, :] = 1.
+            (_, (dzdx, dzdy), _) = \
+                self.evaluateXYPolynomial(x, y, derivatives=1)
+
+            res[0] = -dzdx
+            res[1] = -dzdy
+            res[2] = 1.
 
             return res
 
         def hessxyf(x, y, z):
             res = np.zeros((3, 3, len(x)))
+            (_, _, (dzdxx, dzdxy, dzdyy)) = \
+                self.evaluateXYPolynomial(x, y, derivatives=2)
 
-            (normradius, coeffs) = self.getXYParameters()
-
-            for (xpow, ypow, coefficient) in coeffs:
-                normalization = 1./normradius**(xpow+ypow)
-                xpm1 = np.where(xpow >= 1, x**(xpow-1), np.zeros_like(x))
-                ypm1 = np.where(ypow >= 1, y**(ypow-1), np.zeros_like(x))
-                xpm2 = np.where(xpow >= 2, x**(xpow-2), np.zeros_like(x))
-                ypm2 = np.where(ypow >= 2, y**(ypow-2), np.zeros_like(x))
-
-                res[0, 0] += -xpow*(xpow-1)*xpm2*y**ypow*coefficient*normalization
-                res[0, 1] += -xpow*ypow*xpm1*ypm1*coefficient*normalization
-                res[1, 1] += -ypow*(ypow-1)*x**xpow*ypm2*coefficient*normalization
-
+            res[0, 0] = -dzdxx
+            res[0, 1] = -dzdxy
+            res[1, 1] = -dzdyy
             res[1, 0] = res[0, 1]
 
             return res
@@ -783,6 +920,93 @@ class XYPolynomials(ExplicitShape):
         return (self.params["normradius"](),
                 [(xpow, ypow, self.params["CX"+str(xpow)+"Y"+str(ypow)]()) for (xpow, ypow) in self.list_coefficients])
 
+    def getXYCoefficientMatrices(self):
+        """
+        Returns the normalized coefficients as matrix C with
+        f(x, y) = sum_ij C[i, j] x^i y^j together with the matrices of its
+        first and second derivatives (same form, shifted indices).
+        The matrices are cached and only rebuilt if one of the
+        coefficient variables changed.
+
+        :return (C, (Cx, Cy), (Cxx, Cxy, Cyy)) (2d numpy arrays of float)
+        """
+        variables = [self.params[key] for key in self.__coefficient_keys]
+        revisions = tuple(var.getRevision() for var in variables)
+
+        (cached_revisions, matrices) = self.__coefficient_cache
+        if revisions == cached_revisions:
+            return matrices
+
+        (normradius, coeffs) = self.getXYParameters()
+
+        maxxpow = max([0] + [xpow for (xpow, _) in self.list_coefficients])
+        maxypow = max([0] + [ypow for (_, ypow) in self.list_coefficients])
+
+        cmat = np.zeros((maxxpow + 1, maxypow + 1))
+        if coeffs:
+            xpows = np.array([xpow for (xpow, _, _) in coeffs])
+            ypows = np.array([ypow for (_, ypow, _) in coeffs])
+            values = np.array([coefficient for (_, _, coefficient) in coeffs],
+                              dtype=float)
+            np.add.at(cmat, (xpows, ypows),
+                      values/normradius**(xpows + ypows))
+
+        xfactor = np.arange(maxxpow + 1)[:, np.newaxis]
+        yfactor = np.arange(maxypow + 1)[np.newaxis, :]
+
+        cmatx = (xfactor*cmat)[1:, :]
+        cmaty = (yfactor*cmat)[:, 1:]
+        cmatxx = (xfactor[:-1]*cmatx)[1:, :]
+        cmatxy = (yfactor*cmatx)[:, 1:]
+        cmatyy = (yfactor[:, :-1]*cmaty)[:, 1:]
+
+        matrices = (cmat, (cmatx, cmaty), (cmatxx, cmatxy, cmatyy))
+        self.__coefficient_cache = (revisions, matrices)
+
+        return matrices
+
+    def evaluateXYPolynomial(self, x, y, derivatives=2):
+        """
+        Evaluates the polynomial and its derivatives in one pass. The
+        powers of x and y are tabulated once up to the maximal degree and
+        contracted with the cached coefficient matrices.
+
+        :param x, y: local coordinates (1d numpy array of float)
+        :param derivatives: highest order of derivatives to evaluate (int)
+
+        :return (sag, (dzdx, dzdy), (dzdxx, dzdxy, dzdyy))
+                entries for orders above derivatives are None
+        """
+        (cmat, (cmatx, cmaty), (cmatxx, cmatxy, cmatyy)) = \
+            self.getXYCoefficientMatrices()
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        xpowers = np.ones((cmat.shape[0],) + x.shape)
+        for i in range(1, cmat.shape[0]):
+            xpowers[i] = xpowers[i - 1]*x
+        ypowers = np.ones((cmat.shape[1],) + y.shape)
+        for j in range(1, cmat.shape[1]):
+            ypowers[j] = ypowers[j - 1]*y
+
+        def contract(mat):
+            (numx, numy) = mat.shape
+            if numx == 0 or numy == 0:
+                return np.zeros_like(x)
+            return np.sum(xpowers[:numx] *
+                          np.tensordot(mat, ypowers[:numy], axes=1), axis=0)
+
+        sag = contract(cmat)
+        grad = (None, None)
+        hess = (None, None, None)
+        if derivatives >= 1:
+            grad = (contract(cmatx), contract(cmaty))
+        if derivatives >= 2:
+            hess = (contract(cmatxx), contract(cmatxy), contract(cmatyy))
+
+        return (sag, grad, hess)
+
 
 class GridSag(ExplicitShape):
     """
@@ -832,46 +1056,207 @@ class Zernike(ExplicitShape):
     Class for Zernike
     """
 
+    # coefficients of the radial polynomials per (n, |m|)
+    radial_coefficient_cache = {}
+
     def __init__(self, lc, normradius=1., coefficients=None, **kwargs):
         if coefficients is None:
             coefficients = []
 
         self.numcoefficients = len(coefficients)
         initcoeffs = [("Z"+str(i+1), val) for (i, val) in enumerate(coefficients)]
+        self.__zernike_table = None
 
         def zf(x, y):
-            (normradius, zcoefficients) = self.getZernikeParameters()
-            res = np.zeros_like(x)
-            for (num, val) in enumerate(zcoefficients):
-                res += val*self.zernike_norm_j(num + 1, x/normradius, y/normradius)
-
-            return res
+            (sag, _, _) = self.evaluateZernikeExpansion(x, y, derivatives=0)
+            return sag
 
         def gradzf(x, y, z):
-            (normradius, zcoefficients) = self.getZernikeParameters()
             res = np.zeros((3, len(x)))
-            xp = x/normradius
-            yp = y/normradius
-
-            for (num, val) in enumerate(zcoefficients):
-                (dZdxp, dZdyp) = self.gradzernike_norm_j(num + 1, xp, yp)
-                res[0] += -val*dZdxp/normradius
-                res[1] += -val*dZdyp/normradius
+            (_, (dzdx, dzdy), _) = \
+                self.evaluateZernikeExpansion(x, y, derivatives=1)
 
+            res[0] = -dzdx
+            res[1] = -dzdy
             res[2] = 1.
 
             return res
 
         def hesszf(x, y, z):
-            return np.zeros((3, 3, len(x)))
+            res = np.zeros((3, 3, len(x)))
+            (_, _, (dzdxx, dzdxy, dzdyy)) = \
+                self.evaluateZernikeExpansion(x, y, derivatives=2)
+
+            res[0, 0] = -dzdxx
+            res[0, 1] = res[1, 0] = -dzdxy
+            res[1, 1] = -dzdyy
+
+            return res
 
         super(Zernike, self).__init__(lc, zf, gradzf, hesszf, \
             paramlist=([("normradius", normradius)]+initcoeffs), **kwargs)
 
+    def getRadialCoefficients(self, n, m):
+        """
+        Coefficients of the polynomial P with R_n^m(r) = r^|m| P(r^2),
+        ascending in powers of r^2. They are cached per (n, |m|).
+
+        :param n: radial order (int)
+        :param m: azimuthal order (int)
+        :return coefficients: (1d numpy array of float)
+        """
+        omega = abs(m)
+        key = (n, omega)
+        if key not in Zernike.radial_coefficient_cache:
+            coefficients = np.zeros((n - omega)//2 + 1)
+            if (n - omega) % 2 == 0:
+                for k in range(len(coefficients)):
+                    # coefficient of r^(omega + 2k)
+                    l = (n - omega)//2 - k
+                    coefficients[k] = (-1)**l*math.factorial(n - l)/(
+                        math.factorial(l) *
+                        math.factorial((n + omega)//2 - l) *
+                        math.factorial((n - omega)//2 - l))
+            Zernike.radial_coefficient_cache[key] = coefficients
+        return Zernike.radial_coefficient_cache[key]
+
+    def getZernikeTable(self):
+        """
+        Table of all terms: every term belongs to a group with common
+        azimuthal order |m| and angular function (cos for m >= 0,
+        sin for m < 0). Terms of one group share w^|m| with w = x + iy.
+
+        :return (omegas, sines, groupindices, radialtable):
+                omegas, sines per group (1d numpy arrays of int, bool),
+                group index per term (1d numpy array of int),
+                radial coefficients per term (2d numpy array of float)
+        """
+        if self.__zernike_table is None or \
+                len(self.__zernike_table[2]) != self.numcoefficients:
+            nms = [self.jtonm(j + 1) for j in range(self.numcoefficients)]
+            groups = sorted(set([(abs(m), m < 0) for (n, m) in nms]))
+            groupindices = np.array(
+                [groups.index((abs(m), m < 0)) for (n, m) in nms], dtype=int)
+            radials = [self.getRadialCoefficients(n, m) for (n, m) in nms]
+            radialtable = np.zeros((len(nms),
+                                    max([len(r) for r in radials] + [1])))
+            for (j, radial) in enumerate(radials):
+                radialtable[j, :len(radial)] = radial
+            self.__zernike_table = (
+                np.array([omega for (omega, _) in groups], dtype=int),
+                np.array([sine for (_, sine) in groups], dtype=bool),
+                groupindices,
+                radialtable)
+        return self.__zernike_table
+
+    def evaluateZernikeExpansion(self, x, y, derivatives=2):
+        """
+        Evaluates the sum of all Zernike terms and its derivatives in one
+        pass. Every term is written as Re or Im of P(rho) w^|m| with
+        rho = xp^2 + yp^2 and w = xp + i yp, where P is evaluated by
+        Horner's scheme in rho for all terms with common |m| at once.
+        This avoids arctan2, sqrt and divisions by r.
+
+        :param x: x coordinates (numpy array of float)
+        :param y: y coordinates (numpy array of float)
+        :param derivatives: highest order of derivatives (0, 1 or 2)
+
+        :return (sag, (dzdx, dzdy), (dzdxx, dzdxy, dzdyy)),
+                derivatives not requested are None
+        """
+        (normradius, zcoefficients) = self.getZernikeParameters()
+        (omegas, sines, groupindices, radialtable) = self.getZernikeTable()
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        xp = x/normradius
+        yp = y/normradius
+        rho = xp**2 + yp**2
+        w = xp + 1j*yp
+
+        numgroups = len(omegas)
+        # polynomial coefficients per group (ascending in rho)
+        groupcoefficients = np.zeros((numgroups, np.shape(radialtable)[1]))
+        np.add.at(groupcoefficients, groupindices,
+                  np.array(zcoefficients)[:, np.newaxis]*radialtable)
+
+        def horner(coefficients):
+            result = np.zeros((numgroups,) + np.shape(rho))
+            for k in range(np.shape(coefficients)[1] - 1, -1, -1):
+                result = result*rho + \
+                    coefficients[:, k].reshape((numgroups,) +
+                                               (1,)*np.ndim(rho))
+            return result
+
+        def derivative(coefficients):
+            return coefficients[:, 1:]*np.arange(1, np.shape(coefficients)[1])
+
+        # w^k for k = 0 .. max(|m|)
+        wpowers = np.ones((max(list(omegas) + [0]) + 1,) + np.shape(w),
+                          dtype=complex)
+        for k in range(1, len(wpowers)):
+            wpowers[k] = wpowers[k - 1]*w
+
+        shape = (numgroups,) + (1,)*np.ndim(rho)
+        om = omegas.reshape(shape)
+        w0 = wpowers[omegas]
+        w1 = wpowers[np.maximum(omegas - 1, 0)]
+        w2 = wpowers[np.maximum(omegas - 2, 0)]
+
+        def select(u, scale):
+            return np.sum(np.where(sines.reshape(shape), u.imag, u.real),
+                          axis=0)*scale
+
+        p0 = horner(groupcoefficients)
+        sag = select(p0*w0, 1.)
+        grad = None
+        hess = None
+
+        if derivatives >= 1:
+            dcoefficients = derivative(groupcoefficients)
+            p1 = horner(dcoefficients)
+            ux = 2.*xp*p1*w0 + om*p0*w1
+            uy = 2.*yp*p1*w0 + 1j*om*p0*w1
+            grad = (select(ux, 1./normradius), select(uy, 1./normradius))
+
+        if derivatives >= 2:
+            p2 = horner(derivative(dcoefficients))
+            om2 = om*(om - 1)
+            uxx = 2.*p1*w0 + 4.*xp**2*p2*w0 + 4.*xp*om*p1*w1 + om2*p0*w2
+            uyy = 2.*p1*w0 + 4.*yp**2*p2*w0 + 4j*yp*om*p1*w1 - om2*p0*w2
+            uxy = 4.*xp*yp*p2*w0 + 2j*xp*om*p1*w1 + 2.*yp*om*p1*w1 + \
+                1j*om2*p0*w2
+            hess = (select(uxx, 1./normradius**2),
+                    select(uxy, 1./normradius**2),
+                    select(uyy, 1./normradius**2))
+
+        return (sag, grad, hess)
+
     def getZernikeParameters(self):
         return (self.params["normradius"](), \
                 [self.params["Z"+str(i+1)]() for i in range(self.numcoefficients)])
 
+    def getVertexSagAndCurvature(self):
+        """
+        Sag and mean curvature at the vertex.
+        """
+        (sag, _, (dzdxx, _, dzdyy)) = \
+            self.evaluateZernikeExpansion(np.zeros(1), np.zeros(1))
+
+        return (sag[0], 0.5*(dzdxx[0] + dzdyy[0]))
+
+    def getCentralCurvature(self):
+        (_, curv) = self.getVertexSagAndCurvature()
+        return curv
+
+    def getIntersectionSeed(self, r0, rayDir):
+        """
+        Initial guess from the intersection with the vertex sphere
+        (including piston).
+        """
+        (z0, curv) = self.getVertexSagAndCurvature()
+        return self.seedFromQuadric(r0, rayDir, curv, curv, curv, z0=z0)
+
 
     def jtonm(self, j):
         """
@@ -886,109 +1271,15 @@ class Zernike(ExplicitShape):
         (n, m) = xxx_todo_changeme1
         raise NotImplementedError()
 
-    """
-    def radial_coefficients(self, n, m):
-        omega = abs(m)
-        k = np.arange(0, (n-omega)//2)
-        print(k)
-        return (-1)**k * factorial(n-k) / ( factorial(k) * factorial((n+m)/2 - k) * factorial((n-m)/2-k) );
-    """
-    def rc(self, n, m, l):
-        return (-1.)**l*factorial(n - l)/(factorial(l)*factorial((n+m)/2.0 - l)*factorial((n-m)/2.0 - l))
-
-    def radialfunction_norm2(self, n, m, xp, yp):
-        # TODO: perform lookup table for radial functions coefficients
-        # TODO: examine possibility of looking up zernike functions directly
-
-        rho = np.sqrt(xp**2 + yp**2)
-        omega = abs(m)
-
-        final = np.zeros_like(rho)
-
-        for l in range((n - omega)//2 + 1):
-            final += self.rc(n, omega, l)*rho**(n-2.*l)
-        return final
-
-    def radialfunction_norm(self, n, m, xp, yp):
-        rho = np.sqrt(xp**2 + yp**2)
-        omega = abs(m)
-        sumlimit = (n-omega)//2
-        return (-1)**sumlimit*rho**omega*jacobi(sumlimit, omega, 0)(1. - 2.*rho**2)
-
-    def radialfunction_norm_rho_derivative(self, n, m, xp, yp):
-        # TODO: remove code doubling
-
-        rho = np.sqrt(xp**2 + yp**2)
-        omega = abs(m)
-
-        final = np.zeros_like(rho)
-
-        for l in range((n - omega)//2 + 1):
-            final += (n - 2.*l)*self.rc(n, omega, l)*rho**(n-2.*l - 1)
-        return final
-
-
-    def angularfunction_norm(self, n, m, xp, yp):
-        omega = abs(m)
-        phi = np.arctan2(yp, xp)
-        return np.where(m < 0, np.sin(omega*phi), np.cos(omega*phi))
-
-    def angularfunction_norm_phi_derivative(self, n, m, xp, yp):
-        omega = abs(m)
-        phi = np.arctan2(yp, xp)
-        return np.where(m < 0, omega*np.cos(omega*phi), -omega*np.sin(omega*phi))
-
-
     def zernike_norm_j(self, j, xp, yp):
+        """
+        Single Zernike term j at normalized coordinates xp, yp.
+        """
         (n, m) = self.jtonm(j)
-        return self.zernike_norm(n, m, xp, yp)
-
-    def zernike_norm2(self, n, m, xp, yp):
-        return self.radialfunction_norm(n, m, xp, yp)*self.angularfunction_norm(n, m, xp, yp)
-
-    def zernike_norm(self, n, m, xp, yp):
-
-
-        R = np.zeros(n+1)
-        omega = abs(m)
-
-        a = np.arange(omega, n+1, 2)
-        k = (n-a)/2
-
-        R[a] = (-1)**k * factorial(n-k) / ( factorial(k) * factorial((n+m)/2 - k) * factorial((n-m)/2-k) )
-
-        r = np.sqrt(xp**2 + yp**2)
-        phi = np.arctan2(yp, xp)
-
-        rho = np.zeros_like(r)
-
-        for i in range(n+1):
-            rho += R[i]*r**i
-
-        result = np.zeros_like(rho)
-        if m < 0:
-            result = rho*np.sin(omega*phi)
-        else:
-            result = rho*np.cos(omega*phi)
-
-        return result
-
-
-    def gradzernike_norm(self, n, m, xp, yp):
-        radder = self.radialfunction_norm_rho_derivative(n, m, xp, yp)
-        angder = self.angularfunction_norm_phi_derivative(n, m, xp, yp)
-        rad = self.radialfunction_norm(n, m, xp, yp)
-        ang = self.angularfunction_norm(n, m, xp, yp)
-        rho = np.sqrt(xp**2 + yp**2)
-        dZdxp = (radder*ang*xp + rad*angder*(-yp))/rho
-        dZdyp = (radder*ang*yp + rad*angder*xp)/rho
-
-        return (dZdxp, dZdyp)
-
-    def gradzernike_norm_j(self, j, xp, yp):
-        (n, m) = self.jtonm(j)
-
-        return self.gradzernike_norm(n, m, xp, yp)
+        radial = np.polyval(self.getRadialCoefficients(n, m)[::-1],
+                            xp**2 + yp**2)
+        w = (xp + complex(0, 1)*yp)**abs(m)
+        return radial*(w.imag if m < 0 else w.real)
 
 
 class ZernikeFringe(Zernike):
@@ -1133,7 +1424,15 @@ class ZMXDLLShape(Conic):
             gcc -c -fpic -o us_stand.o us_stand.c -lm
             gcc -shared -o us_stand.so us_stand.o
 
+        If the DLL additionally exports
+
+            int UserDefinedSurfaceBatch(int num, USER_DATA *UD,
+                                        FIXED_DATA *FD, int *ret)
 
+        which calls UserDefinedSurface(&UD[i], FD) and stores its return
+        value in ret[i] for all i < num, all rays are passed to the DLL
+        in one call. Otherwise UserDefinedSurface is called per ray on
+        the same preallocated array of USER_DATA structs.
         """
         super(ZMXDLLShape, self).__init__(lc,
                                           curv=curv,
@@ -1153,6 +1452,28 @@ class ZMXDLLShape(Conic):
         for (key, (value_int, value_float)) in xdata_dict.items():
             self.xdata[value_int] = OptimizableVariable(name="xdata"+str(value_int), value=value_float)
         self.us_surf = self.dll.UserDefinedSurface
+        self.us_surf.restype = ctypes.c_int
+
+        # numpy equivalent of the USER_DATA struct, such that the input
+        # and output fields of all rays can be accessed as arrays
+        self.user_data_dtype = np.dtype({
+            "names": [name for (name, _) in USER_DATA._fields_],
+            "formats": [np.dtype(ctype) for (_, ctype) in USER_DATA._fields_],
+            "offsets": [getattr(USER_DATA, name).offset
+                        for (name, _) in USER_DATA._fields_],
+            "itemsize": ctypes.sizeof(USER_DATA)})
+
+        self.us_surf_batch = getattr(self.dll, "UserDefinedSurfaceBatch",
+                                     None)
+        if self.us_surf_batch is not None:
+            self.us_surf_batch.restype = ctypes.c_int
+            self.us_surf_batch.argtypes = [
+                ctypes.c_int,
+                np.ctypeslib.ndpointer(dtype=self.user_data_dtype,
+                                       ndim=1, flags="C_CONTIGUOUS"),
+                ctypes.POINTER(FIXED_DATA),
+                np.ctypeslib.ndpointer(dtype=np.intc,
+                                       ndim=1, flags="C_CONTIGUOUS")]
 
     def writeParam(self, f):
         for (key, var) in self.param.items():
@@ -1164,73 +1485,109 @@ class ZMXDLLShape(Conic):
             f.xdata[key] = var()
         return f
 
-    def intersect(self, raybundle):
-        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
+    def getFixedData(self, datatype, wavelength=None):
+        """
+        Fills FIXED_DATA struct for a request to the DLL.
 
-        intersection = np.zeros_like(r0)
+        :param datatype: requested data type (int), i.e. 3 sag, 5 ray trace
+        :param wavelength: wavelength in mm (float or None)
 
-        u = USER_DATA()
+        :return f: (FIXED_DATA object)
+        """
         f = FIXED_DATA()
 
-        f.type = 5 # ask for intersection
-        f.k = self.cc()
+        f.type = datatype
+        f.k = self.conic()
         f.cv = self.curvature()
-        f.wavelength = raybundle.wave
-
+        if wavelength is not None:
+            f.wavelength = wavelength
 
         f = self.writeParam(f)
         f = self.writeXdata(f)
 
+        return f
 
-        x = r0[0, :]
-        y = r0[1, :]
-        z = r0[2, :]
+    def callUserDefinedSurface(self, f, **inputs):
+        """
+        Calls UserDefinedSurface of the DLL for all rays at once.
 
-        l = rayDir[0, :]
-        m = rayDir[1, :]
-        n = rayDir[2, :]
+        :param f: request (FIXED_DATA object)
+        :param inputs: fields of USER_DATA, e.g. x=..., y=...
+                       (1d numpy arrays of float of common length)
 
-        for (ind, (xl, yl, zl, ll, ml, nl)) in zip(x.tolist(), y.tolist(), z.tolist(), l.tolist(), m.tolist(), n.tolist()):
+        :return u: USER_DATA of all rays after the call (structured
+                   1d numpy array, fields accessible by name)
+        :return retval: return values of the calls (1d numpy array of int)
+        """
+        num = len(next(iter(inputs.values())))
 
-            u.x = xl
-            u.y = yl
-            u.z = zl
-            u.l = ll
-            u.m = ml
-            u.n = nl
+        u = np.zeros(num, dtype=self.user_data_dtype)
+        for (key, value) in inputs.items():
+            u[key] = value
+        retval = np.zeros(num, dtype=np.intc)
 
-            self.us_surf(ctypes.byref(u), ctypes.byref(f))
+        if num == 0:
+            return (u, retval)
 
-            intersection[0, ind] = u.x
-            intersection[1, ind] = u.y
-            intersection[2, ind] = u.z
+        if self.us_surf_batch is not None:
+            self.us_surf_batch(num, u, ctypes.byref(f), retval)
+        else:
+            fref = ctypes.byref(f)
+            address = u.ctypes.data
+            size = u.itemsize
+            for ind in range(num):
+                retval[ind] = self.us_surf(ctypes.c_void_p(address +
+                                                           ind*size),
+                                           fref)
 
+        return (u, retval)
 
-        globalinter = self.lc.returnLocalToGlobalPoints(intersection)
+    def intersect(self, raybundle):
+        (r0, rayDir) = self.getLocalRayBundleForIntersect(raybundle)
 
-        raybundle.append(globalinter, raybundle.k[-1], raybundle.Efield[-1], raybundle.valid[-1])
+        # FIXED_DATA holds one wavelength, therefore polychromatic
+        # bundles are passed to the DLL in one call per wavelength
+        waves = np.broadcast_to(raybundle.wave, np.shape(r0[0]))
 
-    def getSag(self, x, y):
-        u = USER_DATA()
-        f = FIXED_DATA()
+        intersection = np.zeros_like(r0)
+        validIndices = np.zeros(np.shape(r0[0]), dtype=bool)
 
-        f.type = 3 # ask for sag
-        f.k = self.cc()
-        f.cv = self.curvature()
+        for wavelength in np.unique(waves):
+            f = self.getFixedData(5, wavelength=wavelength) # ask for intersection
+            selection = waves == wavelength
+
+            (u, retval) = self.callUserDefinedSurface(
+                f,
+                x=r0[0, selection], y=r0[1, selection], z=r0[2, selection],
+                l=rayDir[0, selection], m=rayDir[1, selection],
+                n=rayDir[2, selection])
 
+            intersection[:, selection] = np.array([u["x"], u["y"], u["z"]])
+            validIndices[selection] = retval == 0
 
-        #f = self.writeParam(f)
-        #f = self.writeXdata(f)
+        raybundle.appendIntersection(self.lc, intersection, validIndices)
 
-        z = np.zeros_like(x)
+    def getSag(self, x, y):
+        f = self.getFixedData(3) # ask for sag
 
-        for (ind, (xp, yp)) in enumerate(zip(x.tolist(), y.tolist())):
-            u.x = xp
-            u.y = yp
-            retval = self.us_surf(ctypes.byref(u), ctypes.byref(f))
-            z[ind] = u.sag1 if retval == 0 else u.sag2
+        (u, retval) = self.callUserDefinedSurface(f, x=x, y=y)
 
-        return z
+        return np.where(retval == 0, u["sag1"], u["sag2"])
+
+    def getNormal(self, x, y):
+        """
+        Normal obtained from a ray trace request for rays parallel
+        to the z axis through (x, y).
+        """
+        f = self.getFixedData(5) # ask for intersection and normal
+
+        x = np.asarray(x, dtype=float)
+        (u, retval) = self.callUserDefinedSurface(
+            f,
+            x=x, y=y, z=np.zeros_like(x),
+            l=np.zeros_like(x), m=np.zeros_like(x), n=np.ones_like(x))
+
+        return np.array([u["ln"], u["mn"], u["nn"]])
 
 if __name__=="__main__":
 
@@ -1268,7 +1625,7 @@ if __name__=="__main__":
     fig = plt.figure()
     for ind in range(36):
         j = ind+1
-        Zf = sz.zernike_norm(j, XN.flatten(), YN.flatten())
+        Zf = sz.zernike_norm_j(j, XN.flatten(), YN.flatten())
         ZN = Zf.reshape(np.shape(XN))
         ax = fig.add_subplot(9, 4, j)
         ZN[XN**2 + YN**2 > 1] = np.nan
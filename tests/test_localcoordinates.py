@@ -30,6 +30,9 @@ from hypothesis.strategies import floats, integers
 from hypothesis.extra.numpy import arrays
 import numpy as np
 from pyrateoptics.raytracer.localcoordinates import LocalCoordinates
+from pyrateoptics.raytracer.optical_system import OpticalSystem
+from pyrateoptics.core.base import OptimizableVariable
+from pyrateoptics.core.configmanager import ConfigManager
 
 # pylint: disable=no-value-for-parameter
 @given(parameter=integers())
@@ -210,3 +213,112 @@ def inverse_coordinate(dec_x, dec_y, dec_z, tilt_x, tilt_y, tilt_z):
                                                 tiltz=-tilt_z,
                                                 tiltThenDecenter=1))
     assert np.allclose(system4.globalcoordinates, 0)
+
+
+def test_lazy_update():
+    """
+    Setting a tilt/decenter variable updates only the subtree below it
+    and needs no explicit update().
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1", decz=1.0))
+    system2 = system1.addChild(LocalCoordinates(name="2", decz=2.0,
+                                                tiltx=0.1))
+    system3 = root.addChild(LocalCoordinates(name="3", decy=5.0))
+
+    assert np.allclose(system2.globalcoordinates, [0, 0, 3.0])
+    stamp1 = system1.getFrameStamp()
+    stamp3 = system3.getFrameStamp()
+
+    system1.decz.setvalue(4.0)
+    system1.tiltx.setvalue(math.pi/2.)
+    assert np.allclose(system2.globalcoordinates, [0, -2.0, 4.0])
+    assert np.allclose(system2.localbasis,
+                       np.dot(system1.localbasis,
+                              system2.calculateMatrixFromTilt(0.1, 0., 0.)))
+    assert system1.getFrameStamp() != stamp1
+    assert system3.getFrameStamp() == stamp3
+
+    system2.tiltThenDecenter = 1
+    assert np.allclose(system2.globalcoordinates,
+                       system1.globalcoordinates +
+                       np.dot(system2.localbasis, [0, 0, 2.0]))
+
+
+def test_replaced_variables():
+    """
+    Frames follow variables which are replaced instead of set, also for
+    the multi configurations of the config manager.
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1", decz=5.0))
+    assert np.allclose(system1.globalcoordinates, [0, 0, 5.0])
+    root.decz = OptimizableVariable(name="decz", value=1.0)
+    assert np.allclose(system1.globalcoordinates, [0, 0, 6.0])
+    root.resetVariable("root.decz",
+                       OptimizableVariable(name="decz", value=2.0))
+    assert np.allclose(system1.globalcoordinates, [0, 0, 7.0])
+
+    system = OpticalSystem(name="s")
+    system.rootcoordinatesystem.addChild(LocalCoordinates(name="1",
+                                                          decz=5.0))
+    manager = ConfigManager(system, name="mc")
+    configs = manager.setOptimizableVariables(
+        ("s2", "s3"), {"s.global.decz": (("fixed", 2.0), ("fixed", 3.0))})
+    for (config, decz) in zip(configs, [2.0, 3.0]):
+        lcroot = config.rootcoordinatesystem
+        assert np.allclose(lcroot.globalcoordinates, [0, 0, decz])
+        assert np.allclose(lcroot.children[0].globalcoordinates,
+                           [0, 0, decz + 5.0])
+
+
+def test_tree_index():
+    """
+    Reference lookups and connection checks via the tree index.
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1"))
+    subtree = LocalCoordinates(name="sub")
+    system2 = subtree.addChild(LocalCoordinates(name="2"))
+    system3 = root.addChildToReference("1", subtree)
+    assert system3 is subtree
+    system4 = root.addChildToReference("2", LocalCoordinates(name="4"))
+    other = LocalCoordinates(name="other")
+
+    assert root.returnConnectedNames() == ["root", "1", "sub", "2", "4"]
+    assert all(root.isConnected(lc)
+               for lc in [root, system1, subtree, system2, system4])
+    assert not root.isConnected(other)
+    assert system1.isConnected(system4)
+    assert not subtree.isConnected(system1)
+    assert root.returnConnectedByName("4") == [system4]
+
+    system4.name = "renamed"
+    assert root.returnConnectedByName("4") == []
+    assert root.returnConnectedByName("renamed") == [system4]
+
+
+def test_affine_transform():
+    """
+    Precomposed frame to frame transforms agree with the transformation
+    via global coordinates and follow changes of the frames.
+    """
+    root = LocalCoordinates(name="root")
+    system1 = root.addChild(LocalCoordinates(name="1", decz=3.0,
+                                             tiltx=0.3))
+    system2 = system1.addChild(LocalCoordinates(name="2", decx=-1.0,
+                                                tiltz=0.7))
+    system3 = root.addChild(LocalCoordinates(name="3", decy=5.0,
+                                             tilty=-0.2,
+                                             tiltThenDecenter=1))
+    points = np.random.random((3, 10))
+    for value in [0.3, -0.5]:
+        system1.tiltx.setvalue(value)
+        assert np.allclose(
+            system2.returnActualToOtherPoints(points, system3),
+            system3.returnGlobalToLocalPoints(
+                system2.returnLocalToGlobalPoints(points)))
+        assert np.allclose(
+            system2.returnOtherToActualDirections(points, system3),
+            system2.returnGlobalToLocalDirections(
+                system3.returnLocalToGlobalDirections(points)))
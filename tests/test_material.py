@@ -24,13 +24,23 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import pytest
 from hypothesis import given
 from hypothesis.strategies import floats
 from hypothesis.extra.numpy import arrays
 import numpy as np
+import scipy.linalg as sla
 import sympy
 from pyrateoptics.raytracer.localcoordinates import LocalCoordinates
 from pyrateoptics.material.material_anisotropic import AnisotropicMaterial
+from pyrateoptics.material.material_isotropic import (ModelGlass,
+                                                      ConstantIndexGlass)
+from pyrateoptics.material.material_grin import IsotropicGrinMaterial
+from pyrateoptics.material.material_glasscat import (
+    CatalogMaterial, refractiveindex_dot_info_glasscatalog)
+from pyrateoptics.raytracer.surface import Surface
+from pyrateoptics.raytracer.surface_shape import Conic
+from pyrateoptics.raytracer.ray import RayBundle
 
 @given(rnd_data1=arrays(np.float, (3, 3), elements=floats(0, 1)),
        rnd_data2=arrays(np.float, (3, 3), elements=floats(0, 1)),
@@ -302,3 +312,423 @@ def test_anisotropic_xi_eigenvectors(rnd_data1, rnd_data2, rnd_data3,
                  + Cmatrix[:, :, j]*eigenvalues[k, j]
                  + Kmatrix[:, :, j]), eigenvectors[k, :, j])
     assert np.allclose(should_be_zero, 0)
+
+def test_anisotropic_batched_xi_eigenvalues():
+    """
+    Check whether the batched solution of all generalized eigenvalue
+    problems agrees with solving them one by one.
+    """
+    np.random.seed(1234)
+    num_pts = 50
+    lc = LocalCoordinates("1")
+    myeps = np.random.rand(3, 3) + complex(0, 1)*np.random.rand(3, 3)
+    m = AnisotropicMaterial(lc, myeps)
+    n = np.random.randn(3, num_pts)
+    n = n/np.sqrt(np.sum(n*n, axis=0))
+    x = np.zeros((3, num_pts))
+    k = np.random.randn(3, num_pts) + complex(0, 1)*np.random.randn(3, num_pts)
+    kpa = k - np.sum(n * k, axis=0)*n
+    ((Amatrix6x6, Bmatrix6x6), _) = m.calcXiQEVMatricesNorm(x, n, kpa)
+    (eigenvalues, _) = m.calcXiEigenvectorsNorm(x, n, kpa)
+    for j in range(num_pts):
+        (w, _) = sla.eig(Amatrix6x6[:, :, j], b=Bmatrix6x6[:, :, j])
+        w = w[np.isfinite(w)]
+        w = w[np.abs(w).argsort()][:4]
+        assert np.allclose(np.sort_complex(w),
+                           np.sort_complex(eigenvalues[:, j]))
+
+def test_anisotropic_quartic_xi_solver():
+    """
+    Check whether the quartic backend reproduces the sorted k vectors and
+    E-field directions of the generalized eigenvalue backend.
+    """
+    np.random.seed(4321)
+    num_pts = 100
+    lc = LocalCoordinates("1")
+    myeps = np.diag([2.2, 2.4, 2.9]) + complex(0, 0.01)*np.eye(3)
+    m_eig = AnisotropicMaterial(lc, myeps, xi_solver="eig")
+    m_quartic = AnisotropicMaterial(lc, myeps, xi_solver="quartic")
+    n = np.random.randn(3, num_pts)
+    n = n/np.sqrt(np.sum(n*n, axis=0))
+    x = np.zeros((3, num_pts))
+    k = np.random.randn(3, num_pts)
+    kpa = k - np.sum(n * k, axis=0)*n
+    (k_eig, e_eig) = m_eig.sortKnormEField(x, n, kpa, n)
+    (k_quartic, e_quartic) = m_quartic.sortKnormEField(x, n, kpa, n)
+    assert np.allclose(k_eig, k_quartic)
+    # eigenvectors are only determined up to a complex phase
+    assert np.allclose(np.abs(np.sum(np.conj(e_eig)*e_quartic, axis=1)),
+                       np.sqrt(np.sum(np.abs(e_eig)**2, axis=1) *
+                               np.sum(np.abs(e_quartic)**2, axis=1)))
+
+
+def test_isotropic_default_polarization():
+    """
+    The degenerate E-field eigenvectors of an isotropic material are
+    chosen deterministically: the default polarization is the projection
+    of ex (of ey for k along x) onto the plane perpendicular to k.
+    """
+    lc = LocalCoordinates("1")
+    m = ConstantIndexGlass(lc, n=1.5)
+    angles = np.array([0., 1., 15., 20., -20., 0., 90., 90.])*np.pi/180.
+    kd = np.array([np.zeros_like(angles), np.sin(angles), np.cos(angles)])
+    kd[:, 5] = [np.sin(0.2), 0., np.cos(0.2)]
+    kd[:, 7] = [1., 0., 0.]
+    x = np.zeros_like(kd)
+    (_, efield) = m.sortKnormUnitEField(x, kd, kd)
+
+    expected = np.zeros_like(kd)
+    expected[0] = 1.
+    expected[:, 7] = [0., 1., 0.]
+    expected -= np.sum(expected*kd, axis=0)*kd
+    expected /= np.sqrt(np.sum(expected**2, axis=0))
+    assert np.allclose(efield[2], expected)
+    assert np.allclose(np.sum(np.conj(efield[2])*efield[3], axis=0), 0.)
+    assert np.allclose(np.sum(efield[3]*kd, axis=0), 0.)
+
+
+def test_polychromatic_refraction():
+    """
+    Refraction of a bundle with per ray wavelengths equals refraction
+    of the monochromatic bundles.
+    """
+    lc = LocalCoordinates(name="root")
+    surface = Surface(lc, shape=Conic(lc, curv=0.02))
+    glass = ModelGlass(lc)
+
+    num_rays = 20
+    waves = [0.4861e-3, 0.5876e-3, 0.6563e-3]
+    np.random.seed(5678)
+    x0 = np.zeros((3, num_rays))
+    x0[0:2] = 10.*np.random.random((2, num_rays)) - 5.
+    x0[2] = surface.shape.getSag(x0[0], x0[1])
+    k0 = np.zeros((3, num_rays))
+    k0[0:2] = 0.6*np.random.random((2, num_rays)) - 0.3
+    k0[2] = np.sqrt(1. - np.sum(k0[0:2]**2, axis=0))
+
+    polybundle = RayBundle(np.tile(x0, 3), np.tile(k0, 3), None,
+                           wave=np.repeat(waves, num_rays))
+    (polyrefracted,) = glass.refract(polybundle, surface)
+
+    assert np.allclose(polyrefracted.wave, np.repeat(waves, num_rays))
+    for (ind, wave) in enumerate(waves):
+        (refracted,) = glass.refract(RayBundle(x0, k0, None, wave=wave),
+                                     surface)
+        assert np.allclose(
+            polyrefracted.k[-1][:, ind*num_rays:(ind + 1)*num_rays],
+            refracted.k[-1])
+
+
+def test_anisotropic_split_pruning():
+    """
+    Rays of an eigenstate which carries (almost) no energy are pruned
+    at the split and counted in the pruning statistics.
+    """
+    lc = LocalCoordinates(name="root")
+    surface = Surface(lc, shape=Conic(lc, curv=0.0), name="crystalsurf")
+    # uniaxial crystal with optical axis in x direction
+    myeps = np.diag([1.6**2, 1.5**2, 1.5**2])
+    crystal = AnisotropicMaterial(lc, myeps, pruning_threshold=0.01)
+
+    num_rays = 10
+    x0 = np.zeros((3, num_rays))
+    x0[1] = np.linspace(-1., 1., num_rays)
+    k0 = np.zeros((3, num_rays))
+    k0[2] = 1.
+    # E-field perpendicular to optical axis: ordinary rays only
+    efield0 = np.zeros((3, num_rays))
+    efield0[1] = 1.
+    # except for the last three rays with E-field at 45 degrees
+    efield0[0, -3:] = 1.
+
+    (split,) = crystal.refract(RayBundle(x0, k0, efield0), surface)
+    raybundle = RayBundle(x0, k0, efield0)
+    split_paths = crystal.refract(raybundle, surface, splitup=True)
+    statistics = raybundle.pruning_statistics["crystalsurf"]
+
+    assert statistics["rays"] == num_rays
+    assert sorted(statistics["pruned"]) == [0, num_rays - 3]
+    assert len(split.rayID) == num_rays + 3
+    assert len(split_paths) == 2
+    assert sorted([len(rb.rayID) for rb in split_paths]) == [3, num_rays]
+
+    crystal.pruning_threshold = 0.0
+    (unpruned,) = crystal.refract(RayBundle(x0, k0, efield0), surface)
+    assert len(unpruned.rayID) == 2*num_rays
+
+    efield0[0, -3:] = 0.
+    raybundle = RayBundle(x0, k0, efield0)
+    crystal.pruning_threshold = 0.01
+    assert len(crystal.refract(raybundle, surface, splitup=True)) == 1
+
+
+def test_grin_integrator():
+    """
+    GRIN integration gives the same rays for single and combined index
+    functions and any history decimation, and invalidates only the rays
+    violating energy conservation.
+    """
+    lc = LocalCoordinates(name="root")
+    lcsurf = lc.addChild(LocalCoordinates(name="surf", decz=2.0))
+    surface = Surface(lcsurf, shape=Conic(lcsurf, curv=0.0))
+
+    def nandgrad(x, **kw):
+        return (1.5 + x[0]**2,
+                np.array([2.*x[0], np.zeros_like(x[0]), np.zeros_like(x[0])]))
+
+    def nfunc(x, **kw):
+        return nandgrad(x)[0]
+
+    def dndx(x, **kw):
+        return nandgrad(x)[1][0]
+
+    def zero(x, **kw):
+        return np.zeros_like(x[0])
+
+    num_rays = 6
+    x0 = np.zeros((3, num_rays))
+    # strong index gradient at x = 1 leads to energy violation
+    x0[0, 3:] = 1.
+    k0 = np.zeros((3, num_rays))
+    k0[2] = 1.
+
+    raybundles = []
+    for (nandgradfunc, decimation) in [(None, 1), (nandgrad, 10),
+                                       (nandgrad, 0)]:
+        grin = IsotropicGrinMaterial(lc, nfunc, dndx, zero, zero,
+                                     nandgradfunc=nandgradfunc)
+        grin.ds = 0.05
+        grin.energyviolation = 1e-6
+        grin.history_decimation = decimation
+        raybundle = RayBundle(x0, k0, None)
+        (pos, vel, energies, valid) = grin.symplecticintegrator(
+            raybundle, surface, grin.ds)
+        assert np.array_equal(valid, [True]*3 + [False]*3)
+        assert np.all(energies[3:] > grin.energyviolation)
+        raybundles.append(raybundle)
+
+    # 14 steps with history, 10th and final step, final step only
+    assert [np.shape(rb.x)[0] for rb in raybundles] == [15, 3, 2]
+    for raybundle in raybundles:
+        assert np.allclose(raybundle.x[-1], raybundles[0].x[-1])
+        # valid rays end on the surface
+        assert np.allclose(raybundle.x[-1][2, :3], 2.0)
+        assert np.array_equal(raybundle.valid[-1], valid)
+
+
+def test_grin_adaptive_step():
+    """
+    Adaptive GRIN integration with large initial step reproduces the
+    integration with small fixed step up to a curved surface with an
+    order of magnitude fewer steps.
+    """
+    lc = LocalCoordinates(name="root")
+    lcsurf = lc.addChild(LocalCoordinates(name="surf", decz=10.0))
+    surface = Surface(lcsurf, shape=Conic(lcsurf, curv=0.05))
+
+    def nandgrad(x, **kw):
+        return (1.6 - 0.01*(x[0]**2 + x[1]**2),
+                np.array([-0.02*x[0], -0.02*x[1], np.zeros_like(x[0])]))
+
+    def nfunc(x, **kw):
+        return nandgrad(x)[0]
+
+    num_rays = 5
+    x0 = np.zeros((3, num_rays))
+    x0[1] = np.linspace(0., 2., num_rays)
+    k0 = np.zeros((3, num_rays))
+    k0[2] = 1.
+
+    results = []
+    for (ds, adaptive) in [(0.001, False), (0.1, True)]:
+        grin = IsotropicGrinMaterial(lc, nfunc, None, None, None,
+                                     nandgradfunc=nandgrad)
+        grin.adaptive = adaptive
+        grin.steptolerance = 1e-10
+        raybundle = RayBundle(x0, k0, None)
+        (pos, vel, _, valid) = grin.symplecticintegrator(raybundle,
+                                                         surface, ds)
+        assert np.all(valid)
+        assert np.allclose(grin.returnSurfaceDistance(pos, surface), 0.)
+        results.append((np.shape(raybundle.x)[0], pos, vel))
+
+    ((steps_fixed, pos_fixed, vel_fixed),
+     (steps_adaptive, pos_adaptive, vel_adaptive)) = results
+    assert 10*steps_adaptive < steps_fixed
+    assert np.allclose(pos_adaptive, pos_fixed, atol=1e-7)
+    assert np.allclose(vel_adaptive, vel_fixed, atol=1e-7)
+
+
+def test_catalog_material_index_array():
+    """
+    Index of catalog material for an array of wavelengths equals
+    index for the single wavelengths.
+    """
+    lc = LocalCoordinates(name="root")
+    # N-BK7 Sellmeier coefficients (refractiveindex.info formula 2)
+    nbk7 = CatalogMaterial(lc, {"DATA": [{
+        "type": "formula 2",
+        "wavelength_range": "0.3 2.5",
+        "coefficients": "0 1.03961212 0.00600069867 0.231792344 " +
+                        "0.0200179144 1.01046945 103.560653"}]})
+    waves = np.linspace(0.4e-3, 0.7e-3, 7)
+    indices = nbk7.getIndex(None, waves)
+    assert np.shape(indices) == np.shape(waves)
+    assert np.allclose(indices, [nbk7.getIndex(None, wave) for wave in waves])
+    assert abs(nbk7.getIndex(None, 0.5875618e-3) - 1.5168) < 1e-4
+
+
+def test_catalog_material_index_cache():
+    """
+    Cached indices equal the dispersion formula (also after eviction
+    from the bounded cache), out of range wavelengths raise an exception.
+    """
+    lc = LocalCoordinates(name="root")
+    nbk7 = CatalogMaterial(lc, {"DATA": [{
+        "type": "formula 2",
+        "wavelength_range": "0.3 2.5",
+        "coefficients": "0 1.03961212 0.00600069867 0.231792344 " +
+                        "0.0200179144 1.01046945 103.560653"}]},
+                           index_cache_size=3)
+    (b1, c1, b2, c2, b3, c3) = (1.03961212, 0.00600069867, 0.231792344,
+                                0.0200179144, 1.01046945, 103.560653)
+
+    def sellmeier(wave):
+        w2 = (wave*1e3)**2
+        return np.sqrt(1. + b1*w2/(w2 - c1) + b2*w2/(w2 - c2) +
+                       b3*w2/(w2 - c3))
+
+    waves = np.array([0.4e-3, 0.5e-3, 0.6e-3, 0.5e-3, 0.4e-3])
+    for wave in waves.tolist()*2:
+        assert abs(nbk7.getIndex(None, wave) - sellmeier(wave)) < 1e-12
+    assert np.allclose(nbk7.getIndex(None, waves), sellmeier(waves))
+    assert np.allclose(nbk7.getIndex(None, np.linspace(0.4e-3, 0.7e-3, 11)),
+                       sellmeier(np.linspace(0.4e-3, 0.7e-3, 11)))
+
+    with pytest.raises(Exception):
+        nbk7.getIndex(None, 3.0e-3)
+
+
+def test_glass_catalog_index(tmpdir, monkeypatch):
+    """
+    Glass catalogue writes an index next to library.yml, uses it for
+    lookups and rebuilds it if library.yml changes.
+    """
+    library_template = """
+- SHELF: glass
+  name: "Glasses"
+  content:
+    - DIVIDER: "Schott"
+    - BOOK: BK7
+      name: "BK7"
+      content:
+        - PAGE: SCHOTT
+          name: "%s"
+          data: "glass/schott/N-BK7.yml"
+"""
+    page = """
+DATA:
+  - type: formula 2
+    wavelength_range: 0.3 2.5
+    coefficients: 0 1.03961212 0.00600069867 0.231792344 0.0200179144 1.01046945 103.560653
+"""
+    tmpdir.join("library.yml").write(library_template % ("N-BK7",))
+    tmpdir.mkdir("data").mkdir("glass").mkdir("schott").join(
+        "N-BK7.yml").write(page)
+
+    gcat = refractiveindex_dot_info_glasscatalog(str(tmpdir))
+    assert tmpdir.join("library_index.pickle").check()
+    assert gcat.getDictOfLongNames() == {"N-BK7": ("glass", "BK7", "SCHOTT")}
+
+    lc = LocalCoordinates(name="root")
+    nbk7 = gcat.createGlassObjectFromLongName(lc, "N-BK7")
+    assert abs(nbk7.getIndex(None, 0.5875618e-3) - 1.5168) < 1e-4
+    with pytest.raises(Exception):
+        gcat.getMaterialDictFromLongName("BK7")
+
+    # pages are parsed once; callers get copies of the cached page
+    (matdict, dispersion_data) = gcat.getPageData("glass", "BK7", "SCHOTT")
+    assert gcat.getPageData("glass", "BK7", "SCHOTT")[1] is dispersion_data
+    ymldict = gcat.getMaterialDict("glass", "BK7", "SCHOTT")
+    assert ymldict == matdict and ymldict is not matdict
+
+    # index file is used by a new catalogue (also in a new process)
+    def read_library_fails(self, library_yml_filename):
+        raise Exception("library.yml parsed although index is valid")
+
+    refractiveindex_dot_info_glasscatalog.library_cache.clear()
+    monkeypatch.setattr(refractiveindex_dot_info_glasscatalog,
+                        "read_library", read_library_fails)
+    gcat2 = refractiveindex_dot_info_glasscatalog(str(tmpdir))
+    assert gcat2.getDictOfLongNames() == gcat.getDictOfLongNames()
+    monkeypatch.undo()
+
+    # newer library file
+    library = tmpdir.join("library.yml")
+    library.write(library_template % ("N-BK7HT",))
+    library.setmtime(library.mtime() + 10)
+    gcat3 = refractiveindex_dot_info_glasscatalog(str(tmpdir))
+    assert gcat3.getDictOfLongNames() ==\
+        {"N-BK7HT": ("glass", "BK7", "SCHOTT")}
+
+
+def test_glass_catalog_nearest_glass(tmpdir, monkeypatch):
+    """
+    Nearest glass searches in (nd, vd), (nd, vd, PgF) and by glass code.
+    """
+    monkeypatch.setattr(refractiveindex_dot_info_glasscatalog,
+                        "page_cache_size", 2)
+    sellmeier_coefficients = {
+        "N-BK7": "1.03961212 0.00600069867 0.231792344 0.0200179144 " +
+                 "1.01046945 103.560653",
+        "F2": "1.34533359 0.00997743871 0.209073176 0.0470450767 " +
+              "0.937357162 111.886764",
+        "N-SF11": "1.73759695 0.013188707 0.313747346 0.0623068142 " +
+                  "1.89878101 155.23629"}
+
+    library = "- SHELF: glass\n  name: Glasses\n  content:\n"
+    pagedir = tmpdir.mkdir("data").mkdir("glass")
+    for (name, coefficients) in sellmeier_coefficients.items():
+        library += ("    - BOOK: %s\n      name: %s\n      content:\n" +
+                    "        - PAGE: SCHOTT\n          name: \"%s\"\n" +
+                    "          data: \"glass/%s.yml\"\n") %\
+            (name, name, name, name)
+        pagedir.join(name + ".yml").write(
+            "DATA:\n  - type: formula 2\n    wavelength_range: 0.3 2.5\n" +
+            "    coefficients: 0 " + coefficients + "\n")
+    tmpdir.join("library.yml").write(library)
+
+    gcat = refractiveindex_dot_info_glasscatalog(str(tmpdir))
+
+    table = gcat.getDispersionTable()
+    nbk7 = table["longnames"].index("N-BK7")
+    assert abs(table["nd"][nbk7] - 1.5168) < 1e-4
+    assert abs(table["vd"][nbk7] - 64.17) < 0.05
+    assert tmpdir.join("library_dispersion.pickle").check()
+    assert len(refractiveindex_dot_info_glasscatalog.page_cache) <= 2
+
+    f2dict = gcat.getMaterialDictFromLongName("F2")
+    assert gcat.getMaterialDictCloseTo_nd_vd(nd=1.62, vd=37.) == f2dict
+    assert gcat.getMaterialDictCloseTo_nd_vd_PgF(nd=1.62, vd=37.,
+                                                 PgF=0.59) == f2dict
+    assert gcat.getMaterialDictFromSchottCode(517642) ==\
+        gcat.getMaterialDictFromLongName("N-BK7")
+    with pytest.raises(Exception):
+        gcat.getMaterialDictFromSchottCode(123456)
+
+    (longnames, distances) = gcat.findGlassesCloseTo(
+        np.array([1.5, 1.8, 1.63]), np.array([60., 25., 35.]))
+    assert list(longnames) == ["N-BK7", "N-SF11", "F2"]
+    assert np.shape(distances) == (3,)
+    (longnames, _) = gcat.findGlassesCloseTo(1.5, 60., num=2)
+    assert list(longnames) == ["N-BK7", "F2"]
+    (longnames, distances) = gcat.findGlassesCloseTo(1.5, 60., num=5)
+    assert list(longnames) == ["N-BK7", "F2", "N-SF11"]
+    assert np.all(np.isfinite(distances))
+
+    # trees are rebuilt with the table if library.yml changes
+    library = tmpdir.join("library.yml")
+    library.write(library.read().replace('name: "N-SF11"', 'name: "SF11"'))
+    library.setmtime(library.mtime() + 10)
+    (longnames, _) = gcat.findGlassesCloseTo(1.8, 25.)
+    assert longnames == "SF11"
@@ -0,0 +1,187 @@
+#!/usr/bin/env/python
+"""
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2014-2018
+               by     Moritz Esslinger moritz.esslinger@web.de
+               and    Johannes Hartung j.hartung@gmx.net
+               and    Uwe Lippmann  uwe.lippmann@web.de
+               and    Thomas Heinze t.heinze@uni-jena.de
+               and    others
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import numpy as np
+from pyrateoptics import build_rotationally_symmetric_optical_system
+from pyrateoptics.raytracer.ray import RayBundle
+from pyrateoptics.core.base import OptimizableVariable
+from pyrateoptics.raytracer.localcoordinates import LocalCoordinates
+from pyrateoptics.raytracer.surface import Surface
+from pyrateoptics.raytracer.surface_shape import Conic
+from pyrateoptics.raytracer.aperture import CircularAperture
+from pyrateoptics.raytracer.optical_element import OpticalElement
+from pyrateoptics.material.material_isotropic import ConstantIndexGlass
+from pyrateoptics.analysis.optical_system_analysis import\
+    OpticalSystemAnalysis
+
+
+def build_doublet():
+    """
+    Simple doublet with constant index glasses.
+    """
+    (system, seq) = build_rotationally_symmetric_optical_system(
+        [(0, 0, 0., None, "object", {}),
+         (62.8, 0, 5.0, 1.5168, "front", {}),
+         (-45.7, 0, 4.0, 1.6727, "cement", {}),
+         (-128.2, 0, 2.5, None, "rear", {}),
+         (0, 0, 97.2, None, "image", {})])
+    return (system, seq)
+
+
+def build_bundle(num_rays=10, geometric=False):
+    """
+    Collimated bundle in z direction.
+    """
+    x0 = np.zeros((3, num_rays))
+    x0[1] = np.linspace(-5., 5., num_rays)
+    x0[2] = -1.
+    k0 = np.zeros((3, num_rays))
+    k0[2] = 2.*np.pi/0.5876e-3
+    return RayBundle(x0, k0, None, geometric=geometric)
+
+
+def test_seqtrace_record_surfaces():
+    """
+    Streaming trace keeps only recorded and final bundles, which
+    are identical to those of the full trace.
+    """
+    (system, seq) = build_doublet()
+    (elem, _) = seq[0]
+    full_path = system.seqtrace(build_bundle(), seq)[0]
+    final_path = system.seqtrace(build_bundle(), seq,
+                                 record_surfaces=[])[0]
+    recorded_path = system.seqtrace(build_bundle(), seq,
+                                    record_surfaces=[(elem, "cement")])[0]
+    assert len(final_path.raybundles) == 1
+    assert len(recorded_path.raybundles) == 2
+    assert np.allclose(final_path.raybundles[-1].x,
+                       full_path.raybundles[-1].x)
+    assert np.allclose(final_path.raybundles[-1].k,
+                       full_path.raybundles[-1].k)
+    # bundle ending at cement is the fourth bundle of the full trace
+    # (initial bundle appears twice in the full trace)
+    assert np.allclose(recorded_path.raybundles[0].x[-1],
+                       full_path.raybundles[3].x[-1])
+
+
+def test_seqtrace_geometric():
+    """
+    Geometric trace gives the same rays as the full trace but
+    carries real wave vectors and no electrical field.
+    """
+    (system, seq) = build_doublet()
+    full_path = system.seqtrace(build_bundle(), seq)[0]
+    geometric_path = system.seqtrace(build_bundle(geometric=True), seq)[0]
+    assert len(geometric_path.raybundles) == len(full_path.raybundles)
+    for (rbg, rbf) in zip(geometric_path.raybundles, full_path.raybundles):
+        assert rbg.Efield is None
+        assert not np.iscomplexobj(rbg.k)
+        assert np.allclose(rbg.x, rbf.x)
+        assert np.allclose(rbg.k, rbf.k)
+        assert np.allclose(rbg.returnKtoD(), rbf.returnKtoD())
+        assert np.array_equal(rbg.valid, rbf.valid)
+
+
+def test_trace_cache():
+    """
+    Analysis functions reuse the traced rays until the variables of
+    the system change. Creating unrelated objects keeps the rays.
+    """
+    (system, seq) = build_doublet()
+    osa = OpticalSystemAnalysis(system, seq)
+    bundle = build_bundle()
+    osa.initial_bundles = [bundle]
+    raypaths = osa.trace()
+    assert osa.trace() == raypaths
+    assert osa.trace()[0] is raypaths[0]
+    assert bundle.x.shape[0] == 1
+    assert osa.trace(splitup=True)[0] is not raypaths[0]
+
+    # the caller gets a copy of the cached list
+    raypaths = osa.trace()
+    raypaths.pop()
+    assert len(osa.trace()) == 1
+
+    (x0, k0) = (bundle.x[0], bundle.k[0])
+    global1 = osa.trace3Dglobal(x0=x0, k0=k0)
+    raypaths = osa.trace()
+    osa.trace3Dlocal(x0=x0, k0=k0)
+    LocalCoordinates(name="unrelated").decz.setvalue(1.)
+    assert osa.isTraceCacheValid()
+    assert osa.trace()[0] is raypaths[0]
+
+    (elem, _) = seq[0]
+    surface = system.elements[elem].surfaces["front"]
+    surface.shape.curvature.setvalue(1./50.)
+    assert not osa.isTraceCacheValid()
+    global2 = osa.trace3Dglobal(x0=x0, k0=k0)
+    assert not np.allclose(global1[0][0][-1][0], global2[0][0][-1][0])
+    assert np.allclose(global1[0][0][0][0], global2[0][0][0][0])
+
+    # replaced variables (e.g. multi configurations) invalidate the cache
+    variables = system.getAllVariables()["vars"]
+    for (replaced, value) in [(surface.shape.curvature, 1./40.),
+                              (system.rootcoordinatesystem.decz, 0.5)]:
+        raypaths = osa.trace()
+        key = [k for (k, v) in variables.items() if v is replaced][0]
+        system.resetVariable(key, OptimizableVariable(name=replaced.name,
+                                                      value=value))
+        assert not osa.isTraceCacheValid()
+        assert osa.trace()[0] is not raypaths[0]
+        assert not np.allclose(raypaths[0][0].returnLastRayBundle().x[-1],
+                               osa.trace()[0][0].returnLastRayBundle().x[-1])
+
+
+def test_fused_conic_refraction():
+    """
+    The fused conic kernel gives the same bundles as propagate and
+    refract, also for tilted and decentered surfaces.
+    """
+    root = LocalCoordinates(name="root")
+    lcsurf = root.addChild(LocalCoordinates(name="surf", decz=5.0,
+                                            decy=0.3, tiltx=0.05))
+    lcmat = root.addChild(LocalCoordinates(name="mat", decz=2.0,
+                                           tilty=0.1))
+    surface = Surface(lcsurf, shape=Conic(lcsurf, curv=1./20., cc=-0.5),
+                      aperture=CircularAperture(lcsurf, maxradius=4.))
+    mat1 = ConstantIndexGlass(root, n=1.0)
+    mat2 = ConstantIndexGlass(lcmat, n=1.6)
+    elem = OpticalElement(root)
+    assert elem.isFusedConicRefraction(surface, mat1, mat2)
+
+    bundle_fused = build_bundle(20)
+    bundle_generic = build_bundle(20)
+    (fused,) = mat2.propagateConicAndRefract(bundle_fused, surface)
+    mat1.propagate(bundle_generic, surface)
+    (generic,) = mat2.refract(bundle_generic, surface)
+
+    assert np.allclose(bundle_fused.x, bundle_generic.x)
+    assert np.array_equal(bundle_fused.valid, bundle_generic.valid)
+    assert not np.all(bundle_fused.valid[-1])
+    assert np.allclose(fused.x, generic.x)
+    assert np.allclose(fused.k, generic.k)
+    assert np.allclose(fused.Efield, generic.Efield)
+    assert np.array_equal(fused.rayID, generic.rayID)
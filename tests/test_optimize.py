@@ -127,3 +127,190 @@ def test_optimization():
     optimi.meritfunction = testmerit2
     optimi.run()
     assert np.isclose(os.X()**2 + os.Y()**2, os.Z())
+
+
+def test_variable_registry():
+    """
+    Check that the cached variable registry is reused and follows
+    type changes and structural changes.
+    """
+
+    class ExampleSubClass(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleSubClass, self).__init__(name="sub")
+            self.a = OptimizableVariable(name="a",
+                                         variable_type="variable",
+                                         value=1.0)
+
+    class ExampleSuperClass(ClassWithOptimizableVariables):
+        def __init__(self):
+            super(ExampleSuperClass, self).__init__(name="super")
+            self.b = OptimizableVariable(name="b",
+                                         variable_type="fixed",
+                                         value=2.0)
+            self.c = ExampleSubClass()
+
+    s = ExampleSuperClass()
+    other = ExampleSubClass()
+
+    assert s.getAllVariables() is s.getAllVariables()
+    assert len(s.getActiveVariables()) == 1
+    assert np.allclose(s.getActiveValues(), [1.0])
+
+    # variables of other objects do not leak into the registry
+    assert len(other.getAllVariables()["vars"]) == 1
+    assert len(s.getAllVariables()["vars"]) == 2
+
+    s.b.changetype("variable")
+    assert len(s.getActiveVariables()) == 2
+
+    s.setActiveTransformedValues(np.array([5.0, 6.0]))
+    assert sorted(s.getActiveValues()) == [5.0, 6.0]
+    assert s.getAllVariables() is s.getAllVariables()
+
+    s.c.d = OptimizableVariable(name="d", variable_type="variable",
+                                value=3.0)
+    assert len(s.getActiveVariables()) == 3
+    assert s.getVariable("super.sub.d")() == 3.0
+
+    s.resetVariable("super.sub.d", OptimizableVariable(name="d",
+                                             variable_type="fixed",
+                                             value=4.0))
+    assert s.getVariable("super.sub.d")() == 4.0
+    assert len(s.getActiveVariables()) == 2
+
+
+def test_evaluation_plan():
+    """
+    Check bulk evaluation of chained pickups and vectorized interval
+    transforms against the evaluation of the single variables.
+    """
+
+    calls = []
+
+    def count_calls(x, y):
+        calls.append(1)
+        return x + y
+
+    sum_fo = FunctionObject("f = lambda x, y: x + y", ["f"])
+    counting_fo = FunctionObject("", [])
+    counting_fo.functions["f"] = count_calls
+
+    os = ClassWithOptimizableVariables(name="os")
+    os.x = OptimizableVariable(name="x", variable_type="variable", value=1.0)
+    os.y = OptimizableVariable(name="y", variable_type="variable", value=0.5)
+    os.x.set_interval(-2.0, 3.0)
+    os.z = OptimizableVariable(name="z", variable_type="fixed", value=2.0)
+    # pickup chain z1 = x + y, z2 = z1 + z1, z3 = z2 + z2
+    os.z1 = OptimizableVariable(name="z1", variable_type="pickup",
+                                functionobject=(counting_fo, "f"),
+                                args=(os.x, os.y))
+    os.z2 = OptimizableVariable(name="z2", variable_type="pickup",
+                                functionobject=(sum_fo, "f"),
+                                args=(os.z1, os.z1))
+    os.z3 = OptimizableVariable(name="z3", variable_type="pickup",
+                                functionobject=(sum_fo, "f"),
+                                args=(os.z2, os.z2))
+
+    active = os.getActiveVariables()
+    xt = os.getActiveTransformedValues()
+    assert np.allclose(xt, [v.evaluate_transformed() for v in active])
+
+    xt_new = xt + np.array([0.3, -0.2])
+    os.setActiveTransformedValues(xt_new)
+    assert np.allclose([v() for v in active],
+                       [v.inv_transform(t) for (v, t) in zip(active, xt_new)])
+    assert -2.0 < os.x() < 3.0
+    assert len(calls) == 1
+
+    # pickups are not reevaluated until a variable changes
+    assert np.isclose(os.z3(), 4.*(os.x() + os.y()))
+    assert len(calls) == 1
+
+    os.y.setvalue(1.5)
+    assert np.isclose(os.z3(), 4.*(os.x() + 1.5))
+    assert len(calls) > 1
+
+
+def test_evaluation_plan_externals():
+    """
+    Integer values keep the value array of the plan numeric and pickups
+    and version stamps depending on external variables are never stale.
+    """
+
+    sum_fo = FunctionObject("f = lambda x, y: x + y", ["f"])
+    external_fo = FunctionObject("", [])
+    external_fo.functions["f"] = lambda values: values[0]
+    external_values = [1.0]
+
+    os = ClassWithOptimizableVariables(name="os")
+    os.x = OptimizableVariable(name="x", variable_type="variable", value=1.0)
+    os.n = OptimizableVariable(name="n", variable_type="fixed", value=2)
+    os.e = OptimizableVariable(name="e", variable_type="external",
+                               functionobject=(external_fo, "f"),
+                               args=(external_values,))
+    os.p = OptimizableVariable(name="p", variable_type="pickup",
+                               functionobject=(sum_fo, "f"),
+                               args=(os.x, os.e))
+    os.q = OptimizableVariable(name="q", variable_type="pickup",
+                               functionobject=(sum_fo, "f"),
+                               args=(os.p, os.n))
+
+    os.setActiveTransformedValues(np.array([3.0]))
+    plan = os.getVariableRegistry()["plan"]
+    assert plan.values.dtype == float
+    assert os.q() == 6.0
+
+    external_values[0] = 5.0
+    assert os.p() == 8.0
+    assert os.q() == 10.0
+    assert os.e.getRevision() != os.e.getRevision()
+    assert os.getVersionStamp() != os.getVersionStamp()
+
+    os.e = OptimizableVariable(name="e", value=1.0)
+    os.p.parameters["args"] = (os.x, os.e)
+    os.p.markStructureChanged()
+    stamp = os.getVersionStamp()
+    assert os.getVersionStamp() == stamp
+    os.x.setvalue(2.0)
+    assert os.getVersionStamp() != stamp
+
+
+def test_structure_changes():
+    """
+    Only assignments which link or unlink variables change the structure
+    revision, and only registries of trees containing the changed object
+    are rebuilt. In place changes of containers have to be marked.
+    """
+
+    os = ClassWithOptimizableVariables(name="os")
+    os.x = OptimizableVariable(name="x", variable_type="variable", value=1.0)
+    os.lst = []
+    registry = os.getVariableRegistry()
+
+    os.cache = {"values": (1.0, np.zeros(3))}
+    os.lst = []
+    assert os.getVariableRegistry() is registry
+
+    os.lst.append(os.x)
+    assert os.getVariableRegistry() is registry
+    os.markStructureChanged()
+    assert os.getVariableRegistry() is not registry
+
+    registry = os.getVariableRegistry()
+    os.lst = []
+    assert os.getVariableRegistry() is not registry
+
+    # only changes within the object tree invalidate the registry
+    os.sub = ClassWithOptimizableVariables(name="sub")
+    registry = os.getVariableRegistry()
+    unrelated = ClassWithOptimizableVariables(name="unrelated")
+    unrelated.y = OptimizableVariable(name="y", value=2.0)
+    assert os.getVariableRegistry() is registry
+
+    os.sub.y = unrelated.y
+    assert os.getVariableRegistry() is not registry
+    registry = os.getVariableRegistry()
+    os.sub.y.changetype("variable")
+    assert os.getVariableRegistry() is not registry
+    assert len(os.getVariableRegistry()["active"]) == 2
@@ -0,0 +1,139 @@
+#!/usr/bin/env/python
+"""
+Pyrate - Optical raytracing based on Python
+
+Copyright (C) 2014-2018
+               by     Moritz Esslinger moritz.esslinger@web.de
+               and    Johannes Hartung j.hartung@gmx.net
+               and    Uwe Lippmann  uwe.lippmann@web.de
+               and    Thomas Heinze t.heinze@uni-jena.de
+               and    others
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import numpy as np
+import pytest
+from copy import deepcopy
+from pyrateoptics.raytracer.ray import RayBundle, RayPath
+from pyrateoptics.raytracer.localcoordinates import LocalCoordinates
+
+
+def test_append_preallocated():
+    """
+    Appending beyond the preallocated storage keeps all points and the
+    cumulative validity.
+    """
+    x0 = np.random.random((3, 4))
+    k0 = np.random.random((3, 4))
+    raybundle = RayBundle(x0, k0, None, numsteps=2)
+    xlist = [x0]
+    for i in range(5):
+        xnew = np.random.random((3, 4))
+        validnew = np.array([True, True, i != 2, True])
+        raybundle.append(xnew, k0, raybundle.Efield[-1], validnew)
+        xlist.append(xnew)
+    assert np.shape(raybundle.x) == (6, 3, 4)
+    assert np.allclose(raybundle.x, np.array(xlist))
+    assert np.all(raybundle.valid[:3, 2])
+    assert not np.any(raybundle.valid[3:, 2])
+    assert np.allclose(raybundle.x[-1], xlist[-1])
+
+
+def test_append_complex_upcast():
+    """
+    Appending complex wave vectors to a real bundle does not discard the
+    imaginary part.
+    """
+    x0 = np.zeros((3, 2))
+    k0 = np.zeros((3, 2))
+    raybundle = RayBundle(x0, k0, None)
+    k1 = np.ones((3, 2)) + 1j*np.ones((3, 2))
+    raybundle.append(x0, k1, raybundle.Efield[-1], np.ones(2, dtype=bool))
+    assert np.allclose(raybundle.k[0], 0)
+    assert np.allclose(raybundle.k[-1], k1)
+
+
+def test_geometric_bundle():
+    """
+    Geometric bundles keep the real dtype of x0, drop the electrical
+    field and normalize the wave vectors to obtain directions. Setting
+    an electrical field is refused.
+    """
+    x0 = np.zeros((3, 2), dtype=np.float32)
+    k0 = np.array([[0., 3.], [0., 0.], [2., 4.]]) + 0.j
+    raybundle = RayBundle(x0, k0, np.ones((3, 2)), geometric=True)
+    raybundle.append(x0 + 1., 2.*k0, None, np.array([True, False]))
+    assert raybundle.Efield is None
+    assert raybundle.x.dtype == np.float32
+    assert raybundle.k.dtype == np.float32
+    assert np.allclose(raybundle.returnKtoD(-1),
+                       [[0., 0.6], [0., 0.], [1., 0.8]])
+    assert np.array_equal(raybundle.valid[-1], [True, False])
+    clone = raybundle.clone()
+    assert clone.geometric
+    assert np.allclose(clone.x, raybundle.x)
+    raybundle.Efield = None
+    with pytest.raises(Exception):
+        raybundle.Efield = np.ones((2, 3, 2))
+
+
+def test_local_points_from_intersection():
+    """
+    Local points of an intersection are transformed frame to frame and
+    agree with the transformation from global coordinates.
+    """
+    root = LocalCoordinates(name="root")
+    lcshape = root.addChild(LocalCoordinates(name="shape", decz=10.,
+                                             tiltx=0.1))
+    lcmat = root.addChild(LocalCoordinates(name="mat", decy=2.,
+                                           tilty=-0.2))
+    x0 = np.random.random((3, 5))
+    k0 = np.random.random((3, 5))
+    raybundle = RayBundle(x0, k0, None)
+    xlocal = np.random.random((3, 5))
+    raybundle.appendIntersection(lcshape, xlocal, np.ones(5, dtype=bool))
+    assert np.allclose(raybundle.x[-1],
+                       lcshape.returnLocalToGlobalPoints(xlocal))
+    assert np.allclose(raybundle.returnLocalPoints(lcshape), xlocal)
+    assert np.allclose(raybundle.returnLocalPoints(lcmat),
+                       lcmat.returnGlobalToLocalPoints(raybundle.x[-1]))
+    lcshape.decx.setvalue(1.)
+    assert np.allclose(raybundle.returnLocalPoints(lcmat),
+                       lcmat.returnGlobalToLocalPoints(raybundle.x[-1]))
+
+
+def test_raypath_branch():
+    """
+    Branched ray paths share their common raybundles and can be
+    continued independently.
+    """
+    bundles = [RayBundle(np.zeros((3, 2)), np.ones((3, 2)), None)
+               for _ in range(4)]
+    raypath = RayPath(bundles[0])
+    raypath.appendRayBundle(bundles[1])
+    branched = raypath.branch()
+    raypath.appendRayBundle(bundles[2])
+    branched.appendRayBundle(bundles[3])
+    assert raypath.raybundles == tuple(bundles[:3])
+    assert branched.raybundles == tuple(bundles[:2] + [bundles[3]])
+    assert branched.raybundles[0] is raypath.raybundles[0]
+    assert raypath.raybundles is raypath.raybundles
+    assert raypath.popRayBundle() is bundles[2]
+    assert raypath.getNumberOfRayBundles() == 2
+    assert branched.returnLastRayBundle() is bundles[3]
+    copied = deepcopy(branched)
+    assert copied.getNumberOfRayBundles() == 3
+    assert copied.raybundles[0] is not bundles[0]
@@ -25,6 +25,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import math
+import subprocess
+from distutils.spawn import find_executable
+import pytest
 from hypothesis import given
 from hypothesis.strategies import floats
 from hypothesis.extra.numpy import arrays
@@ -32,8 +35,13 @@ import numpy as np
 from pyrateoptics.raytracer.surface_shape import (Conic,
                                                   Asphere,
                                                   Biconic,
-                                                  XYPolynomials)
+                                                  XYPolynomials,
+                                                  ZernikeFringe,
+                                                  ZMXDLLShape)
 from pyrateoptics.raytracer.localcoordinates import LocalCoordinates
+from pyrateoptics.raytracer.ray import RayBundle
+from pyrateoptics.core.base import OptimizableVariable
+from pyrateoptics.core.functionobject import FunctionObject
 
 
 # pylint: disable=no-value-for-parameter
@@ -350,3 +358,301 @@ def xypolynomials_grad(test_vector):
     comparison[2, :] = 1.
 
     assert np.allclose(gradient, comparison)
+
+
+def test_explicit_intersect():
+    """
+    Intersection points of rays with explicit shapes lie on the surface,
+    rays missing the surface are invalid.
+    """
+    coordinate_system = LocalCoordinates(name="root", decz=5.0)
+    shapes = [Asphere(coordinate_system, curv=0.05, cc=-0.5,
+                      coefficients=[1e-4, -1e-6]),
+              Biconic(coordinate_system, curvx=0.03, curvy=0.05,
+                      ccx=0.1, ccy=-0.2, coefficients=[(1e-4, 0.1)]),
+              XYPolynomials(coordinate_system, normradius=10.,
+                            coefficients=[(2, 0, 0.05), (0, 2, 0.03),
+                                          (2, 1, 0.01)])]
+    num_pts = 100
+    np.random.seed(1234)
+    x0 = np.zeros((3, num_pts))
+    x0[0:2] = 8.*np.random.random((2, num_pts)) - 4.
+    k0 = np.zeros((3, num_pts))
+    k0[2] = 1.
+    k0[0] = 0.1*np.random.randn(num_pts)
+    k0 = k0/np.sqrt(np.sum(k0**2, axis=0))
+    efield0 = np.zeros((3, num_pts))
+    efield0[1] = 1.
+
+    for shape in shapes:
+        raybundle = RayBundle(x0, k0, efield0)
+        shape.intersect(raybundle)
+        xlocal = coordinate_system.returnGlobalToLocalPoints(raybundle.x[-1])
+        assert np.all(raybundle.valid[-1])
+        assert np.allclose(xlocal[2], shape.getSag(xlocal[0], xlocal[1]))
+
+    # sag is only defined for r < 1/curv = 2
+    small_sphere = Asphere(coordinate_system, curv=0.5)
+    x0[0] = np.linspace(0., 4., num_pts)
+    x0[1] = 0.
+    k0 = np.zeros((3, num_pts))
+    k0[2] = 1.
+    raybundle = RayBundle(x0, k0, efield0)
+    small_sphere.intersect(raybundle)
+    assert np.all(raybundle.valid[-1] == (x0[0] < 2.))
+
+
+def test_explicit_intersect_seed():
+    """
+    Asphere without polynomial coefficients is seeded with its exact
+    intersection, therefore Newton converges in one iteration.
+    Statistics are recorded in the raybundle.
+    """
+    coordinate_system = LocalCoordinates(name="root", decz=5.0)
+    asphere = Asphere(coordinate_system, curv=0.25, cc=-0.5)
+    num_pts = 100
+    x0 = np.zeros((3, num_pts))
+    x0[0] = np.linspace(-3.5, 3.5, num_pts)
+    k0 = np.zeros((3, num_pts))
+    k0[0] = -0.6*x0[0]/3.5
+    k0[1] = 0.3
+    k0[2] = 1.
+    k0 = k0/np.sqrt(np.sum(k0**2, axis=0))
+    efield0 = np.zeros((3, num_pts))
+    efield0[1] = 1.
+
+    raybundle = RayBundle(x0, k0, efield0)
+    asphere.intersect(raybundle)
+    statistics = raybundle.intersection_statistics[asphere.name]
+    assert np.all(raybundle.valid[-1])
+    assert np.all(statistics["iterations"] == 1)
+    assert np.all(statistics["residual"] < 1e-12)
+
+
+def test_zernike_expansion():
+    """
+    Sag of the Zernike expansion equals sum of single terms, gradient and
+    Hessian equal finite differences and are finite at the vertex.
+    """
+    coordinate_system = LocalCoordinates(name="root")
+    np.random.seed(1234)
+    coefficients = list(0.1*np.random.randn(37))
+    normradius = 5.0
+    zernike = ZernikeFringe(coordinate_system, normradius=normradius,
+                            coefficients=coefficients)
+    x = 8.*np.random.random(100) - 4.
+    y = 8.*np.random.random(100) - 4.
+
+    def zernike_term(j, xp, yp):
+        (n, m) = zernike.jtonm(j)
+        omega = abs(m)
+        r = np.sqrt(xp**2 + yp**2)
+        phi = np.arctan2(yp, xp)
+        radial = sum([(-1)**l*math.factorial(n - l) /
+                      (math.factorial(l)*math.factorial((n + omega)//2 - l) *
+                       math.factorial((n - omega)//2 - l))*r**(n - 2*l)
+                      for l in range((n - omega)//2 + 1)])
+        return radial*(np.sin(omega*phi) if m < 0 else np.cos(omega*phi))
+
+    sag_terms = np.zeros_like(x)
+    for (j, coefficient) in enumerate(coefficients):
+        sag_terms += coefficient*zernike_term(j + 1, x/normradius,
+                                              y/normradius)
+    assert np.allclose(zernike.getSag(x, y), sag_terms)
+    assert np.allclose(zernike.zernike_norm_j(12, x/normradius,
+                                              y/normradius),
+                       zernike_term(12, x/normradius, y/normradius))
+
+    step = 1e-6
+    grad = zernike.getGrad(x, y)
+    dzdx = (zernike.getSag(x + step, y) - zernike.getSag(x - step, y))/(2.*step)
+    dzdy = (zernike.getSag(x, y + step) - zernike.getSag(x, y - step))/(2.*step)
+    assert np.allclose(-grad[0], dzdx, atol=1e-6)
+    assert np.allclose(-grad[1], dzdy, atol=1e-6)
+
+    step = 1e-5
+    hessian = zernike.getHessian(x, y)
+    gradxp = zernike.getGrad(x + step, y)
+    gradxm = zernike.getGrad(x - step, y)
+    gradyp = zernike.getGrad(x, y + step)
+    gradym = zernike.getGrad(x, y - step)
+    assert np.allclose(hessian[0, 0], (gradxp[0] - gradxm[0])/(2.*step),
+                       atol=1e-6)
+    assert np.allclose(hessian[0, 1], (gradyp[0] - gradym[0])/(2.*step),
+                       atol=1e-6)
+    assert np.allclose(hessian[1, 1], (gradyp[1] - gradym[1])/(2.*step),
+                       atol=1e-6)
+
+    origin = np.zeros(1)
+    assert np.all(np.isfinite(zernike.getGrad(origin, origin)))
+    assert np.all(np.isfinite(zernike.getHessian(origin, origin)))
+
+
+def test_xypolynomials_coefficient_cache():
+    """
+    Cached XY coefficients follow changes of variables and pickups,
+    Hessian equals explicit calculation
+    """
+    coordinate_system = LocalCoordinates(name="root")
+    shape = XYPolynomials(coordinate_system, normradius=2.,
+                          coefficients=[(2, 0, 1.), (1, 2, 0.5)])
+    x = np.linspace(-1., 1., 7)
+    y = np.linspace(0.5, -1.5, 7)
+
+    def comparison(c20, c12, normradius):
+        return c20*x**2/normradius**2 + c12*x*y**2/normradius**3
+
+    assert np.allclose(shape.getSag(x, y), comparison(1., 0.5, 2.))
+
+    shape.params["CX2Y0"].setvalue(3.)
+    assert np.allclose(shape.getSag(x, y), comparison(3., 0.5, 2.))
+
+    scale = OptimizableVariable("Variable", value=4.)
+    shape.params["CX1Y2"].changetype(
+        "pickup",
+        functionobject=(FunctionObject("f = lambda s: -s", ["f"]), "f"),
+        args=(scale,))
+    assert np.allclose(shape.getSag(x, y), comparison(3., -4., 2.))
+
+    scale.setvalue(1.)
+    shape.params["normradius"].setvalue(1.)
+    assert np.allclose(shape.getSag(x, y), comparison(3., -1., 1.))
+
+    hessian = shape.getHessian(x, y)
+    assert np.allclose(hessian[0, 0], -6.*np.ones_like(x))
+    assert np.allclose(hessian[0, 1], 2.*y)
+    assert np.allclose(hessian[1, 0], 2.*y)
+    assert np.allclose(hessian[1, 1], 2.*x)
+
+
+ZMXDLL_STAND_IN_SOURCE = """
+#include <math.h>
+
+typedef struct
+{
+    double x, y, z, l, m, n, ln, mn, nn, path, sag1, sag2;
+    double index, dndx, dndy, dndz, rel_surf_tran;
+    double udreserved1, udreserved2, udreserved3, udreserved4;
+    char string[20];
+} USER_DATA;
+
+typedef struct
+{
+    int type, numb, surf, wave;
+    double wavelength, pwavelength, n1, n2, cv, thic, sdia, k;
+    double param[9];
+    double fdreserved1;
+    double xdata[201];
+    char glass[21];
+} FIXED_DATA;
+
+/* conic with vertex shifted by param[1] + wavelength along z */
+int UserDefinedSurface(USER_DATA *UD, FIXED_DATA *FD)
+{
+    double cv = FD->cv, cz = FD->cv*(1. + FD->k);
+    double z0 = FD->param[1] + FD->wavelength;
+    double r2, z, F, G, H, square, t, norm;
+
+    switch (FD->type)
+    {
+    case 3:
+        r2 = UD->x*UD->x + UD->y*UD->y;
+        square = 1. - cv*cz*r2;
+        if (square < 0.)
+            return -1;
+        UD->sag1 = z0 + cv*r2/(1. + sqrt(square));
+        UD->sag2 = UD->sag1;
+        return 0;
+    case 5:
+        z = UD->z - z0;
+        F = UD->n - (cv*UD->l*UD->x + cv*UD->m*UD->y + cz*UD->n*z);
+        G = cv*UD->x*UD->x + cv*UD->y*UD->y + cz*z*z - 2.*z;
+        H = -(cv*UD->l*UD->l + cv*UD->m*UD->m + cz*UD->n*UD->n);
+        square = F*F + H*G;
+        if (square < 0.)
+            return -1;
+        t = G/(F + sqrt(square));
+        UD->x += t*UD->l;
+        UD->y += t*UD->m;
+        UD->z += t*UD->n;
+        UD->path = t;
+        z = UD->z - z0;
+        norm = sqrt(cv*cv*(UD->x*UD->x + UD->y*UD->y) +
+                    (1. - cz*z)*(1. - cz*z));
+        UD->ln = -cv*UD->x/norm;
+        UD->mn = -cv*UD->y/norm;
+        UD->nn = (1. - cz*z)/norm;
+        return 0;
+    }
+    return -1;
+}
+
+#ifdef WITH_BATCH
+int UserDefinedSurfaceBatch(int num, USER_DATA *UD, FIXED_DATA *FD, int *ret)
+{
+    int i;
+    for (i = 0; i < num; i++)
+        ret[i] = UserDefinedSurface(&UD[i], FD);
+    return 0;
+}
+#endif
+"""
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_zmxdll_shape(tmpdir, batched):
+    """
+    Sag, normal and intersection of a compiled stand-in DLL
+    (conic shifted by param 1 and wavelength) equal the conic, with
+    and without batched entry point, for mono- and polychromatic rays
+    """
+    compiler = find_executable("gcc")
+    if compiler is None:
+        pytest.skip("no C compiler available")
+
+    source = tmpdir.join("us_stand_in.c")
+    source.write(ZMXDLL_STAND_IN_SOURCE)
+    library = tmpdir.join("us_stand_in.so")
+    subprocess.check_call([compiler, "-shared", "-fpic", "-o",
+                           str(library), str(source), "-lm"] +
+                          (["-DWITH_BATCH"] if batched else []))
+
+    coordinate_system = LocalCoordinates(name="root")
+    (curv, cc, z0) = (0.05, -0.5, 0.1)
+    shape = ZMXDLLShape(coordinate_system, str(library),
+                        param_dict={"shift": (1, z0)}, curv=curv, cc=cc)
+    conic = Conic(coordinate_system, curv=curv, cc=cc)
+    assert (shape.us_surf_batch is not None) == batched
+
+    np.random.seed(4321)
+    x = 8.*np.random.random(50) - 4.
+    y = 8.*np.random.random(50) - 4.
+
+    assert np.allclose(shape.getSag(x, y), conic.getSag(x, y) + z0)
+    assert np.allclose(shape.getNormal(x, y), conic.getNormal(x, y))
+
+    num_rays = 50
+    x0 = np.zeros((3, num_rays))
+    x0[0] = x
+    x0[1] = y
+    x0[2] = -5.
+    k0 = np.zeros((3, num_rays))
+    k0[0] = 0.1
+    k0[2] = 1.
+    k0 = k0/np.sqrt(np.sum(k0**2, axis=0))
+    k0[:, -1] = np.array([1., 0., 0.])  # parallel to vertex plane, misses
+
+    wave = 1e-3*np.array([0.5, 0.6, 0.7])[np.arange(num_rays) % 3]
+    for raywave in (0.5876e-3, wave):
+        raybundle = RayBundle(x0, k0, None, wave=raywave)
+
+        shape.intersect(raybundle)
+        intersection = raybundle.x[-1]
+        valid = raybundle.valid[-1]
+
+        assert not valid[-1]
+        assert np.all(valid[:-1])
+        assert np.allclose(intersection[2, :-1],
+                           conic.getSag(intersection[0, :-1],
+                                        intersection[1, :-1]) + z0 +
+                           np.broadcast_to(raywave, num_rays)[:-1])